@@ -1,5 +1,12 @@
 """Paquete para seguimiento simple de pacientes bariátricos."""
 
-from .cli import main
-
 __all__ = ["main"]
+
+
+def __getattr__(name: str):
+    # ``main`` se importa al pedirlo: ``import patient_tracking.storage`` no debe cargar la CLI.
+    if name == "main":
+        from .cli import main
+
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
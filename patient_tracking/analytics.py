@@ -0,0 +1,211 @@
+"""Analítica de cohortes sobre el avance de etapas usando matrices de NumPy.
+
+El estado de las etapas se carga una sola vez en una matriz booleana
+pacientes × etapas (y otra con las fechas de término en segundos); los
+reportes de embudo, conversión, tiempo por etapa y cohortes se calculan con
+operaciones vectorizadas sobre esas matrices.
+
+NumPy es una dependencia opcional: si no está instalado, :func:`load_matrix`
+lanza :class:`AnalyticsUnavailable`.
+"""
+from __future__ import annotations
+
+import warnings
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable, List, Optional
+
+try:  # pragma: no cover - depende del entorno
+    import numpy as np
+except ImportError:  # pragma: no cover - NumPy es opcional
+    np = None  # type: ignore[assignment]
+
+from .storage import Patient
+from .workflow import STAGES, WorkflowStage
+
+COHORT_KEYS = ("mes", "canal")
+
+_SECONDS_PER_DAY = 86400.0
+
+
+class AnalyticsUnavailable(RuntimeError):
+    """NumPy no está instalado."""
+
+
+@dataclass
+class StageMatrix:
+    """Estado de las etapas de todos los pacientes en forma matricial.
+
+    ``completed[i, j]`` indica si el paciente ``i`` completó ``STAGES[j]`` y
+    ``completed_at[i, j]`` es la fecha de término en segundos desde epoch
+    (``NaN`` si no se completó o no hay fecha registrada).
+    """
+
+    patient_ids: List[str]
+    channels: "np.ndarray"
+    completed: "np.ndarray"
+    completed_at: "np.ndarray"
+
+    def __len__(self) -> int:
+        return len(self.patient_ids)
+
+
+@dataclass(frozen=True)
+class StageStats:
+    """Métricas de una etapa dentro del embudo."""
+
+    stage: WorkflowStage
+    completed: int
+    conversion: Optional[float]
+    drop_off: Optional[int]
+    median_days: Optional[float]
+
+
+@dataclass(frozen=True)
+class CohortStats:
+    """Resumen de una cohorte de pacientes."""
+
+    label: str
+    patients: int
+    mean_completed: float
+    finished: int
+    completed_by_stage: List[int]
+
+
+def _require_numpy() -> None:
+    if np is None:
+        raise AnalyticsUnavailable("La analítica requiere NumPy; instálelo con 'pip install numpy'.")
+
+
+def _timestamps(values: List[str]) -> "np.ndarray":
+    """Convertir fechas ISO (UTC, sin zona) a segundos; las inválidas quedan como ``NaN``."""
+    try:
+        return np.array(values, dtype="datetime64[s]").astype(np.float64)
+    except ValueError:
+        return np.array([_timestamp(value) for value in values], dtype=np.float64)
+
+
+def _timestamp(value: str) -> float:
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return float("nan")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def load_matrix(patients: Iterable[Patient]) -> StageMatrix:
+    """Cargar pacientes en matrices; este es el único paso que recorre pacientes en Python."""
+    _require_numpy()
+    stage_ids = np.array([stage.id for stage in STAGES], dtype=np.int64)
+    column = {str(stage.id): index for index, stage in enumerate(STAGES)}
+    patient_ids: List[str] = []
+    channels: List[str] = []
+    masks: List[int] = []
+    time_rows: List[int] = []
+    time_cols: List[int] = []
+    time_values: List[str] = []
+    for row, patient in enumerate(patients):
+        patient_ids.append(patient.patient_id)
+        channels.append(patient.preferred_channel.value)
+        masks.append(patient.stage_mask)
+        for stage_id, at in (patient.stage_times or {}).items():
+            if stage_id in column:
+                time_rows.append(row)
+                time_cols.append(column[stage_id])
+                time_values.append(at)
+    mask_array = np.array(masks, dtype=np.int64).reshape(-1, 1)
+    # Las etapas completadas ya son una máscara de bits: basta con desplazarla.
+    completed = ((mask_array >> stage_ids.reshape(1, -1)) & 1).astype(bool)
+    completed_at = np.full(completed.shape, np.nan)
+    if time_values:
+        completed_at[time_rows, time_cols] = _timestamps(time_values)
+    return StageMatrix(
+        patient_ids=patient_ids,
+        channels=np.array(channels, dtype=object),
+        completed=completed,
+        completed_at=completed_at,
+    )
+
+
+def _nanmedian(values: "np.ndarray") -> "np.ndarray":
+    with warnings.catch_warnings():
+        # Columnas sin ningún dato dan NaN, que se informa como "sin datos".
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmedian(values, axis=0)
+
+
+def funnel(matrix: StageMatrix) -> List[StageStats]:
+    """Completados por etapa, conversión y abandono respecto de la etapa anterior y mediana de días.
+
+    La conversión de una etapa es la fracción de pacientes que, habiendo
+    completado la anterior, también completaron esta. El tiempo en la etapa es
+    lo que pasa entre el término de la anterior y el de esta.
+    """
+    _require_numpy()
+    completed = matrix.completed
+    counts = completed.sum(axis=0)
+    both = (completed[:, 1:] & completed[:, :-1]).sum(axis=0)
+    previous = counts[:-1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        conversion = np.where(previous > 0, both / previous, np.nan)
+    if len(matrix):
+        days = _nanmedian((matrix.completed_at[:, 1:] - matrix.completed_at[:, :-1]) / _SECONDS_PER_DAY)
+    else:
+        days = np.full(len(STAGES) - 1, np.nan)
+    rows = [StageStats(STAGES[0], int(counts[0]), None, None, None)]
+    for index, stage in enumerate(STAGES[1:]):
+        rows.append(
+            StageStats(
+                stage=stage,
+                completed=int(counts[index + 1]),
+                conversion=None if np.isnan(conversion[index]) else float(conversion[index]),
+                drop_off=int(previous[index] - both[index]),
+                median_days=None if np.isnan(days[index]) else float(days[index]),
+            )
+        )
+    return rows
+
+
+def cohort_labels(matrix: StageMatrix, key: str = "mes") -> "np.ndarray":
+    """Etiqueta de cohorte por paciente: mes de la primera etapa completada o canal preferido."""
+    _require_numpy()
+    if key == "canal":
+        return matrix.channels
+    if key != "mes":
+        raise ValueError(f"Cohorte desconocida: '{key}'.")
+    labels = np.full(len(matrix), "sin fecha", dtype=object)
+    known = ~np.isnan(matrix.completed_at).all(axis=1)
+    if known.any():
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            first = np.nanmin(matrix.completed_at[known], axis=1)
+        labels[known] = np.datetime_as_string(first.astype("datetime64[s]"), unit="M").astype(object)
+    return labels
+
+
+def cohorts(matrix: StageMatrix, key: str = "mes") -> List[CohortStats]:
+    """Agrupar pacientes por cohorte y contar etapas completadas con ``bincount`` por columna."""
+    _require_numpy()
+    labels = cohort_labels(matrix, key)
+    if not len(matrix):
+        return []
+    names, inverse = np.unique(labels.astype(str), return_inverse=True)
+    columns = [
+        np.bincount(inverse, weights=matrix.completed[:, column], minlength=len(names))
+        for column in range(len(STAGES))
+    ]
+    by_stage = np.stack(columns, axis=1).astype(np.int64)
+    sizes = np.bincount(inverse, minlength=len(names))
+    finished = np.bincount(inverse, weights=matrix.completed.all(axis=1), minlength=len(names))
+    return [
+        CohortStats(
+            label=str(name),
+            patients=int(sizes[index]),
+            mean_completed=float(by_stage[index].sum() / sizes[index]),
+            finished=int(finished[index]),
+            completed_by_stage=[int(value) for value in by_stage[index]],
+        )
+        for index, name in enumerate(names)
+    ]
@@ -0,0 +1,143 @@
+"""Modo por lotes: aplicar muchas operaciones con una sola carga y escritura del almacenamiento.
+
+Cada operación es un objeto JSON por línea (JSONL) o una fila CSV con la columna
+``op`` (``registrar``, ``marcar`` o ``enviar``) y los mismos datos que acepta la CLI::
+
+    {"op": "registrar", "patient_id": "123", "name": "Ana", "contact": "+569...", "channel": "sms"}
+    {"op": "marcar", "patient_id": "123", "stage_id": 4, "pendiente": false}
+    {"op": "enviar", "patient_id": "123", "template": "confirmar_cita", "params": {"appointment_date": "1/7"}}
+
+En CSV los parámetros de plantilla se escriben como ``clave=valor`` separados por ``;``.
+"""
+from __future__ import annotations
+
+import csv
+import json
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, TextIO, Tuple
+
+from .operations import OperationError, parse_params, register_patient, send_to_patient, set_stage
+from .ratelimit import RateLimiter
+from .storage import StorageBackend
+
+_TRUE_VALUES = {"1", "true", "si", "sí", "yes", "x"}
+
+
+@dataclass
+class BatchResult:
+    """Resultado de aplicar una línea del lote."""
+
+    line: int
+    ok: bool
+    message: str
+
+
+def read_operations(stream: TextIO, fmt: str = "jsonl") -> Iterator[Tuple[int, Dict]]:
+    """Iterar ``(número de línea, operación)`` desde un flujo JSONL o CSV."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # La línea 1 es el encabezado; ``line_num`` apunta al final de la fila.
+            yield reader.line_num, {key: value for key, value in row.items() if value not in (None, "")}
+        return
+    if fmt != "jsonl":
+        raise ValueError(f"Formato de lote desconocido: '{fmt}'.")
+    for number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            operation = json.loads(line)
+        except json.JSONDecodeError as exc:
+            yield number, {"op": None, "error": f"JSON inválido: {exc.msg}"}
+            continue
+        yield number, operation if isinstance(operation, dict) else {"op": None, "error": "Se esperaba un objeto JSON"}
+
+
+def as_bool(value: object) -> bool:
+    """Interpretar ``true``/``"sí"``/``1``... como verdadero; también lo usa el servicio HTTP."""
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in _TRUE_VALUES
+
+
+def _params(value: object) -> Mapping[str, str]:
+    if value is None:
+        return {}
+    if isinstance(value, Mapping):
+        return {str(key): str(item) for key, item in value.items()}
+    if isinstance(value, str):
+        return parse_params(pair for pair in value.split(";") if pair)
+    return parse_params(value)  # type: ignore[arg-type]
+
+
+def _field(operation: Mapping, name: str) -> str:
+    try:
+        return str(operation[name])
+    except KeyError:
+        raise OperationError(f"Falta el campo '{name}'.") from None
+
+
+def apply_operation(
+    storage: StorageBackend, operation: Mapping, rate_limiter: Optional[RateLimiter] = None
+) -> str:
+    """Aplicar una operación y devolver un resumen; lanza :class:`OperationError` si falla."""
+    if operation.get("error"):
+        raise OperationError(operation["error"])
+    op = operation.get("op")
+    if op == "registrar":
+        patient = register_patient(
+            storage,
+            _field(operation, "patient_id"),
+            _field(operation, "name"),
+            _field(operation, "contact"),
+            operation.get("channel") or "chat",
+        )
+        return f"Paciente {patient.patient_id} registrado/actualizado correctamente."
+    if op == "marcar":
+        try:
+            stage_id = int(_field(operation, "stage_id"))
+        except ValueError:
+            raise OperationError(f"Etapa inválida: '{operation['stage_id']}'.") from None
+        completed = not as_bool(operation.get("pendiente", False))
+        patient, stage = set_stage(storage, _field(operation, "patient_id"), stage_id, completed)
+        estado = "completada" if completed else "pendiente"
+        return f"Etapa '{stage.name}' marcada como {estado} para {patient.name}."
+    if op == "enviar":
+        try:
+            params = _params(operation.get("params"))
+        except ValueError as exc:
+            raise OperationError(f"Error al usar la plantilla: {exc}") from exc
+        message = send_to_patient(
+            storage,
+            _field(operation, "patient_id"),
+            channel=operation.get("channel"),
+            subject=operation.get("subject"),
+            body=operation.get("body"),
+            template=operation.get("template"),
+            params=params,
+            rate_limiter=rate_limiter,
+        )
+        return f"Mensaje '{message.subject}' enviado a {message.patient_id} por {message.channel.value}."
+    raise OperationError(f"Operación desconocida: '{op}'.")
+
+
+def run_batch(
+    storage: StorageBackend,
+    operations: Iterable[Tuple[int, Dict]],
+    rate_limiter: Optional[RateLimiter] = None,
+) -> List[BatchResult]:
+    """Aplicar todas las operaciones dentro de ``storage.batch()`` y reportar cada línea.
+
+    Con ``rate_limiter`` los envíos esperan su turno, manteniendo el lote abierto
+    (y el almacenamiento bloqueado) mientras tanto.
+    """
+    results: List[BatchResult] = []
+    with storage.batch():
+        for line, operation in operations:
+            try:
+                summary = apply_operation(storage, operation, rate_limiter)
+            except (OperationError, ValueError) as exc:
+                results.append(BatchResult(line=line, ok=False, message=str(exc)))
+            else:
+                results.append(BatchResult(line=line, ok=True, message=summary))
+    return results
@@ -0,0 +1,221 @@
+"""Registro de cambios numerados para exportaciones incrementales.
+
+Cada ``save_patient``, cambio de etapa y ``save_message`` agrega un evento con un
+número de secuencia creciente (``seq``). Un sistema externo guarda el último
+``seq`` que procesó (su cursor) y en la siguiente sincronización pide solo los
+eventos posteriores (``exportar --desde-cursor``), sin recorrer el almacenamiento.
+
+Eventos (``data`` depende de ``op``):
+
+* ``patient``: el registro completo del paciente sin historial, con ``version``;
+* ``stage``: ``{"stage_id", "completed", "at"}`` por cada etapa que cambió;
+* ``message``: el mensaje guardado.
+
+Los motores de archivos anotan los eventos en ``<almacenamiento>.changes``
+(:class:`ChangeFeed`); SQLite los guarda en su tabla ``changes`` dentro de la
+misma transacción que el cambio.
+
+Con los motores de archivos los datos y el registro son dos escrituras
+distintas. El evento se anota primero, bajo el mismo candado, así que el
+registro es "al menos una vez": un corte (o ``group_commit``) puede dejar un
+evento cuyo cambio no llegó a guardarse, pero nunca un cambio guardado sin su
+evento. Quien consume la exportación debe tomar ``version`` como referencia y
+volver a leer el paciente si el evento no coincide con lo guardado.
+"""
+from __future__ import annotations
+
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from .durability import FsyncPolicy, fsync_file
+from .locking import FileLock
+
+CHANGE_OPS = ("patient", "stage", "message")
+CSV_COLUMNS = (
+    "seq", "at", "op", "patient_id",
+    "version", "name", "contact", "preferred_channel", "notes", "surgery_date", "completed_stages",
+    "stage_id", "completed", "stage_at",
+    "subject", "body", "channel", "sent_at",
+)
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat(timespec="seconds")
+
+
+def patient_changes(previous: Optional[Dict], payload: Dict) -> List[Dict]:
+    """Eventos de guardar ``payload`` sobre ``previous`` (registros serializados, o ``None`` si es nuevo).
+
+    De ``previous`` solo se usa ``stage_status``.
+    """
+    patient_id = payload["patient_id"]
+    # Copia: los eventos retenidos en un lote no deben ver cambios posteriores del registro.
+    record = {key: value for key, value in payload.items() if key != "messages"}
+    for key in ("stage_status", "stage_times"):
+        if key in record:
+            record[key] = dict(record[key])
+    events = [{"op": "patient", "patient_id": patient_id, "data": record}]
+    old_status = previous.get("stage_status", {}) if previous else {}
+    times = payload.get("stage_times", {})
+    for stage_id, completed in payload.get("stage_status", {}).items():
+        if old_status.get(stage_id, False) != completed:
+            events.append(
+                {
+                    "op": "stage",
+                    "patient_id": patient_id,
+                    "data": {"stage_id": int(stage_id), "completed": completed, "at": times.get(stage_id)},
+                }
+            )
+    return events
+
+
+def message_change(message: Dict) -> Dict:
+    """Evento de un mensaje serializado (``asdict`` de :class:`MessageRecord`)."""
+    data = dict(message)
+    data["channel"] = str(getattr(data["channel"], "value", data["channel"]))
+    return {"op": "message", "patient_id": data["patient_id"], "data": data}
+
+
+def _tail(fp: BinaryIO, size: int) -> Tuple[int, int]:
+    """``(seq de la última línea completa, dónde termina)``, leyendo desde el final del archivo."""
+    data = b""
+    position = size
+    while position > 0:
+        start = max(0, position - (1 << 16))
+        fp.seek(start)
+        data = fp.read(position - start) + data
+        position = start
+        end = data.rfind(b"\n")
+        if end < 0:
+            continue
+        begin = data.rfind(b"\n", 0, end)
+        if begin < 0 and position > 0:
+            continue
+        return json.loads(data[begin + 1:end])["seq"], position + end + 1
+    return 0, 0
+
+
+def _line_from(fp: BinaryIO, offset: int) -> Tuple[int, Optional[int]]:
+    """Inicio y ``seq`` de la primera línea completa que empieza en ``offset`` o después."""
+    fp.seek(max(0, offset - 1))
+    if offset > 0:
+        fp.readline()  # resto de la línea en curso (o solo su salto de línea)
+    start = fp.tell()
+    line = fp.readline()
+    if not line.endswith(b"\n"):
+        return start, None
+    return start, json.loads(line)["seq"]
+
+
+class ChangeFeed:
+    """Archivo JSONL de solo anexado con los eventos de cambio, uno por línea y en orden de ``seq``.
+
+    ``append`` numera los eventos bajo un candado exclusivo, tomando el último
+    ``seq`` del final del archivo (no lo recorre entero). Como las líneas quedan
+    ordenadas, :meth:`since` ubica el cursor con una búsqueda binaria sobre los
+    desplazamientos del archivo: una exportación cuesta lo que midan los cambios
+    nuevos. Una línea truncada por una escritura interrumpida se descarta al
+    anexar la siguiente.
+    """
+
+    def __init__(self, path: str | Path, fsync: str | FsyncPolicy | None = None) -> None:
+        self.path = Path(path)
+        self.fsync = FsyncPolicy.parse(fsync)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file_lock = FileLock(self.path.with_name(self.path.name + ".lock"))
+        self._seq = 0
+        self._end: Optional[Tuple[int, int]] = None
+
+    @classmethod
+    def beside(cls, storage_path: str | Path, fsync: str | FsyncPolicy | None = None) -> "ChangeFeed":
+        """Registro asociado a un almacenamiento: ``<ruta del almacenamiento>.changes``."""
+        storage_path = Path(storage_path)
+        return cls(storage_path.with_name(storage_path.name + ".changes"), fsync=fsync)
+
+    def append(self, events: Iterable[Dict]) -> int:
+        """Numerar y anexar ``events`` con una sola escritura; devuelve el último ``seq``."""
+        events = list(events)
+        if not events:
+            return self._seq
+        at = _now()
+        with self._file_lock.exclusive(), self.path.open("a+b") as fp:
+            stat = os.fstat(fp.fileno())
+            if (stat.st_ino, stat.st_size) != self._end:
+                # Otro proceso anexó desde la última vez (o es la primera escritura).
+                self._seq, valid = _tail(fp, stat.st_size)
+                if valid < stat.st_size:
+                    fp.truncate(valid)
+            lines = []
+            for event in events:
+                self._seq += 1
+                lines.append(json.dumps({"seq": self._seq, "at": at, **event}, ensure_ascii=False) + "\n")
+            fp.write("".join(lines).encode("utf-8"))
+            fp.flush()
+            if self.fsync.after_write():
+                os.fsync(fp.fileno())
+            self._end = (stat.st_ino, fp.tell())
+        return self._seq
+
+    def since(self, cursor: int = 0) -> Iterator[Dict]:
+        """Eventos con ``seq`` mayor que ``cursor``, hasta el final del archivo al momento de llamar."""
+        if not self.path.exists():
+            return
+        with self._file_lock.shared():
+            size = self.path.stat().st_size
+        with self.path.open("rb") as fp:
+            low, high = 0, size
+            while low < high:
+                middle = (low + high) // 2
+                _, seq = _line_from(fp, middle)
+                if seq is None or seq > cursor:
+                    high = middle
+                else:
+                    low = middle + 1
+            offset, _ = _line_from(fp, low)
+            fp.seek(offset)
+            while fp.tell() < size:
+                line = fp.readline()
+                if not line.endswith(b"\n"):
+                    break
+                yield json.loads(line)
+
+    def close(self) -> None:
+        if self.fsync.on_close() and self.path.exists():
+            fsync_file(self.path)
+        self._file_lock.close()
+
+
+def change_row(event: Dict) -> Dict[str, object]:
+    """Fila CSV de un evento: las columnas que no corresponden a su ``op`` quedan vacías."""
+    data = event["data"]
+    row: Dict[str, object] = {key: event[key] for key in ("seq", "at", "op", "patient_id")}
+    if event["op"] == "patient":
+        row.update({key: data.get(key, "") for key in CSV_COLUMNS[4:10]})
+        status = data.get("stage_status", {})
+        row["completed_stages"] = ";".join(stage_id for stage_id, done in status.items() if done)
+    elif event["op"] == "stage":
+        row.update(stage_id=data["stage_id"], completed=data["completed"], stage_at=data.get("at") or "")
+    else:
+        row.update({key: data[key] for key in ("subject", "body", "channel", "sent_at")})
+    return row
+
+
+def write_changes(stream: TextIO, events: Iterable[Dict], fmt: str = "jsonl") -> Tuple[int, Optional[int]]:
+    """Escribir los eventos como JSONL o CSV; devuelve ``(cantidad, último seq)``."""
+    count, last = 0, None
+    writer = None
+    if fmt == "csv":
+        import csv
+
+        writer = csv.DictWriter(stream, fieldnames=CSV_COLUMNS)
+        writer.writeheader()
+    for event in events:
+        if writer is not None:
+            writer.writerow(change_row(event))
+        else:
+            stream.write(json.dumps(event, ensure_ascii=False) + "\n")
+        count, last = count + 1, event["seq"]
+    return count, last
@@ -1,29 +1,116 @@
-"""Interfaz de línea de comandos para el seguimiento de pacientes."""
+"""Interfaz de línea de comandos para el seguimiento de pacientes.
+
+Cada subcomando es una entrada de :data:`COMMANDS` con su ayuda, la función que
+agrega sus argumentos, su manejador y si necesita el almacenamiento. El parser
+solo configura los argumentos del subcomando pedido y cada manejador importa lo
+que usa, de modo que ``flujo`` no abre el almacenamiento (ni crea el directorio
+de datos) y ``marcar`` no carga NumPy, asyncio ni el servidor HTTP. Los
+programas de cron lanzan la CLI miles de veces: ``scripts/bench_startup.py``
+vigila ese costo de arranque.
+"""
 from __future__ import annotations
 
 import argparse
-import json
-from typing import Dict, Iterable
+import os
+import sys
+import time
+from typing import TYPE_CHECKING, Callable, Dict, NamedTuple, Optional, Sequence
 
-from .messaging import MessagingChannel, MessagingService
-from .storage import PatientStorage, ensure_patient
-from .templates import TEMPLATES, render_template
-from .workflow import STAGES, get_stage
+if TYPE_CHECKING:  # pragma: no cover - solo para anotaciones
+    from .ratelimit import RateLimiter
+    from .scheduler import TickReport
+    from .storage import Patient, StorageBackend
 
+GLOBAL_FLAGS = frozenset({"--perfil"})
+GLOBAL_OPTIONS = frozenset({"--storage", "--fsync", "--perfil-cprofile", "--perfil-prometheus"})
+# Prefijo de las variables de entorno de :mod:`patient_tracking.profiling`.
+PROFILE_ENV_PREFIX = "CLYNICO_PERFIL"
 
-def build_parser() -> argparse.ArgumentParser:
+
+def build_parser(command: Optional[str] = None) -> argparse.ArgumentParser:
+    """Parser de la CLI; con ``command`` solo se configuran los argumentos de ese subcomando."""
     parser = argparse.ArgumentParser(
         description="Herramienta simple para hacer seguimiento de pacientes bariátricos",
     )
     parser.add_argument(
         "--storage",
         default="data/patients.json",
-        help="Ruta al archivo JSON donde se guardará la información.",
+        help=(
+            "Ruta al archivo JSON donde se guardará la información. Acepta también "
+            "'journal:///ruta' para usar la bitácora de solo anexado, 'sqlite:///ruta' "
+            "para una base SQLite, 'sharded:///directorio' para repartir los pacientes en fragmentos o "
+            "'binary:///ruta' para una instantánea binaria con índice (ver el comando convertir). "
+            "Tras '://' se descarta una sola barra: 'sqlite:///datos/p.db' es relativa al directorio "
+            "actual y 'sqlite:////var/datos/p.db' (cuatro barras) es absoluta."
+        ),
+    )
+
+    parser.add_argument(
+        "--fsync",
+        default="close",
+        help=(
+            "Cuándo sincronizar las escrituras a disco: 'always', 'close' (al terminar), "
+            "'never' o un número N para hacerlo cada N escrituras."
+        ),
+    )
+    parser.add_argument(
+        "--perfil",
+        action="store_true",
+        help=(
+            "Mostrar en stderr el tiempo y los bytes de cada fase del comando (lectura, escritura, "
+            "conversión de pacientes, envío). También se activa con CLYNICO_PERFIL=1."
+        ),
+    )
+    parser.add_argument(
+        "--perfil-cprofile",
+        metavar="ARCHIVO",
+        help="Guardar la salida de cProfile del comando en ARCHIVO (o CLYNICO_PERFIL_CPROFILE).",
+    )
+    parser.add_argument(
+        "--perfil-prometheus",
+        metavar="ARCHIVO",
+        help=(
+            "Sumar los contadores por fase a ARCHIVO en formato de texto de Prometheus, para el "
+            "colector textfile de node exporter (o CLYNICO_PERFIL_PROMETHEUS)."
+        ),
     )
 
     subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, entry in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=entry.help)
+        if entry.configure is not None and command in (None, name):
+            entry.configure(subparser)
+    return parser
+
+
+def requested_command(argv: Sequence[str]) -> Optional[str]:
+    """Subcomando de ``argv`` si se reconoce sin ambigüedad; con ``None`` se configuran todos."""
+    tokens = iter(argv)
+    for token in tokens:
+        if token in GLOBAL_FLAGS or (token.startswith("--") and token.split("=", 1)[0] in GLOBAL_OPTIONS):
+            if token in GLOBAL_OPTIONS:
+                next(tokens, None)
+            continue
+        # Ayuda, abreviaturas u opciones desconocidas: se deja todo a argparse.
+        return token if token in COMMANDS else None
+    return None
+
+
+def _channel_choices() -> list[str]:
+    from .messaging import MessagingChannel
+
+    return [channel.value for channel in MessagingChannel]
+
+
+def _template_choices() -> list[str]:
+    from .templates import TEMPLATES
+
+    return sorted(TEMPLATES.keys())
+
+
+def configure_register(register: argparse.ArgumentParser) -> None:
+    from .messaging import MessagingChannel
 
-    register = subparsers.add_parser("registrar", help="Registrar o actualizar un paciente")
     register.add_argument("patient_id", help="Identificador único, por ejemplo el número de expediente")
     register.add_argument("name", help="Nombre completo del paciente")
     register.add_argument("contact", help="Datos de contacto (teléfono, email, etc.)")
@@ -34,12 +121,12 @@ def build_parser() -> argparse.ArgumentParser:
         help="Canal preferido para los mensajes",
     )
 
-    list_parser = subparsers.add_parser("listar", help="Listar pacientes registrados")
 
-    show_parser = subparsers.add_parser("ver", help="Ver detalle de un paciente")
+def configure_show(show_parser: argparse.ArgumentParser) -> None:
     show_parser.add_argument("patient_id")
 
-    stage_parser = subparsers.add_parser("marcar", help="Marcar una etapa como completa o pendiente")
+
+def configure_stage(stage_parser: argparse.ArgumentParser) -> None:
     stage_parser.add_argument("patient_id")
     stage_parser.add_argument("stage_id", type=int)
     stage_parser.add_argument(
@@ -48,20 +135,24 @@ def build_parser() -> argparse.ArgumentParser:
         help="Marcar la etapa como pendiente en lugar de completada",
     )
 
-    workflow_parser = subparsers.add_parser("flujo", help="Mostrar todas las etapas del proceso")
 
-    send_parser = subparsers.add_parser("enviar", help="Enviar un mensaje al paciente")
+def configure_surgery(surgery_parser: argparse.ArgumentParser) -> None:
+    surgery_parser.add_argument("patient_id")
+    surgery_parser.add_argument("fecha", help="Fecha de cirugía AAAA-MM-DD ('' para borrarla)")
+
+
+def configure_send(send_parser: argparse.ArgumentParser) -> None:
     send_parser.add_argument("patient_id")
     send_parser.add_argument(
         "--channel",
-        choices=[channel.value for channel in MessagingChannel],
+        choices=_channel_choices(),
         help="Canal a utilizar (por defecto el preferido del paciente)",
     )
     send_parser.add_argument("--subject", help="Asunto del mensaje")
     send_parser.add_argument("--body", help="Cuerpo del mensaje")
     send_parser.add_argument(
         "--template",
-        choices=sorted(TEMPLATES.keys()),
+        choices=_template_choices(),
         help="Usar una plantilla predefinida",
     )
     send_parser.add_argument(
@@ -70,100 +161,435 @@ def build_parser() -> argparse.ArgumentParser:
         default=[],
         help="Parámetros para la plantilla en formato clave=valor",
     )
+    send_parser.add_argument(
+        "--encolar",
+        action="store_true",
+        help="Dejar el mensaje en la bandeja de salida para entregarlo con 'despachar'",
+    )
+
 
-    history_parser = subparsers.add_parser("historial", help="Ver historial de mensajes")
+def configure_campaign(campaign_parser: argparse.ArgumentParser) -> None:
+    from .stage_index import STAGE_STATES
+
+    campaign_parser.add_argument("--template", choices=_template_choices(), required=True)
+    campaign_parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        help="Parámetros para la plantilla en formato clave=valor",
+    )
+    campaign_parser.add_argument("--etapa", type=int, help="Solo pacientes con esta etapa (ver --estado)")
+    campaign_parser.add_argument("--estado", choices=STAGE_STATES, default="actual")
+    campaign_parser.add_argument(
+        "--channel",
+        choices=_channel_choices(),
+        help="Canal a utilizar (por defecto el preferido de cada paciente)",
+    )
+
+
+def configure_dispatch(dispatch_parser: argparse.ArgumentParser) -> None:
+    dispatch_parser.add_argument("--concurrencia", type=int, default=8, help="Envíos simultáneos por canal")
+    dispatch_parser.add_argument("--reintentos", type=int, default=5, help="Intentos máximos por mensaje")
+    dispatch_parser.add_argument("--lote", type=int, default=2000, help="Entregas por escritura en el almacenamiento")
+    dispatch_parser.add_argument("--latencia", type=float, default=0.05, help="Latencia simulada en segundos")
+    dispatch_parser.add_argument("--fallos", type=float, default=0.0, help="Fracción de envíos que fallan (0-1)")
+    add_rate_limit_arguments(dispatch_parser)
+
+
+def configure_scheduler(scheduler_parser: argparse.ArgumentParser) -> None:
+    scheduler_parser.add_argument(
+        "--una-vez", action="store_true", help="Ejecutar lo vencido y salir (útil desde cron)"
+    )
+    scheduler_parser.add_argument(
+        "--listar", type=int, metavar="N", help="Mostrar las próximas N acciones programadas y salir"
+    )
+    scheduler_parser.add_argument("--intervalo", type=float, default=30.0, help="Segundos máximos entre ciclos")
+    scheduler_parser.add_argument(
+        "--reescaneo", type=float, default=300.0, help="Segundos entre replanificaciones completas"
+    )
+    scheduler_parser.add_argument("--hora", type=int, default=9, help="Hora (UTC) de los mensajes diarios")
+    add_rate_limit_arguments(scheduler_parser)
+
+
+def configure_worklist(worklist_parser: argparse.ArgumentParser) -> None:
+    from .stage_index import STAGE_STATES
+
+    worklist_parser.add_argument("--etapa", type=int, required=True, help="ID de la etapa")
+    worklist_parser.add_argument(
+        "--estado",
+        choices=STAGE_STATES,
+        default="actual",
+        help="actual: la etapa es la primera pendiente (por defecto); pendiente o completada",
+    )
+
+
+def configure_analytics(analytics_parser: argparse.ArgumentParser) -> None:
+    from .analytics import COHORT_KEYS
+
+    analytics_parser.add_argument(
+        "--cohorte",
+        choices=COHORT_KEYS,
+        default="mes",
+        help="Agrupar por mes de la primera etapa completada (por defecto) o por canal preferido",
+    )
+
+
+def configure_history(history_parser: argparse.ArgumentParser) -> None:
     history_parser.add_argument("patient_id")
+    history_parser.add_argument(
+        "--limit", type=int, default=20, help="Mostrar solo los últimos N mensajes (por defecto 20; 0 = todos)"
+    )
+    history_parser.add_argument(
+        "--desde", metavar="FECHA", help="Solo mensajes enviados desde esta fecha (AAAA-MM-DD[THH:MM:SS], UTC)"
+    )
+
+
+def configure_serve(server_parser: argparse.ArgumentParser) -> None:
+    server_parser.add_argument("--host", default="127.0.0.1", help="Dirección de escucha (por defecto 127.0.0.1)")
+    server_parser.add_argument("--puerto", type=int, default=8080, help="Puerto de escucha (por defecto 8080)")
+    server_parser.add_argument("--verbose", action="store_true", help="Registrar cada solicitud en stderr")
+
+
+def configure_search(search_parser: argparse.ArgumentParser) -> None:
+    search_parser.add_argument(
+        "consulta", nargs="+", help="Términos a buscar (sin importar tildes); basta el comienzo de cada palabra"
+    )
+    search_parser.add_argument("--limit", type=int, default=20, help="Máximo de resultados (por defecto 20)")
 
-    return parser
 
+def configure_migrate(migrate_parser: argparse.ArgumentParser) -> None:
+    migrate_parser.add_argument("origen", help="Ruta o especificación del almacenamiento de origen")
 
-def parse_params(pairs: Iterable[str]) -> Dict[str, str]:
-    params: Dict[str, str] = {}
-    for pair in pairs:
-        if "=" not in pair:
-            raise ValueError(f"El parámetro '{pair}' no tiene el formato clave=valor")
-        key, value = pair.split("=", 1)
-        params[key] = value
-    return params
 
+def configure_reshard(reshard_parser: argparse.ArgumentParser) -> None:
+    reshard_parser.add_argument("fragmentos", type=int, help="Nueva cantidad de fragmentos")
 
-def handle_register(args: argparse.Namespace, storage: PatientStorage) -> None:
-    patient = ensure_patient(storage, args.patient_id, args.name, args.contact, args.channel)
+
+def configure_convert(convert_parser: argparse.ArgumentParser) -> None:
+    convert_parser.add_argument("origen", help="Archivo del almacenamiento JSON o binario a convertir")
+    convert_parser.add_argument("destino", help="Archivo a escribir")
+    convert_parser.add_argument(
+        "--formato",
+        choices=["json", "binary"],
+        help="Formato del destino (por defecto, el contrario al del origen)",
+    )
+
+
+def configure_import(import_parser: argparse.ArgumentParser) -> None:
+    import_parser.add_argument("archivo", help="Archivo CSV o JSONL con un paciente por fila ('-' para leer de stdin)")
+    import_parser.add_argument(
+        "--formato",
+        choices=["jsonl", "csv"],
+        help="Formato de entrada (por defecto se deduce de la extensión, o jsonl)",
+    )
+    import_parser.add_argument(
+        "--procesos", type=int, help="Procesos que validan las filas en paralelo (por defecto, uno por CPU)"
+    )
+    import_parser.add_argument(
+        "--rechazados", metavar="ARCHIVO", help="Guardar las filas rechazadas y su motivo en este archivo JSONL"
+    )
+
+
+def configure_export(export_parser: argparse.ArgumentParser) -> None:
+    export_parser.add_argument(
+        "--desde-cursor",
+        type=int,
+        metavar="SEQ",
+        help="Exportar solo los cambios posteriores a este número de secuencia (por defecto, el de --cursor o 0)",
+    )
+    export_parser.add_argument(
+        "--cursor",
+        metavar="ARCHIVO",
+        help="Archivo con el cursor de la sincronización: se lee al empezar y se actualiza al terminar",
+    )
+    export_parser.add_argument("--formato", choices=["jsonl", "csv"], default="jsonl", help="Formato de salida")
+    export_parser.add_argument("--salida", default="-", help="Archivo de salida ('-' para stdout)")
+
+
+def configure_batch(batch_parser: argparse.ArgumentParser) -> None:
+    batch_parser.add_argument(
+        "archivo",
+        nargs="?",
+        default="-",
+        help="Archivo JSONL o CSV con una operación por línea ('-' para leer de stdin)",
+    )
+    batch_parser.add_argument(
+        "--formato",
+        choices=["jsonl", "csv"],
+        help="Formato de entrada (por defecto se deduce de la extensión, o jsonl)",
+    )
+    add_rate_limit_arguments(batch_parser)
+
+
+def add_rate_limit_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--limite",
+        action="append",
+        default=[],
+        metavar="CANAL=TASA[/RAFAGA]",
+        help="Máximo de mensajes por segundo para un canal, p. ej. sms=5/10 (repetible)",
+    )
+    parser.add_argument(
+        "--intervalo-paciente",
+        type=float,
+        default=0.0,
+        metavar="SEG",
+        help="Separación mínima en segundos entre mensajes al mismo paciente",
+    )
+
+
+def build_rate_limiter(args: argparse.Namespace) -> Optional[RateLimiter]:
+    """Limitador configurado por ``--limite``/``--intervalo-paciente``; lanza ``ValueError`` si no es válido."""
+    if not args.limite and args.intervalo_paciente <= 0:
+        return None
+    from .ratelimit import RateLimiter, parse_limits
+
+    return RateLimiter(parse_limits(args.limite), patient_gap=args.intervalo_paciente)
+
+
+def print_rate_limit_stats(limiter: Optional[RateLimiter]) -> None:
+    if limiter is None:
+        return
+    for channel, stats in sorted(limiter.stats.items()):
+        print(
+            f"Canal {channel}: {stats.queued} solicitados, {stats.throttled} demorados "
+            f"({stats.waited:.1f}s de espera acumulada), {stats.sent} enviados."
+        )
+
+
+def handle_register(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .operations import OperationError, register_patient
+
+    try:
+        patient = register_patient(storage, args.patient_id, args.name, args.contact, args.channel)
+    except OperationError as exc:
+        print(str(exc))
+        return
     print(f"Paciente {patient.patient_id} registrado/actualizado correctamente.")
 
 
-def handle_list(storage: PatientStorage) -> None:
-    patients = storage.list_patients()
-    if not patients:
+def print_patient_line(patient: Patient) -> None:
+    completed = len(patient.completed_stages())
+    pending = len(patient.pending_stages())
+    print(
+        f"- {patient.patient_id}: {patient.name} | Contacto: {patient.contact} | "
+        f"Canal: {patient.preferred_channel.value} | Etapas completadas: {completed} | Pendientes: {pending}"
+    )
+
+
+def handle_list(args: argparse.Namespace, storage: StorageBackend) -> None:
+    empty = True
+    for patient in storage.iter_patients(include_messages=False):
+        empty = False
+        print_patient_line(patient)
+    if empty:
         print("No hay pacientes registrados.")
+
+
+def handle_campaign(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .dispatch import Outbox
+    from .operations import OperationError, parse_params, queue_campaign
+
+    try:
+        params = parse_params(args.param)
+    except ValueError as exc:
+        print(f"Error al usar la plantilla: {exc}")
         return
-    for patient in patients:
-        completed = len(patient.completed_stages())
-        pending = len(patient.pending_stages())
-        print(
-            f"- {patient.patient_id}: {patient.name} | Contacto: {patient.contact} | "
-            f"Canal: {patient.preferred_channel.value} | Etapas completadas: {completed} | Pendientes: {pending}"
+    outbox = Outbox.beside(storage.path, fsync=args.fsync)
+    try:
+        count = queue_campaign(storage, outbox, args.template, params, args.etapa, args.estado, args.channel)
+    except OperationError as exc:
+        print(str(exc))
+        return
+    finally:
+        outbox.close()
+    print(f"{count} mensajes encolados; use 'despachar' para entregarlos.")
+
+
+def handle_dispatch(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .dispatch import Outbox, dispatch, fake_senders
+
+    try:
+        limiter = build_rate_limiter(args)
+    except ValueError as exc:
+        print(str(exc))
+        return
+    outbox = Outbox.beside(storage.path, fsync=args.fsync)
+    try:
+        report = dispatch(
+            storage,
+            outbox,
+            fake_senders(latency=args.latencia, failure_rate=args.fallos),
+            concurrency=args.concurrencia,
+            max_attempts=args.reintentos,
+            batch_size=args.lote,
+            rate_limiter=limiter,
         )
+    finally:
+        outbox.close()
+    print(
+        f"Despacho terminado en {report.elapsed:.1f}s: {report.delivered} entregados, "
+        f"{report.failed} fallidos, {report.retries} reintentos."
+    )
+    for entry_id, error in report.errors[:10]:
+        print(f"- {entry_id}: {error}")
+    for error in report.flush_errors:
+        print(f"Escritura reintentada tras un error: {error}")
+    print_rate_limit_stats(limiter)
 
 
-def handle_show(args: argparse.Namespace, storage: PatientStorage) -> None:
-    patient = storage.get_patient(args.patient_id)
-    if not patient:
-        print("Paciente no encontrado.")
+def handle_worklist(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .workflow import get_stage
+
+    try:
+        stage = get_stage(args.etapa)
+        patients = storage.patients_at_stage(stage.id, args.estado)
+    except ValueError as exc:
+        print(str(exc))
+        return
+    if not patients:
+        print(f"No hay pacientes con la etapa '{stage.name}' como {args.estado}.")
         return
-    print(json.dumps(patient.to_dict(), indent=2, ensure_ascii=False))
+    print(f"Etapa {stage.id:02d}. {stage.name} ({args.estado}): {len(patients)} pacientes")
+    for patient in patients:
+        print_patient_line(patient)
+
+
+def handle_funnel(args: argparse.Namespace, storage: StorageBackend) -> None:
+    rows = storage.stage_funnel()
+    print(f"{'Etapa':<48} {'Completada':>10} {'Actual':>7} {'Pendiente':>9}")
+    for row in rows:
+        label = f"{row.stage.id:02d}. {row.stage.name}"
+        print(f"{label:<48} {row.completed:>10} {row.current:>7} {row.pending:>9}")
+
 
+def handle_show(args: argparse.Namespace, storage: StorageBackend) -> None:
+    import json
 
-def handle_stage(args: argparse.Namespace, storage: PatientStorage) -> None:
     patient = storage.get_patient(args.patient_id)
     if not patient:
         print("Paciente no encontrado.")
         return
+    print(json.dumps(patient.to_dict(include_messages=False), indent=2, ensure_ascii=False))
+
+
+def handle_stage(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .operations import OperationError, set_stage
+
+    completed = not args.pendiente
     try:
-        stage = get_stage(args.stage_id)
-    except ValueError as exc:
+        patient, stage = set_stage(storage, args.patient_id, args.stage_id, completed)
+    except OperationError as exc:
         print(str(exc))
         return
-    completed = not args.pendiente
-    patient.mark_stage(stage.id, completed)
-    storage.save_patient(patient)
     estado = "completada" if completed else "pendiente"
     print(f"Etapa '{stage.name}' marcada como {estado} para {patient.name}.")
 
 
-def handle_workflow() -> None:
+def handle_surgery(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .operations import OperationError, schedule_surgery
+
+    try:
+        patient = schedule_surgery(storage, args.patient_id, args.fecha)
+    except OperationError as exc:
+        print(str(exc))
+        return
+    if patient.surgery_date:
+        print(f"Cirugía de {patient.name} agendada para el {patient.surgery_date}.")
+    else:
+        print(f"Se borró la fecha de cirugía de {patient.name}.")
+
+
+def print_tick(report: TickReport) -> None:
+    from datetime import datetime
+
+    stamp = datetime.utcnow().isoformat(timespec="seconds")
+    print(f"[{stamp}] {report.sent} mensajes enviados, {report.skipped} vencidos omitidos.", flush=True)
+    for error in report.errors:
+        print(f"- {error}", flush=True)
+
+
+def handle_scheduler(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .scheduler import Scheduler, ScheduleState
+
+    try:
+        limiter = build_rate_limiter(args)
+    except ValueError as exc:
+        print(str(exc))
+        return
+    state = ScheduleState.beside(storage.path, fsync=args.fsync)
+    scheduler = Scheduler(storage, state, hour=args.hora, rate_limiter=limiter)
+    try:
+        planned = scheduler.rebuild()
+        if args.listar is not None:
+            print(f"{planned} acciones programadas.")
+            for action in scheduler.upcoming(args.listar):
+                print(f"- {action.due.isoformat(timespec='minutes')} {action.patient_id}: {action.key}")
+            return
+        if args.una_vez:
+            print_tick(scheduler.run_due())
+            return
+        print(f"Programador iniciado con {planned} acciones; Ctrl+C para detener.", flush=True)
+        try:
+            scheduler.run_forever(args.intervalo, args.reescaneo, on_tick=print_tick)
+        except KeyboardInterrupt:
+            print("Programador detenido.")
+    finally:
+        state.close()
+
+
+def handle_workflow(args: argparse.Namespace) -> None:
+    from .workflow import STAGES
+
     for stage in STAGES:
         print(f"{stage.id:02d}. {stage.name} - {stage.description}")
 
 
-def handle_send(args: argparse.Namespace, storage: PatientStorage) -> None:
-    patient = storage.get_patient(args.patient_id)
-    if not patient:
-        print("Paciente no encontrado.")
-        return
+def handle_send(args: argparse.Namespace, storage: StorageBackend) -> None:
+    import json
 
-    channel_value = args.channel or patient.preferred_channel.value
-    channel = MessagingChannel(channel_value)
+    from .operations import OperationError, parse_params, queue_message, send_to_patient
 
-    if args.template:
+    try:
+        params = parse_params(args.param) if args.template else {}
+    except ValueError as exc:
+        print(f"Error al usar la plantilla: {exc}")
+        return
+    if args.encolar:
+        from .dispatch import Outbox
+
+        outbox = Outbox.beside(storage.path, fsync=args.fsync)
         try:
-            params = parse_params(args.param)
-            params.setdefault("name", patient.name)
-            template = render_template(args.template, **params)
-        except Exception as exc:  # pylint: disable=broad-except
-            print(f"Error al usar la plantilla: {exc}")
-            return
-        subject = template.subject
-        body = template.body
-    else:
-        if not args.subject or not args.body:
-            print("Debe proporcionar --subject y --body si no usa una plantilla.")
+            entry = queue_message(
+                storage,
+                outbox,
+                args.patient_id,
+                channel=args.channel,
+                subject=args.subject,
+                body=args.body,
+                template=args.template,
+                params=params,
+            )
+        except OperationError as exc:
+            print(str(exc))
             return
-        subject = args.subject
-        body = args.body
-
-    messaging = MessagingService(storage)
-    message = messaging.send_message(patient.patient_id, subject, body, channel)
+        finally:
+            outbox.close()
+        print(f"Mensaje encolado ({entry.entry_id}); use 'despachar' para entregarlo.")
+        return
+    try:
+        message = send_to_patient(
+            storage,
+            args.patient_id,
+            channel=args.channel,
+            subject=args.subject,
+            body=args.body,
+            template=args.template,
+            params=params,
+        )
+    except OperationError as exc:
+        print(str(exc))
+        return
     print(
         "Mensaje enviado:",
         json.dumps(
@@ -180,41 +606,337 @@ def handle_send(args: argparse.Namespace, storage: PatientStorage) -> None:
     )
 
 
-def handle_history(args: argparse.Namespace, storage: PatientStorage) -> None:
-    patient = storage.get_patient(args.patient_id)
-    if not patient:
-        print("Paciente no encontrado.")
+def handle_analytics(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .analytics import AnalyticsUnavailable, cohorts, funnel, load_matrix
+
+    start = time.perf_counter()
+    try:
+        matrix = load_matrix(storage.iter_patients(include_messages=False))
+    except AnalyticsUnavailable as exc:
+        print(str(exc))
         return
-    if not patient.messages:
+    loaded = time.perf_counter()
+    stages = funnel(matrix)
+    groups = cohorts(matrix, args.cohorte)
+    computed = time.perf_counter()
+
+    print(f"Pacientes: {len(matrix)} (carga {loaded - start:.2f}s, cálculo {computed - loaded:.3f}s)")
+    print()
+    print(f"{'Etapa':<48} {'Completada':>10} {'Conversión':>10} {'Abandono':>8} {'Días (mediana)':>14}")
+    for row in stages:
+        label = f"{row.stage.id:02d}. {row.stage.name}"
+        conversion = "-" if row.conversion is None else f"{row.conversion:.1%}"
+        drop_off = "-" if row.drop_off is None else str(row.drop_off)
+        days = "-" if row.median_days is None else f"{row.median_days:.1f}"
+        print(f"{label:<48} {row.completed:>10} {conversion:>10} {drop_off:>8} {days:>14}")
+    print()
+    print(f"{'Cohorte (' + args.cohorte + ')':<20} {'Pacientes':>9} {'Etapas prom.':>12} {'Flujo completo':>14}")
+    for group in groups:
+        print(f"{group.label:<20} {group.patients:>9} {group.mean_completed:>12.1f} {group.finished:>14}")
+
+
+def handle_history(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .operations import OperationError, message_history
+
+    try:
+        messages = message_history(storage, args.patient_id, limit=args.limit, since=args.desde)
+    except OperationError as exc:
+        print(exc)
+        return
+    if not messages:
         print("No hay mensajes registrados para este paciente.")
         return
-    for message in patient.messages:
+    for message in messages:
         print(
             f"[{message.sent_at}] {message.channel.value.upper()} | {message.subject}\n{message.body}\n"
         )
+    if args.limit and len(messages) == args.limit:
+        print(f"Se muestran los últimos {args.limit} mensajes; use --limit o --desde para ver otros.")
+
+
+def handle_serve(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .server import ApiServer
+
+    server = ApiServer((args.host, args.puerto), storage, verbose=args.verbose)
+    host, port = server.server_address[:2]
+    print(f"Sirviendo en http://{host}:{port} (Ctrl+C para detener).", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Servicio detenido.")
+    finally:
+        server.server_close()
+
+
+def handle_search(args: argparse.Namespace, storage: StorageBackend) -> None:
+    if args.limit < 1:
+        print("El límite de resultados debe ser al menos 1.")
+        return
+    start = time.perf_counter()
+    try:
+        hits = storage.search(" ".join(args.consulta), limit=args.limit)
+    except ValueError as exc:
+        print(exc)
+        return
+    elapsed = time.perf_counter() - start
+    if not hits:
+        print("Sin resultados.")
+        return
+    for hit in hits:
+        if hit.kind == "paciente":
+            print(f"- {hit.patient_id}: {hit.name} | paciente")
+        else:
+            print(f"- {hit.patient_id}: {hit.name} | mensaje [{hit.sent_at}] {hit.subject}")
+    print(f"{len(hits)} resultados en {elapsed * 1000:.1f} ms.")
+
+
+def handle_migrate(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from pathlib import Path
+
+    from .storage import open_storage, parse_storage_spec
+
+    _, source_path = parse_storage_spec(args.origen)
+    if not Path(source_path).exists():
+        print(f"No existe el almacenamiento de origen '{args.origen}'.")
+        return
+    with open_storage(args.origen) as source:
+        count = storage.import_patients(source.iter_patients())
+    print(f"{count} pacientes migrados desde {args.origen}.")
+
+
+def handle_reshard(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .sharded import ShardedStorage
+
+    if not isinstance(storage, ShardedStorage):
+        print("Solo se puede reparticionar un almacenamiento 'sharded:///directorio'.")
+        return
+    start = time.perf_counter()
+    try:
+        count, previous = storage.reshard(args.fragmentos)
+    except ValueError as exc:
+        print(exc)
+        return
+    print(
+        f"{count} pacientes repartidos de {previous} a {args.fragmentos} fragmentos "
+        f"en {time.perf_counter() - start:.1f}s."
+    )
+
+
+def handle_convert(args: argparse.Namespace) -> None:
+    from .snapshot import convert_snapshot
+
+    start = time.perf_counter()
+    try:
+        fmt, count = convert_snapshot(args.origen, args.destino, args.formato)
+    except FileNotFoundError:
+        print(f"No existe el almacenamiento de origen '{args.origen}'.")
+        return
+    except ValueError as exc:
+        print(exc)
+        return
+    print(f"{count} pacientes escritos en {args.destino} (formato {fmt}) en {time.perf_counter() - start:.1f}s.")
+
+
+def handle_import(args: argparse.Namespace, storage: StorageBackend) -> None:
+    import json
+
+    from .importer import import_rows, parse_rows
+
+    fmt = args.formato or ("csv" if args.archivo.lower().endswith(".csv") else "jsonl")
+    start = time.perf_counter()
+    try:
+        if args.archivo == "-":
+            report = import_rows(storage, parse_rows(sys.stdin, fmt, args.procesos))
+        else:
+            with open(args.archivo, "r", encoding="utf-8", newline="") as stream:
+                report = import_rows(storage, parse_rows(stream, fmt, args.procesos))
+    except FileNotFoundError:
+        print(f"No existe el archivo '{args.archivo}'.")
+        return
+    except ValueError as exc:
+        print(exc)
+        return
+    elapsed = time.perf_counter() - start
+    for rejected in report.rejected[:20]:
+        print(f"Línea {rejected.line}: ERROR - {rejected.error}")
+    if len(report.rejected) > 20:
+        print(f"... y {len(report.rejected) - 20} filas rechazadas más.")
+    if args.rechazados and report.rejected:
+        with open(args.rechazados, "w", encoding="utf-8") as stream:
+            for rejected in report.rejected:
+                record = {"line": rejected.line, "error": rejected.error, "row": rejected.row}
+                stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+    print(
+        f"{report.imported} pacientes importados ({report.created} nuevos, {report.updated} actualizados), "
+        f"{len(report.rejected)} filas rechazadas, en {elapsed:.1f}s."
+    )
+
+
+def handle_export(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from pathlib import Path
+
+    from .changes import write_changes
+    from .durability import atomic_write
+
+    cursor_path = Path(args.cursor) if args.cursor else None
+    cursor = args.desde_cursor
+    if cursor is None and cursor_path is not None and cursor_path.exists():
+        try:
+            cursor = int(cursor_path.read_text(encoding="utf-8").strip() or 0)
+        except ValueError:
+            print(f"El archivo de cursor '{cursor_path}' no contiene un número.", file=sys.stderr)
+            return
+    cursor = cursor or 0
+    events = storage.changes_since(cursor)
+    if args.salida == "-":
+        count, last = write_changes(sys.stdout, events, args.formato)
+        sys.stdout.flush()
+    else:
+        with open(args.salida, "w", encoding="utf-8", newline="") as stream:
+            count, last = write_changes(stream, events, args.formato)
+    if last is not None and cursor_path is not None:
+        atomic_write(cursor_path, lambda fp: fp.write(f"{last}\n"))
+    # Con la salida en stdout el resumen va a stderr para no mezclarse con los datos.
+    print(
+        f"{count} cambios exportados; cursor {last if last is not None else cursor}.",
+        file=sys.stderr if args.salida == "-" else sys.stdout,
+    )
+
+
+def handle_batch(args: argparse.Namespace, storage: StorageBackend) -> None:
+    from .batch import read_operations, run_batch
+
+    try:
+        limiter = build_rate_limiter(args)
+    except ValueError as exc:
+        print(str(exc))
+        return
+    fmt = args.formato or ("csv" if args.archivo.lower().endswith(".csv") else "jsonl")
+    if args.archivo == "-":
+        results = run_batch(storage, read_operations(sys.stdin, fmt), limiter)
+    else:
+        try:
+            with open(args.archivo, "r", encoding="utf-8", newline="") as stream:
+                results = run_batch(storage, read_operations(stream, fmt), limiter)
+        except FileNotFoundError:
+            print(f"No existe el archivo '{args.archivo}'.")
+            return
+    failed = 0
+    for result in results:
+        estado = "OK" if result.ok else "ERROR"
+        failed += not result.ok
+        print(f"Línea {result.line}: {estado} - {result.message}")
+    print(f"Lote aplicado: {len(results) - failed} operaciones correctas, {failed} con errores.")
+    print_rate_limit_stats(limiter)
+
+
+class Command(NamedTuple):
+    """Entrada de :data:`COMMANDS`."""
+
+    help: str
+    handler: Callable[..., None]
+    configure: Optional[Callable[[argparse.ArgumentParser], None]] = None
+    storage: bool = True
+
+
+# El orden es el de la ayuda. Los manejadores reciben ``(args, storage)``, o solo
+# ``args`` si ``storage`` es falso.
+COMMANDS: Dict[str, Command] = {
+    "registrar": Command("Registrar o actualizar un paciente", handle_register, configure_register),
+    "listar": Command("Listar pacientes registrados", handle_list),
+    "ver": Command("Ver detalle de un paciente", handle_show, configure_show),
+    "marcar": Command("Marcar una etapa como completa o pendiente", handle_stage, configure_stage),
+    "agendar": Command("Registrar la fecha de cirugía del paciente", handle_surgery, configure_surgery),
+    "flujo": Command("Mostrar todas las etapas del proceso", handle_workflow, storage=False),
+    "enviar": Command("Enviar un mensaje al paciente", handle_send, configure_send),
+    "campana": Command(
+        "Encolar una plantilla para todos los pacientes o los de una etapa", handle_campaign, configure_campaign
+    ),
+    "despachar": Command(
+        "Entregar los mensajes de la bandeja de salida (pasarela simulada)", handle_dispatch, configure_dispatch
+    ),
+    "programador": Command(
+        "Demonio que envía los recordatorios y la dieta pre cirugía cuando vencen",
+        handle_scheduler,
+        configure_scheduler,
+    ),
+    "pendientes": Command(
+        "Listar los pacientes detenidos en una etapa del flujo", handle_worklist, configure_worklist
+    ),
+    "embudo": Command("Resumen por etapa de pacientes completados, en curso y pendientes", handle_funnel),
+    "analitica": Command(
+        "Embudo, conversión, tiempo por etapa y cohortes (requiere NumPy)", handle_analytics, configure_analytics
+    ),
+    "historial": Command("Ver historial de mensajes", handle_history, configure_history),
+    "servir": Command(
+        "Servicio HTTP/JSON que mantiene el almacenamiento abierto (ver patient_tracking.server)",
+        handle_serve,
+        configure_serve,
+    ),
+    "buscar": Command(
+        "Buscar por texto en nombre, contacto y notas de pacientes y en sus mensajes", handle_search, configure_search
+    ),
+    "migrar": Command(
+        "Importar los pacientes de otro almacenamiento (por ejemplo un patients.json existente)",
+        handle_migrate,
+        configure_migrate,
+    ),
+    "lote": Command(
+        "Aplicar muchas operaciones (registrar, marcar, enviar) en una sola escritura", handle_batch, configure_batch
+    ),
+    "importar": Command(
+        "Importar muchos pacientes desde CSV o JSONL, validando en paralelo y con una sola escritura",
+        handle_import,
+        configure_import,
+    ),
+    "exportar": Command(
+        "Exportar los cambios registrados desde un cursor, en JSONL o CSV", handle_export, configure_export
+    ),
+    "reparticionar": Command(
+        "Cambiar la cantidad de fragmentos de un almacenamiento sharded", handle_reshard, configure_reshard
+    ),
+    "convertir": Command(
+        "Convertir un almacenamiento entre JSON y la instantánea binaria (binary:///ruta)",
+        handle_convert,
+        configure_convert,
+        storage=False,
+    ),
+}
 
 
 def main(argv: list[str] | None = None) -> None:
-    parser = build_parser()
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser(requested_command(argv))
     args = parser.parse_args(argv)
-    storage = PatientStorage(args.storage)
-
-    if args.command == "registrar":
-        handle_register(args, storage)
-    elif args.command == "listar":
-        handle_list(storage)
-    elif args.command == "ver":
-        handle_show(args, storage)
-    elif args.command == "marcar":
-        handle_stage(args, storage)
-    elif args.command == "flujo":
-        handle_workflow()
-    elif args.command == "enviar":
-        handle_send(args, storage)
-    elif args.command == "historial":
-        handle_history(args, storage)
-    else:  # pragma: no cover - safety net
-        parser.print_help()
+    requested = args.perfil or args.perfil_cprofile or args.perfil_prometheus
+    if not requested and not any(name.startswith(PROFILE_ENV_PREFIX) for name in os.environ):
+        run_command(parser, args)
+        return
+    from .profiling import ProfileOptions, profile_command
+
+    options = ProfileOptions.resolve(args.perfil, args.perfil_cprofile, args.perfil_prometheus)
+    if options is None:
+        run_command(parser, args)
+        return
+    with profile_command(args.command, options):
+        run_command(parser, args)
+
+
+def run_command(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    command = COMMANDS[args.command]
+    if not command.storage:
+        command.handler(args)
+        return
+    from .storage import open_storage
+
+    try:
+        storage = open_storage(args.storage, fsync=args.fsync)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    with storage:
+        command.handler(args, storage)
 
 
 if __name__ == "__main__":  # pragma: no cover
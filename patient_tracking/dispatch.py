@@ -0,0 +1,403 @@
+"""Despacho asíncrono de mensajes con bandeja de salida persistente y reintentos.
+
+Los mensajes se encolan en una bandeja de salida (``<almacenamiento>.outbox``,
+un archivo JSONL de solo anexado) y un :class:`Dispatcher` basado en
+``asyncio`` los entrega con varios trabajadores por canal. Los fallos
+transitorios se reintentan con espera exponencial y los resultados se guardan
+en el almacenamiento por lotes, con una sola escritura por cada
+``batch_size`` entregas.
+
+La entrega es "al menos una vez": si el proceso se interrumpe después de
+guardar un lote de mensajes y antes de marcarlos como entregados en la
+bandeja, esos mensajes se vuelven a enviar en el siguiente despacho.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Mapping, Optional, TextIO, Tuple
+
+from .durability import FsyncPolicy, atomic_write, fsync_file
+from .locking import FileLock
+from .messaging import MessageRecord, MessagingChannel
+from .ratelimit import RateLimiter
+from .storage import StorageBackend
+
+
+class DeliveryError(Exception):
+    """Error al entregar un mensaje; ``retryable`` indica si vale la pena reintentar."""
+
+    def __init__(self, message: str, retryable: bool = True) -> None:
+        super().__init__(message)
+        self.retryable = retryable
+
+
+@dataclass
+class OutboxEntry:
+    """Mensaje en espera de ser entregado."""
+
+    entry_id: str
+    patient_id: str
+    subject: str
+    body: str
+    channel: str
+    queued_at: str
+
+    @classmethod
+    def create(cls, patient_id: str, subject: str, body: str, channel: MessagingChannel | str) -> "OutboxEntry":
+        return cls(
+            entry_id=uuid.uuid4().hex,
+            patient_id=patient_id,
+            subject=subject,
+            body=body,
+            channel=MessagingChannel(channel).value,
+            queued_at=datetime.utcnow().isoformat(timespec="seconds"),
+        )
+
+
+class Outbox:
+    """Bandeja de salida persistente en un archivo JSONL de solo anexado.
+
+    Cada línea es un evento: ``queue`` (mensaje nuevo), ``done`` (entregado) o
+    ``failed`` (descartado tras agotar los reintentos). El estado se reconstruye
+    reproduciendo los eventos; :meth:`compact` reescribe el archivo dejando solo
+    los mensajes pendientes y fallidos.
+    """
+
+    def __init__(self, path: str | Path, fsync: str | FsyncPolicy | None = None) -> None:
+        self.path = Path(path)
+        self.fsync = FsyncPolicy.parse(fsync)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file_lock = FileLock(self.path.with_name(self.path.name + ".lock"))
+
+    @classmethod
+    def beside(cls, storage_path: str | Path, fsync: str | FsyncPolicy | None = None) -> "Outbox":
+        """Bandeja asociada a un almacenamiento: ``<ruta del almacenamiento>.outbox``."""
+        storage_path = Path(storage_path)
+        return cls(storage_path.with_name(storage_path.name + ".outbox"), fsync=fsync)
+
+    def _events(self) -> Iterator[Dict]:
+        if not self.path.exists():
+            return
+        with self.path.open("rb") as fp:
+            for raw in fp:
+                if not raw.endswith(b"\n"):
+                    # Línea truncada por una escritura interrumpida: se ignora.
+                    break
+                yield json.loads(raw)
+
+    def _state(self) -> Tuple[Dict[str, OutboxEntry], Dict[str, Tuple[OutboxEntry, str]]]:
+        pending: Dict[str, OutboxEntry] = {}
+        failed: Dict[str, Tuple[OutboxEntry, str]] = {}
+        for event in self._events():
+            op = event["op"]
+            if op == "queue":
+                entry = OutboxEntry(**event["entry"])
+                pending[entry.entry_id] = entry
+            elif op == "done":
+                pending.pop(event["id"], None)
+            elif op == "failed":
+                entry = pending.pop(event["id"], None)
+                if entry is not None:
+                    failed[entry.entry_id] = (entry, event.get("error", ""))
+        return pending, failed
+
+    def pending(self) -> List[OutboxEntry]:
+        """Mensajes encolados que aún no se entregan ni se descartan, en orden de llegada."""
+        with self._file_lock.shared():
+            pending, _ = self._state()
+        return list(pending.values())
+
+    def failed(self) -> List[Tuple[OutboxEntry, str]]:
+        """Mensajes descartados junto con el último error."""
+        with self._file_lock.shared():
+            _, failed = self._state()
+        return list(failed.values())
+
+    def _append(self, events: Iterable[Dict]) -> int:
+        lines = [json.dumps(event, ensure_ascii=False) + "\n" for event in events]
+        if not lines:
+            return 0
+        with self._file_lock.exclusive():
+            with self.path.open("ab") as fp:
+                fp.write("".join(lines).encode("utf-8"))
+                if self.fsync.after_write():
+                    fp.flush()
+                    os.fsync(fp.fileno())
+        return len(lines)
+
+    def enqueue(self, entries: Iterable[OutboxEntry]) -> int:
+        """Agregar mensajes a la bandeja con una sola escritura."""
+        return self._append({"op": "queue", "entry": asdict(entry)} for entry in entries)
+
+    def mark_done(self, entry_ids: Iterable[str]) -> None:
+        self._append({"op": "done", "id": entry_id} for entry_id in entry_ids)
+
+    def mark_failed(self, failures: Iterable[Tuple[str, str]]) -> None:
+        self._append({"op": "failed", "id": entry_id, "error": error} for entry_id, error in failures)
+
+    def compact(self) -> None:
+        """Reescribir la bandeja solo con los mensajes pendientes y fallidos."""
+        with self._file_lock.exclusive():
+            pending, failed = self._state()
+
+            def write(fp: TextIO) -> None:
+                for entry in list(pending.values()) + [entry for entry, _ in failed.values()]:
+                    fp.write(json.dumps({"op": "queue", "entry": asdict(entry)}, ensure_ascii=False) + "\n")
+                for entry_id, (_, error) in failed.items():
+                    fp.write(json.dumps({"op": "failed", "id": entry_id, "error": error}, ensure_ascii=False) + "\n")
+
+            atomic_write(self.path, write)
+        self.fsync.on_close()
+
+    def close(self) -> None:
+        if self.fsync.on_close() and self.path.exists():
+            fsync_file(self.path)
+        self._file_lock.close()
+
+
+# -- remitentes -------------------------------------------------------------------
+
+
+class ChannelSender:
+    """Interfaz de entrega para un canal; las implementaciones lanzan :class:`DeliveryError`."""
+
+    async def send(self, entry: OutboxEntry) -> None:  # pragma: no cover - interface
+        raise NotImplementedError
+
+
+class FakeGateway(ChannelSender):
+    """Pasarela SMS/chat simulada para pruebas: latencia aleatoria y fallos transitorios."""
+
+    def __init__(self, latency: float = 0.05, failure_rate: float = 0.0, seed: Optional[int] = None) -> None:
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self._random = random.Random(seed)
+        self.sent: List[OutboxEntry] = []
+
+    async def send(self, entry: OutboxEntry) -> None:
+        await asyncio.sleep(self.latency * (0.5 + self._random.random()))
+        if self._random.random() < self.failure_rate:
+            raise DeliveryError("Falla simulada de la pasarela.")
+        self.sent.append(entry)
+
+
+def fake_senders(
+    latency: float = 0.05, failure_rate: float = 0.0, seed: Optional[int] = None
+) -> Dict[str, ChannelSender]:
+    """Una pasarela simulada por cada canal soportado."""
+    return {channel.value: FakeGateway(latency, failure_rate, seed) for channel in MessagingChannel}
+
+
+# -- despacho ---------------------------------------------------------------------
+
+
+@dataclass
+class DispatchReport:
+    """Resultado de un despacho."""
+
+    delivered: int = 0
+    failed: int = 0
+    retries: int = 0
+    elapsed: float = 0.0
+    errors: List[Tuple[str, str]] = field(default_factory=list)
+    # Escrituras por lote que fallaron durante el despacho; sus entregas se reintentan al final.
+    flush_errors: List[str] = field(default_factory=list)
+
+
+class Dispatcher:
+    """Entrega los mensajes pendientes de la bandeja con ``asyncio``.
+
+    Cada canal tiene su propia cola y ``concurrency`` trabajadores, de modo que
+    un canal lento no frena a los demás. Un fallo reintentable vuelve a la cola
+    tras ``base_delay * 2**intento`` segundos (con variación aleatoria y tope
+    ``max_delay``) sin ocupar un trabajador mientras espera; tras
+    ``max_attempts`` intentos el mensaje se marca como fallido.
+
+    Con ``rate_limiter`` cada envío (incluidos los reintentos) espera su turno
+    según los límites del canal y la separación mínima por paciente.
+
+    Las escrituras por lote corren en un hilo aparte para no detener el bucle de
+    eventos. Si una falla, sus entregas quedan para la siguiente y el error se
+    anota en ``flush_errors``; el ``flush`` final de :meth:`run` propaga el error
+    si persiste, y los mensajes siguen pendientes en la bandeja.
+    """
+
+    def __init__(
+        self,
+        storage: StorageBackend,
+        outbox: Outbox,
+        senders: Mapping[str, ChannelSender],
+        concurrency: int | Mapping[str, int] = 8,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        batch_size: int = 2000,
+        flush_interval: float = 5.0,
+        rate_limiter: Optional[RateLimiter] = None,
+    ) -> None:
+        self.storage = storage
+        self.outbox = outbox
+        self.senders = dict(senders)
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.rate_limiter = rate_limiter
+        self._delivered: List[Tuple[OutboxEntry, str]] = []
+        self._failed: List[Tuple[str, str]] = []
+        self._attempts: Dict[str, int] = {}
+        self._report = DispatchReport()
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+    def _workers_for(self, channel: str) -> int:
+        if isinstance(self.concurrency, int):
+            return self.concurrency
+        return self.concurrency.get(channel, 1)
+
+    def _backoff(self, attempt: int) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay * (0.5 + random.random() / 2)
+
+    def _take(self) -> Tuple[List[Tuple[OutboxEntry, str]], List[Tuple[str, str]]]:
+        delivered, self._delivered = self._delivered, []
+        failed, self._failed = self._failed, []
+        return delivered, failed
+
+    def flush(self) -> None:
+        """Guardar las entregas acumuladas en una sola escritura y registrarlas en la bandeja."""
+        self._write(*self._take())
+
+    def _write(self, delivered: List[Tuple[OutboxEntry, str]], failed: List[Tuple[str, str]]) -> None:
+        done: List[str] = []
+        if delivered:
+            with self.storage.batch():
+                for entry, sent_at in delivered:
+                    message = MessageRecord(
+                        patient_id=entry.patient_id,
+                        subject=entry.subject,
+                        body=entry.body,
+                        channel=MessagingChannel(entry.channel),
+                        sent_at=sent_at,
+                    )
+                    try:
+                        self.storage.save_message(message)
+                    except ValueError as exc:
+                        failed.append((entry.entry_id, str(exc)))
+                        continue
+                    done.append(entry.entry_id)
+        self.outbox.mark_done(done)
+        self.outbox.mark_failed(failed)
+        self._report.delivered += len(done)
+        self._report.failed += len(failed)
+        self._report.errors.extend(failed)
+
+    async def _flush_async(self) -> None:
+        """Ejecutar :meth:`flush` en un hilo; las listas se toman en el bucle y las escrituras no se solapan."""
+        async with self._flush_lock:
+            delivered, failed = self._take()
+            if not delivered and not failed:
+                return
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, delivered, failed)
+            except Exception as exc:  # pylint: disable=broad-except
+                # Se reintentan en la próxima escritura; la entrega ya es "al menos una vez".
+                self._delivered[:0] = delivered
+                self._failed[:0] = failed
+                self._report.flush_errors.append(str(exc))
+
+    async def _retry_later(self, queue: "asyncio.Queue[OutboxEntry]", entry: OutboxEntry, delay: float) -> None:
+        await asyncio.sleep(delay)
+        queue.put_nowait(entry)
+        # El mensaje cuenta como pendiente hasta volver a la cola, así ``join`` lo espera.
+        queue.task_done()
+
+    async def _worker(self, queue: "asyncio.Queue[OutboxEntry]", sender: ChannelSender) -> None:
+        while True:
+            entry = await queue.get()
+            retrying = False
+            try:
+                retrying = await self._deliver(queue, entry, sender)
+            finally:
+                # Aunque la entrega o la escritura fallen, ``join`` no debe quedar esperando
+                # este mensaje; un reintento lo marca ``_retry_later`` al volver a encolarlo.
+                if not retrying:
+                    queue.task_done()
+
+    async def _deliver(self, queue: "asyncio.Queue[OutboxEntry]", entry: OutboxEntry, sender: ChannelSender) -> bool:
+        """Intentar una entrega; devuelve ``True`` si quedó programado un reintento."""
+        attempt = self._attempts.get(entry.entry_id, 0) + 1
+        self._attempts[entry.entry_id] = attempt
+        try:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.acquire(entry.channel, entry.patient_id)
+            await sender.send(entry)
+        except Exception as exc:  # pylint: disable=broad-except
+            retryable = exc.retryable if isinstance(exc, DeliveryError) else True
+            if retryable and attempt < self.max_attempts:
+                self._report.retries += 1
+                asyncio.ensure_future(self._retry_later(queue, entry, self._backoff(attempt)))
+                return True
+            self._failed.append((entry.entry_id, str(exc)))
+        else:
+            self._delivered.append((entry, datetime.utcnow().isoformat(timespec="seconds")))
+        if len(self._delivered) + len(self._failed) >= self.batch_size:
+            await asyncio.shield(self._flush_async())
+        return False
+
+    async def _flusher(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Protegida: si ``run`` cancela la tarea a mitad de una escritura, esta
+            # termina igual y ``run`` la espera tomando ``_flush_lock``.
+            await asyncio.shield(self._flush_async())
+
+    async def run(self, entries: Optional[List[OutboxEntry]] = None) -> DispatchReport:
+        """Entregar ``entries`` (por defecto todo lo pendiente en la bandeja) y devolver el resumen."""
+        start = time.perf_counter()
+        self._flush_lock = asyncio.Lock()
+        entries = self.outbox.pending() if entries is None else entries
+        queues: Dict[str, asyncio.Queue] = {}
+        for entry in entries:
+            if entry.channel not in self.senders:
+                self._failed.append((entry.entry_id, f"No hay remitente configurado para el canal '{entry.channel}'."))
+                continue
+            queues.setdefault(entry.channel, asyncio.Queue()).put_nowait(entry)
+        tasks = [
+            asyncio.ensure_future(self._worker(queue, self.senders[channel]))
+            for channel, queue in queues.items()
+            for _ in range(self._workers_for(channel))
+        ]
+        flusher = asyncio.ensure_future(self._flusher())
+        try:
+            await asyncio.gather(*(queue.join() for queue in queues.values()))
+        finally:
+            for task in tasks + [flusher]:
+                task.cancel()
+            await asyncio.gather(*tasks, flusher, return_exceptions=True)
+            async with self._flush_lock:
+                # La última escritura propaga su error: los mensajes siguen pendientes en la bandeja.
+                self.flush()
+        self._report.elapsed = time.perf_counter() - start
+        return self._report
+
+
+def dispatch(
+    storage: StorageBackend,
+    outbox: Outbox,
+    senders: Mapping[str, ChannelSender],
+    **options: object,
+) -> DispatchReport:
+    """Ejecutar un :class:`Dispatcher` hasta vaciar la bandeja y compactarla."""
+    report = asyncio.run(Dispatcher(storage, outbox, senders, **options).run())
+    outbox.compact()
+    return report
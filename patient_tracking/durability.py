@@ -0,0 +1,104 @@
+"""Escrituras atómicas y políticas de ``fsync`` para los motores basados en archivos."""
+from __future__ import annotations
+
+import os
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Callable
+
+FSYNC_CHOICES = ("always", "close", "never")
+
+
+@dataclass
+class FsyncPolicy:
+    """Decide cuándo forzar ``fsync`` tras una escritura.
+
+    Modos: ``always`` (cada escritura), ``every`` (cada ``every`` escrituras),
+    ``close`` (una vez al cerrar el almacenamiento) y ``never``.
+    """
+
+    mode: str = "close"
+    every: int = 1
+    _unsynced: int = field(default=0, repr=False)
+
+    @classmethod
+    def parse(cls, value: "str | int | FsyncPolicy | None") -> "FsyncPolicy":
+        """Interpretar ``always``, ``close``, ``never`` o un número N (cada N escrituras)."""
+        if isinstance(value, FsyncPolicy):
+            return value
+        if value is None:
+            return cls()
+        text = str(value).strip().lower()
+        if text.isdigit():
+            count = int(text)
+            return cls("always") if count <= 1 else cls("every", count)
+        if text in FSYNC_CHOICES:
+            return cls(text)
+        raise ValueError(f"Política de fsync desconocida: '{value}'.")
+
+    def after_write(self) -> bool:
+        """Registrar una escritura y devolver si debe sincronizarse ahora."""
+        if self.mode == "always":
+            return True
+        self._unsynced += 1
+        if self.mode == "every" and self._unsynced >= self.every:
+            self._unsynced = 0
+            return True
+        return False
+
+    def synced(self) -> None:
+        """Registrar que todo lo escrito hasta ahora ya quedó sincronizado a disco."""
+        self._unsynced = 0
+
+    def on_close(self) -> bool:
+        """Devolver si quedan escrituras sin sincronizar que deban forzarse al cerrar."""
+        unsynced, self._unsynced = self._unsynced, 0
+        return unsynced > 0 and self.mode in ("close", "every")
+
+
+def fsync_directory(directory: Path) -> None:
+    """Sincronizar la entrada de directorio tras un ``os.replace`` (solo POSIX)."""
+    if os.name != "posix":
+        return
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_file(path: Path) -> None:
+    with path.open("rb") as fp:
+        os.fsync(fp.fileno())
+    fsync_directory(path.parent)
+
+
+def atomic_write(path: Path, write: Callable[[IO], None], sync: bool = True, binary: bool = False) -> None:
+    """Escribir ``path`` en un archivo temporal hermano y reemplazarlo con ``os.replace``.
+
+    Un lector concurrente o un fallo a mitad de escritura ven siempre el documento
+    anterior completo o el nuevo completo, nunca uno truncado. ``write`` recibe el
+    archivo en modo texto UTF-8, o en modo binario si ``binary`` es verdadero.
+    """
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        try:
+            mode = path.stat().st_mode & 0o777
+        except FileNotFoundError:
+            mode = 0o644
+        os.chmod(tmp_name, mode)
+        with (os.fdopen(fd, "wb") if binary else os.fdopen(fd, "w", encoding="utf-8")) as fp:
+            write(fp)
+            if sync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.replace(tmp_name, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_name)
+        except FileNotFoundError:
+            pass
+        raise
+    if sync:
+        fsync_directory(path.parent)
@@ -0,0 +1,263 @@
+"""Importación masiva de pacientes desde CSV o JSONL.
+
+Cada fila describe un paciente con los campos de ``registrar`` más su estado
+inicial::
+
+    {"patient_id": "123", "name": "Ana", "contact": "+569...", "channel": "sms", "stage_status": {"1": true}}
+
+    patient_id,name,contact,channel,notes,surgery_date,stage_status
+    123,Ana,+569...,sms,,2024-07-01,1;2;3
+
+En CSV ``stage_status`` lista las etapas completadas separadas por ``;``; en JSONL
+puede ser esa misma cadena, una lista de ids o el objeto ``{"<id>": bool}`` que
+usa el almacenamiento (también se acepta ``preferred_channel`` en lugar de
+``channel``, de modo que un registro exportado puede volver a importarse).
+
+Las filas se decodifican y validan en procesos de trabajo, por bloques; una vez
+validado todo el archivo se combinan con el almacenamiento dentro de un único
+``batch()``, de modo que el candado solo se retiene durante la combinación: los
+pacientes nuevos se agregan con ``import_patients`` y los existentes se
+actualizan igual que con ``registrar`` (nombre, contacto y canal; notas y fecha
+de cirugía solo si la fila las trae) y reciben las etapas indicadas,
+conservando su historial.
+"""
+from __future__ import annotations
+
+import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Deque, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, TextIO, Tuple
+
+from .messaging import MessagingChannel
+from .storage import Patient, StorageBackend
+from .workflow import get_stage
+
+IMPORT_FORMATS = ("jsonl", "csv")
+CHUNK_ROWS = 2000
+# Bloques enviados a cada proceso de trabajo sin esperar resultados: acota la
+# memoria cuando el archivo se lee más rápido de lo que se valida.
+CHUNKS_PER_WORKER = 2
+MAX_ID_LENGTH = 64
+_TRUE_VALUES = {"1", "true", "si", "sí", "yes", "x"}
+
+# Fila leída: número de línea y contenido (línea JSONL sin decodificar o fila CSV).
+RawRow = Tuple[int, object]
+
+
+@dataclass
+class RejectedRow:
+    """Fila descartada al importar, con el motivo y su contenido original."""
+
+    line: int
+    error: str
+    row: object = None
+
+
+@dataclass
+class ImportReport:
+    created: int = 0
+    updated: int = 0
+    rejected: List[RejectedRow] = field(default_factory=list)
+
+    @property
+    def imported(self) -> int:
+        return self.created + self.updated
+
+
+def _text(row: Mapping, name: str, required: bool = False) -> str:
+    value = row.get(name)
+    text = "" if value is None else str(value).strip()
+    if required and not text:
+        raise ValueError(f"Falta el campo '{name}'.")
+    return text
+
+
+def _completed(value: object) -> bool:
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in _TRUE_VALUES
+
+
+def parse_stage_status(value: object) -> Dict[str, bool]:
+    """Normalizar ``stage_status`` a ``{"<id>": bool}``, validando que cada etapa exista."""
+    if value is None or value == "":
+        return {}
+    if isinstance(value, Mapping):
+        items = list(value.items())
+    elif isinstance(value, str):
+        items = [(stage_id, True) for stage_id in value.replace(",", ";").split(";") if stage_id.strip()]
+    elif isinstance(value, list):
+        items = [(stage_id, True) for stage_id in value]
+    else:
+        raise ValueError(f"Estado de etapas inválido: '{value}'.")
+    status: Dict[str, bool] = {}
+    for stage_id, completed in items:
+        try:
+            stage = get_stage(int(str(stage_id).strip()))
+        except ValueError:
+            raise ValueError(f"Etapa inválida: '{stage_id}'.") from None
+        status[str(stage.id)] = _completed(completed)
+    return status
+
+
+def parse_patient(row: Mapping) -> Patient:
+    """Validar una fila y construir el paciente; lanza ``ValueError`` con el motivo si no es válida."""
+    patient_id = _text(row, "patient_id", required=True)
+    if len(patient_id) > MAX_ID_LENGTH or any(char.isspace() or not char.isprintable() for char in patient_id):
+        raise ValueError(f"Identificador inválido: '{patient_id}'.")
+    channel = _text(row, "channel") or _text(row, "preferred_channel") or MessagingChannel.CHAT.value
+    try:
+        preferred_channel = MessagingChannel(channel.lower())
+    except ValueError:
+        choices = ", ".join(option.value for option in MessagingChannel)
+        raise ValueError(f"Canal inválido: '{channel}' (use {choices}).") from None
+    surgery_date = _text(row, "surgery_date")
+    if surgery_date:
+        try:
+            surgery_date = date.fromisoformat(surgery_date).isoformat()
+        except ValueError:
+            raise ValueError(f"Fecha de cirugía inválida: '{surgery_date}' (use AAAA-MM-DD).") from None
+    patient = Patient(
+        patient_id=patient_id,
+        name=_text(row, "name", required=True),
+        contact=_text(row, "contact", required=True),
+        preferred_channel=preferred_channel,
+        notes=_text(row, "notes"),
+        surgery_date=surgery_date,
+    )
+    times = row.get("stage_times")
+    times = times if isinstance(times, Mapping) else {}
+    for stage_id, completed in parse_stage_status(row.get("stage_status")).items():
+        patient.mark_stage(int(stage_id), completed, at=times.get(stage_id) if completed else None)
+    return patient
+
+
+def _parse_chunk(fmt: str, header: Optional[Sequence[str]], rows: List[RawRow]) -> List[Tuple[int, object, object]]:
+    """Decodificar y validar un bloque; se ejecuta en un proceso de trabajo.
+
+    Devuelve ``(línea, paciente, None)`` o ``(línea, motivo, fila original)`` por fila.
+    """
+    results: List[Tuple[int, object, object]] = []
+    for line, raw in rows:
+        try:
+            if fmt == "csv":
+                if len(raw) != len(header):
+                    raise ValueError(f"Se esperaban {len(header)} columnas y hay {len(raw)}.")
+                row = dict(zip(header, raw))
+            else:
+                try:
+                    row = json.loads(raw)
+                except json.JSONDecodeError as exc:
+                    raise ValueError(f"JSON inválido: {exc.msg}") from None
+                if not isinstance(row, dict):
+                    raise ValueError("Se esperaba un objeto JSON.")
+            results.append((line, parse_patient(row), None))
+        except ValueError as exc:
+            results.append((line, str(exc), raw))
+    return results
+
+
+def read_rows(stream: TextIO, fmt: str = "jsonl") -> Tuple[Optional[List[str]], Iterator[RawRow]]:
+    """Encabezado (solo CSV) y filas sin decodificar ``(número de línea, contenido)``."""
+    if fmt == "csv":
+        reader = csv.reader(stream)
+        header = [name.strip() for name in next(reader, [])]
+
+        def csv_rows() -> Iterator[RawRow]:
+            for row in reader:
+                if row:
+                    yield reader.line_num, row
+
+        return header, csv_rows()
+    if fmt != "jsonl":
+        raise ValueError(f"Formato de importación desconocido: '{fmt}'.")
+    return None, ((number, line) for number, line in enumerate(stream, start=1) if line.strip())
+
+
+def _chunks(rows: Iterable[RawRow], size: int) -> Iterator[List[RawRow]]:
+    chunk: List[RawRow] = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_rows(
+    stream: TextIO, fmt: str = "jsonl", workers: Optional[int] = None, chunk_rows: int = CHUNK_ROWS
+) -> Iterator[Tuple[int, object, object]]:
+    """Validar las filas de ``stream`` en ``workers`` procesos (por defecto, uno por CPU), en orden de línea.
+
+    A lo sumo ``CHUNKS_PER_WORKER`` bloques por proceso están en curso a la vez.
+    """
+    header, rows = read_rows(stream, fmt)
+    if fmt == "csv" and "patient_id" not in header:
+        raise ValueError("El CSV debe tener un encabezado con la columna 'patient_id'.")
+    workers = workers or os.cpu_count() or 1
+    chunks = _chunks(rows, chunk_rows)
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _parse_chunk(fmt, header, chunk)
+        return
+    with ProcessPoolExecutor(workers) as pool:
+        pending: Deque[Future] = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(_parse_chunk, fmt, header, chunk))
+            if len(pending) >= workers * CHUNKS_PER_WORKER:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _merge(current: Patient, patient: Patient) -> None:
+    current.name = patient.name
+    current.contact = patient.contact
+    current.preferred_channel = patient.preferred_channel
+    if patient.notes:
+        current.notes = patient.notes
+    if patient.surgery_date:
+        current.surgery_date = patient.surgery_date
+    for stage_id, completed in patient.stage_status.items():
+        if current.is_stage_completed(int(stage_id)) != completed:
+            current.mark_stage(int(stage_id), completed, at=patient.stage_time(stage_id))
+
+
+def import_rows(storage: StorageBackend, parsed: Iterable[Tuple[int, object, object]]) -> ImportReport:
+    """Combinar las filas validadas con el almacenamiento en una sola escritura.
+
+    ``parsed`` se consume por completo antes de abrir el ``batch()``, para no
+    retener el candado mientras se valida. Un ``patient_id`` repetido en el
+    archivo se rechaza a partir de su segunda aparición.
+    """
+    report = ImportReport()
+    seen: Dict[str, int] = {}
+    valid: List[Patient] = []
+    for line, patient, raw in parsed:
+        if not isinstance(patient, Patient):
+            report.rejected.append(RejectedRow(line, str(patient), raw))
+            continue
+        first = seen.setdefault(patient.patient_id, line)
+        if first != line:
+            report.rejected.append(
+                RejectedRow(line, f"Paciente {patient.patient_id} repetido (ya aparece en la línea {first}).")
+            )
+            continue
+        valid.append(patient)
+    new: List[Patient] = []
+    with storage.batch():
+        for patient in valid:
+            current = storage.get_patient(patient.patient_id)
+            if current is None:
+                new.append(patient)
+                continue
+            _merge(current, patient)
+            storage.save_patient(current)
+            report.updated += 1
+        report.created = storage.import_patients(new)
+    return report
@@ -0,0 +1,390 @@
+"""Almacenamiento basado en bitácora de solo anexado (journal) con compactación periódica.
+
+Cada mutación se agrega como una línea JSON al archivo ``<snapshot>.journal`` en lugar
+de reescribir todo el documento. Periódicamente la bitácora se compacta en una
+instantánea con el mismo formato que usa :class:`~patient_tracking.storage.PatientStorage`,
+por lo que ambos motores pueden leer el mismo archivo de pacientes.
+"""
+from __future__ import annotations
+
+import json
+import os
+from contextlib import contextmanager
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from .changes import ChangeFeed, message_change, patient_changes
+from .durability import FsyncPolicy, atomic_write, fsync_file
+from .jsonstream import dump_patients
+from .messaging import MessageRecord
+from .locking import FileLock
+from .search_index import SearchIndex
+from .stage_index import StageIndex
+from .storage import Patient, StorageBackend, check_version, payload_completed_stages, tail_messages
+
+_CORE_FIELDS = ("patient_id", "name", "contact", "preferred_channel", "notes", "surgery_date")
+
+
+class JournalStorage(StorageBackend):
+    """Motor que registra mutaciones en una bitácora y las compacta en una instantánea.
+
+    El estado completo se mantiene en memoria; las lecturas revisan si la bitácora
+    creció (por ejemplo, por otro proceso) y aplican solo los registros nuevos.
+    Los mensajes se guardan aparte del registro de cada paciente, sin decodificar,
+    y solo se convierten en :class:`MessageRecord` al pedir el historial.
+    ``fsync`` controla cuándo se sincronizan los anexos; las instantáneas siempre
+    se escriben de forma atómica y sincronizada. Los eventos de cambio van a
+    ``<instantánea>.changes``, que la compactación no toca.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = "data/patients.json",
+        compact_every: int = 1000,
+        fsync: str | FsyncPolicy | None = None,
+    ) -> None:
+        self.path = Path(path)
+        self.journal_path = self.path.with_name(self.path.name + ".journal")
+        self.compact_every = compact_every
+        self.fsync = FsyncPolicy.parse(fsync)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.change_feed = ChangeFeed.beside(self.path, fsync=fsync)
+        self._file_lock = FileLock(self.path.with_name(self.path.name + ".lock"))
+        self._patients: Dict[str, Dict] = {}
+        self._messages: Dict[str, List[Dict]] = {}
+        self._seq = 0
+        self._records = 0
+        self._offset = 0
+        self._snapshot_stat: Optional[tuple] = None
+        self._buffer: Optional[List[str]] = None
+        # ``_generation`` cambia cada vez que se incorporan cambios ajenos (instantánea
+        # nueva o registros de otro proceso) e invalida el índice de etapas.
+        self._generation = 0
+        self._stage_index: Optional[StageIndex] = None
+        self._stage_index_generation = -1
+        self._search_index: Optional[SearchIndex] = None
+        self._search_index_generation = -1
+        with self._file_lock.shared():
+            self._load_snapshot()
+            self._replay()
+
+    # -- carga y reproducción -------------------------------------------------
+
+    def _stat_key(self) -> Optional[tuple]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _load_snapshot(self) -> None:
+        self._generation += 1
+        self._patients = {}
+        self._messages = {}
+        self._seq = 0
+        self._records = 0
+        self._offset = 0
+        self._snapshot_stat = self._stat_key()
+        if self._snapshot_stat is None:
+            return
+        with self.path.open("r", encoding="utf-8") as fp:
+            data = json.load(fp)
+        self._patients = data.get("patients", {})
+        for patient_id, payload in self._patients.items():
+            self._messages[patient_id] = payload.pop("messages", [])
+        self._seq = data.get("journal_seq", 0)
+
+    def _replay(self) -> None:
+        """Aplicar los registros de la bitácora posteriores al último desplazamiento leído."""
+        if not self.journal_path.exists():
+            return
+        with self.journal_path.open("rb") as fp:
+            fp.seek(self._offset)
+            for raw in fp:
+                if not raw.endswith(b"\n"):
+                    # Línea truncada por una escritura interrumpida: se ignora.
+                    break
+                try:
+                    record = json.loads(raw)
+                except json.JSONDecodeError:
+                    break
+                self._offset += len(raw)
+                self._records += 1
+                if record.get("seq", 0) <= self._seq:
+                    continue
+                self._apply(record)
+                self._seq = record["seq"]
+                self._generation += 1
+
+    def _refresh(self) -> None:
+        if self._buffer is not None:
+            return
+        with self._file_lock.shared():
+            if self._stat_key() != self._snapshot_stat:
+                # Otro proceso compactó la bitácora: recargar desde la instantánea.
+                self._load_snapshot()
+            elif self.journal_path.exists() and self.journal_path.stat().st_size < self._offset:
+                self._load_snapshot()
+            self._replay()
+
+    def _apply(self, record: Dict) -> None:
+        op = record["op"]
+        if op == "patient":
+            payload = dict(record["patient"])
+            current = self._patients.get(payload["patient_id"], {})
+            if "messages" in payload:
+                # Solo las importaciones traen el historial completo, que reemplaza al anterior.
+                self._messages[payload["patient_id"]] = payload.pop("messages")
+            payload["version"] = current.get("version", 0)
+            self._patients[payload["patient_id"]] = payload
+        elif op == "stage":
+            payload = self._patients[record["patient_id"]]
+            stage_id = str(record["stage_id"])
+            payload.setdefault("stage_status", {})[stage_id] = record["completed"]
+            times = payload.setdefault("stage_times", {})
+            if record.get("at"):
+                times[stage_id] = record["at"]
+            else:
+                times.pop(stage_id, None)
+        elif op == "message":
+            payload = self._patients[record["message"]["patient_id"]]
+            self._messages.setdefault(payload["patient_id"], []).append(record["message"])
+        else:
+            raise ValueError(f"Registro de bitácora desconocido: '{op}'.")
+        # Cada registro aplicado cuenta como una nueva versión del paciente.
+        payload["version"] = payload.get("version", 0) + 1
+
+    # -- escritura --------------------------------------------------------------
+
+    def _append(self, records: List[Dict]) -> None:
+        self._commit(self._stage(records))
+
+    def _stage(self, records: List[Dict]) -> List[str]:
+        """Numerar y aplicar en memoria los registros; devuelve sus líneas sin escribirlas."""
+        lines = []
+        for record in records:
+            self._seq += 1
+            record["seq"] = self._seq
+            self._apply(record)
+            if record["op"] != "message" and self._stage_index_generation == self._generation:
+                patient_id = record.get("patient_id") or record["patient"]["patient_id"]
+                self._stage_index.update(patient_id, payload_completed_stages(self._patients[patient_id]))
+            if self._search_index_generation == self._generation:
+                self._update_search_index(record)
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        return lines
+
+    def _commit(self, lines: List[str]) -> None:
+        if self._buffer is not None:
+            self._buffer.extend(lines)
+            return
+        self._flush(lines, len(lines))
+
+    def _flush(self, lines: List[str], count: int) -> None:
+        data = "".join(lines).encode("utf-8")
+        with self.journal_path.open("a+b") as fp:
+            if os.fstat(fp.fileno()).st_size > self._offset:
+                # Bajo el candado exclusivo ``_offset`` es el final del último registro
+                # válido: lo que sigue es una línea truncada que se descarta para no
+                # pegarle el registro nuevo.
+                fp.truncate(self._offset)
+            fp.write(data)
+            if self.fsync.after_write():
+                fp.flush()
+                os.fsync(fp.fileno())
+        self._offset += len(data)
+        self._records += count
+        if self.compact_every and self._records >= self.compact_every:
+            self.compact()
+
+    def _full_payload(self, patient_id: str, payload: Dict) -> Dict:
+        """Registro del paciente con su historial, en el formato de la instantánea."""
+        full = {key: value for key, value in payload.items() if key != "version"}
+        full["messages"] = self._messages.get(patient_id, [])
+        full["version"] = payload.get("version", 0)
+        return full
+
+    def compact(self) -> None:
+        """Escribir una instantánea con el estado actual y vaciar la bitácora."""
+        patients = (
+            (patient_id, self._full_payload(patient_id, payload)) for patient_id, payload in self._patients.items()
+        )
+        # La instantánea reemplaza a la bitácora que se vacía a continuación: salvo con
+        # ``never`` se sincroniza siempre, o un corte podría perder lo ya compactado.
+        sync = self.fsync.mode != "never"
+        atomic_write(self.path, lambda fp: dump_patients(fp, patients, {"journal_seq": self._seq}), sync=sync)
+        # Si el proceso se interrumpe antes de vaciar la bitácora, ``journal_seq``
+        # evita aplicar dos veces los registros ya incluidos en la instantánea.
+        with self.journal_path.open("wb"):
+            pass
+        self._snapshot_stat = self._stat_key()
+        self._offset = 0
+        self._records = 0
+        if sync:
+            # Los registros pendientes de la bitácora ya están en la instantánea
+            # sincronizada: ``close`` no tiene nada más que forzar.
+            self.fsync.synced()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Acumular los registros del bloque y anexarlos con una única escritura."""
+        if self._buffer is not None:
+            yield
+            return
+        with self._file_lock.exclusive(), self._holding_changes():
+            self._refresh()
+            self._buffer = []
+            try:
+                yield
+            except BaseException:
+                # Los cambios ya aplicados en memoria se descartan recargando desde disco.
+                self._buffer = None
+                self._load_snapshot()
+                self._replay()
+                raise
+            lines, self._buffer = self._buffer, None
+            self._publish_changes()
+            if lines:
+                self._flush(lines, len(lines))
+
+    # -- API pública ------------------------------------------------------------
+
+    def list_patients(self) -> List[Patient]:
+        self._refresh()
+        return [
+            Patient.from_dict(self._full_payload(patient_id, payload)) for patient_id, payload in self._patients.items()
+        ]
+
+    def iter_patients(self, include_messages: bool = True) -> Iterator[Patient]:
+        self._refresh()
+        for patient_id, payload in list(self._patients.items()):
+            if include_messages:
+                payload = self._full_payload(patient_id, payload)
+            yield Patient.from_dict(payload)
+
+    def stage_index(self) -> StageIndex:
+        self._refresh()
+        if self._stage_index is None or self._stage_index_generation != self._generation:
+            self._stage_index = StageIndex.build(
+                (patient_id, payload_completed_stages(payload)) for patient_id, payload in self._patients.items()
+            )
+            self._stage_index_generation = self._generation
+        return self._stage_index
+
+    def _update_search_index(self, record: Dict) -> None:
+        if record["op"] == "message":
+            message = record["message"]
+            self._search_index.add_message(
+                message["patient_id"], message["subject"], message["body"], message["sent_at"]
+            )
+        elif record["op"] == "patient":
+            if "messages" in record["patient"]:
+                # Una importación reemplaza el historial: el índice se rehace al consultarlo.
+                self._search_index_generation = -1
+                return
+            payload = record["patient"]
+            self._search_index.update_patient(
+                payload["patient_id"], payload["name"], payload["contact"], payload.get("notes", "")
+            )
+
+    def search_index(self) -> SearchIndex:
+        self._refresh()
+        if self._search_index is None or self._search_index_generation != self._generation:
+            self._search_index = SearchIndex.build(
+                (payload, self._messages.get(patient_id, [])) for patient_id, payload in self._patients.items()
+            )
+            self._search_index_generation = self._generation
+        return self._search_index
+
+    def patients_at_stage(self, stage_id: int, state: str = "actual") -> List[Patient]:
+        patient_ids = sorted(self.stage_index().patient_ids(stage_id, state))
+        return [Patient.from_dict(self._patients[patient_id]) for patient_id in patient_ids]
+
+    def get_patient(self, patient_id: str) -> Optional[Patient]:
+        self._refresh()
+        payload = self._patients.get(patient_id)
+        if payload is None:
+            return None
+        return Patient.from_dict(payload)
+
+    def message_history(
+        self, patient_id: str, limit: Optional[int] = None, since: Optional[str] = None
+    ) -> List[MessageRecord]:
+        self._refresh()
+        return tail_messages(self._messages.get(patient_id, []), limit, since)
+
+    def _patient_records(self, patient: Patient, current: Optional[Dict]) -> List[Dict]:
+        """Traducir el paciente a registros: cambios de etapa si es posible, si no un upsert."""
+        new = patient.to_dict(include_messages=False)
+        del new["version"]
+        old_status = current.get("stage_status", {}) if current is not None else {}
+        old_times = current.get("stage_times", {}) if current is not None else {}
+        changed = [stage_id for stage_id, done in new["stage_status"].items() if old_status.get(stage_id) != done]
+        if (
+            current is not None
+            and all(current.get(key, "") == new[key] for key in _CORE_FIELDS)
+            and set(old_status) <= set(new["stage_status"])
+            and all(old_times.get(key) == at for key, at in new["stage_times"].items() if key not in changed)
+            and set(old_times) - set(changed) <= set(new["stage_times"])
+        ):
+            return [
+                {
+                    "op": "stage",
+                    "patient_id": patient.patient_id,
+                    "stage_id": int(stage_id),
+                    "completed": new["stage_status"][stage_id],
+                    "at": new["stage_times"].get(stage_id),
+                }
+                for stage_id in changed
+            ]
+        # Sin "messages" el registro conserva el historial guardado.
+        return [{"op": "patient", "patient": new}]
+
+    def save_patient(self, patient: Patient) -> None:
+        """Anexar los cambios del paciente si su ``version`` sigue siendo la guardada."""
+        with self._file_lock.exclusive():
+            self._refresh()
+            current = self._patients.get(patient.patient_id)
+            check_version(patient, current)
+            records = self._patient_records(patient, current)
+            if records:
+                # Los registros de etapa modifican ``current`` en su lugar.
+                previous = {"stage_status": dict(current.get("stage_status", {}))} if current else None
+                lines = self._stage(records)
+                # El evento va antes que la bitácora (ver :mod:`patient_tracking.changes`).
+                self._record_changes(patient_changes(previous, self._patients[patient.patient_id]))
+                self._commit(lines)
+            patient.version = self._patients[patient.patient_id]["version"]
+
+    def save_message(self, message: MessageRecord) -> None:
+        with self._file_lock.exclusive():
+            self._refresh()
+            if message.patient_id not in self._patients:
+                raise ValueError(f"Paciente {message.patient_id} no existe.")
+            payload = asdict(message)
+            payload["channel"] = message.channel.value
+            lines = self._stage([{"op": "message", "message": payload}])
+            self._record_changes([message_change(payload)])
+            self._commit(lines)
+
+    def import_patients(self, patients: Iterable[Patient]) -> int:
+        """Anexar un registro completo (con historial) por paciente, sin control de versión."""
+        count = 0
+        with self.batch():
+            for patient in patients:
+                record = patient.to_dict()
+                del record["version"]
+                current = self._patients.get(patient.patient_id)
+                known = len(self._messages.get(patient.patient_id, []))
+                self._append([{"op": "patient", "patient": record}])
+                self._record_changes(patient_changes(current, self._patients[patient.patient_id]))
+                self._record_changes([message_change(message) for message in record["messages"][known:]])
+                count += 1
+        return count
+
+    def close(self) -> None:
+        if self.fsync.on_close() and self.journal_path.exists():
+            fsync_file(self.journal_path)
+        self.change_feed.close()
+        self._file_lock.close()
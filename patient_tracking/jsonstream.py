@@ -0,0 +1,133 @@
+"""Lectura y escritura incremental del documento JSON de pacientes.
+
+El lector recorre ``{"patients": {...}}`` en bloques de tamaño fijo y entrega un
+paciente a la vez, opcionalmente descartando la lista ``messages`` para no construir
+los registros de mensajes.
+El escritor produce exactamente el mismo formato que ``json.dump(..., indent=2)``
+a partir de un iterable, sin construir el documento completo en memoria.
+"""
+from __future__ import annotations
+
+import json
+import re
+from typing import Any, Dict, Iterable, Iterator, Mapping, Optional, TextIO, Tuple
+
+_WHITESPACE = re.compile(r"\s*")
+_NUMBER = re.compile(r"[-+0-9.eE]*")
+_DECODER = json.JSONDecoder()
+
+
+class _ChunkedReader:
+    """Cursor sobre un archivo de texto que solo mantiene en memoria el bloque en curso."""
+
+    def __init__(self, fp: TextIO, chunk_size: int) -> None:
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self, size: Optional[int] = None) -> bool:
+        if self._eof:
+            return False
+        chunk = self._fp.read(size or self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str) -> None:
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"JSON inválido: se esperaba '{char}' y se encontró '{found or 'EOF'}'.")
+        self._pos += 1
+
+    def value(self) -> Any:
+        """Decodificar el siguiente valor JSON completo."""
+        if self.peek() in "-0123456789":
+            # Un número al final del bloque podría continuar en el siguiente.
+            while _NUMBER.match(self._buf, self._pos).end() == len(self._buf) and self._fill():
+                pass
+        size = self._chunk_size
+        while True:
+            try:
+                obj, end = _DECODER.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                if not self._fill(size):
+                    raise
+                size *= 2
+                continue
+            self._pos = end
+            return obj
+
+    def members(self) -> Iterator[str]:
+        """Iterar las claves del objeto actual dejando el cursor sobre cada valor."""
+        self.expect("{")
+        if self.peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(":")
+            yield key
+            separator = self.peek()
+            self._pos += 1
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError(f"JSON inválido: separador inesperado '{separator or 'EOF'}'.")
+
+
+def iter_patient_payloads(fp: TextIO, skip_messages: bool = False, chunk_size: int = 1 << 16) -> Iterator[Dict]:
+    """Entregar cada paciente de ``{"patients": {...}}`` sin cargar el documento completo.
+
+    Cada paciente se decodifica de una vez con el decodificador nativo de ``json``, que es
+    más rápido que recorrer sus campos en Python; con ``skip_messages`` la lista
+    ``messages`` se descarta antes de entregarlo. La memoria usada depende del paciente
+    más grande, no del tamaño del archivo.
+    """
+    reader = _ChunkedReader(fp, chunk_size)
+    for key in reader.members():
+        if key != "patients":
+            reader.value()
+            continue
+        for _patient_id in reader.members():
+            payload = reader.value()
+            if skip_messages:
+                payload.pop("messages", None)
+            yield payload
+
+
+def _indented(value: Any, prefix: str) -> str:
+    return json.dumps(value, indent=2, ensure_ascii=False).replace("\n", "\n" + prefix)
+
+
+def dump_patients(
+    fp: TextIO, patients: Iterable[Tuple[str, Dict]], extra: Optional[Mapping[str, Any]] = None
+) -> None:
+    """Escribir ``{"patients": {...}}`` a partir de pares ``(patient_id, payload)``.
+
+    El resultado es idéntico a ``json.dump(documento, fp, indent=2, ensure_ascii=False)``.
+    """
+    fp.write('{\n  "patients": {')
+    empty = True
+    for patient_id, payload in patients:
+        fp.write("\n    " if empty else ",\n    ")
+        empty = False
+        fp.write(json.dumps(patient_id, ensure_ascii=False))
+        fp.write(": ")
+        fp.write(_indented(payload, "    "))
+    fp.write("}" if empty else "\n  }")
+    for key, value in (extra or {}).items():
+        fp.write(f",\n  {json.dumps(key, ensure_ascii=False)}: {_indented(value, '  ')}")
+    fp.write("\n}")
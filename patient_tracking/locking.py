@@ -0,0 +1,70 @@
+"""Candados consultivos entre procesos para los motores basados en archivos."""
+from __future__ import annotations
+
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import ContextManager, Iterator, Optional
+
+try:  # pragma: no cover - depende de la plataforma
+    import fcntl
+except ImportError:  # pragma: no cover - Windows no tiene fcntl
+    fcntl = None  # type: ignore[assignment]
+
+
+class FileLock:
+    """Candado ``flock`` sobre un archivo ``.lock`` hermano del almacenamiento.
+
+    Se bloquea un archivo aparte porque el archivo de datos se reemplaza en cada
+    escritura atómica y cambiaría de inodo. Los bloqueos anidados dentro de uno
+    exclusivo no hacen nada; en plataformas sin ``fcntl`` el candado es un no-op.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._fd: Optional[int] = None
+        self._mode: Optional[int] = None
+        self._depth = 0
+
+    @property
+    def available(self) -> bool:
+        return fcntl is not None
+
+    @contextmanager
+    def _hold(self, mode: int) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        if self._depth and (self._mode == fcntl.LOCK_EX or mode == self._mode):
+            self._depth += 1
+            try:
+                yield
+            finally:
+                self._depth -= 1
+            return
+        if self._depth:
+            raise RuntimeError("No se puede pasar de un candado compartido a uno exclusivo.")
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, mode)
+        self._mode = mode
+        self._depth = 1
+        try:
+            yield
+        finally:
+            self._depth = 0
+            self._mode = None
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def shared(self) -> ContextManager[None]:
+        """Candado de lectura: varios procesos pueden tenerlo a la vez."""
+        return self._hold(fcntl.LOCK_SH if fcntl is not None else 0)
+
+    def exclusive(self) -> ContextManager[None]:
+        """Candado de escritura: excluye a lectores y escritores de otros procesos."""
+        return self._hold(fcntl.LOCK_EX if fcntl is not None else 0)
+
+    def close(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -4,7 +4,10 @@ from __future__ import annotations
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:  # pragma: no cover - solo para anotaciones
+    from .ratelimit import RateLimiter
 
 
 class MessagingChannel(str, Enum):
@@ -14,7 +17,7 @@ class MessagingChannel(str, Enum):
     SMS = "sms"
 
 
-@dataclass
+@dataclass(slots=True)
 class MessageRecord:
     """Mensaje que fue enviado a un paciente."""
 
@@ -34,15 +37,32 @@ class MessageRecord:
             sent_at=datetime.utcnow().isoformat(timespec="seconds"),
         )
 
+    @classmethod
+    def from_dict(cls, data: Dict) -> "MessageRecord":
+        return cls(
+            patient_id=data["patient_id"],
+            subject=data["subject"],
+            body=data["body"],
+            channel=MessagingChannel(data["channel"]),
+            sent_at=data["sent_at"],
+        )
+
 
 class MessagingService:
-    """Servicio simple que registra mensajes en memoria o almacenamiento externo."""
+    """Servicio simple que registra mensajes en memoria o almacenamiento externo.
+
+    Con ``rate_limiter`` (ver :class:`~patient_tracking.ratelimit.RateLimiter`)
+    cada envío espera su turno según los límites del canal y del paciente.
+    """
 
-    def __init__(self, storage: "StorageProtocol") -> None:
+    def __init__(self, storage: "StorageProtocol", rate_limiter: Optional["RateLimiter"] = None) -> None:
         self._storage = storage
+        self._rate_limiter = rate_limiter
 
     def send_message(self, patient_id: str, subject: str, body: str, channel: MessagingChannel) -> MessageRecord:
         """Enviar (simulado) un mensaje y guardarlo en el historial."""
+        if self._rate_limiter is not None:
+            self._rate_limiter.wait(MessagingChannel(channel).value, patient_id)
         record = MessageRecord.create(patient_id, subject, body, channel)
         self._storage.save_message(record)
         return record
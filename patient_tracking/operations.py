@@ -0,0 +1,201 @@
+"""Operaciones de dominio compartidas por la CLI y el modo por lotes."""
+from __future__ import annotations
+
+from datetime import date, datetime, timezone
+from typing import TYPE_CHECKING, Dict, Iterable, List, Mapping, Optional, Tuple
+
+from .messaging import MessageRecord, MessagingChannel, MessagingService
+from .ratelimit import RateLimiter
+from .storage import ConflictError, Patient, StorageBackend, ensure_patient, update_patient
+from .templates import compile_template, render_many, render_template
+from .workflow import WorkflowStage, get_stage
+
+if TYPE_CHECKING:  # pragma: no cover - solo para anotaciones
+    from .dispatch import Outbox, OutboxEntry
+
+
+class OperationError(Exception):
+    """Error esperado al aplicar una operación; el mensaje se muestra al usuario."""
+
+
+def parse_params(pairs: Iterable[str]) -> Dict[str, str]:
+    params: Dict[str, str] = {}
+    for pair in pairs:
+        if "=" not in pair:
+            raise ValueError(f"El parámetro '{pair}' no tiene el formato clave=valor")
+        key, value = pair.split("=", 1)
+        params[key] = value
+    return params
+
+
+def require_patient(storage: StorageBackend, patient_id: str) -> Patient:
+    patient = storage.get_patient(patient_id)
+    if not patient:
+        raise OperationError("Paciente no encontrado.")
+    return patient
+
+
+def register_patient(
+    storage: StorageBackend, patient_id: str, name: str, contact: str, channel: str = MessagingChannel.CHAT.value
+) -> Patient:
+    try:
+        return ensure_patient(storage, patient_id, name, contact, channel)
+    except (ValueError, ConflictError) as exc:
+        raise OperationError(str(exc)) from exc
+
+
+def set_stage(
+    storage: StorageBackend, patient_id: str, stage_id: int, completed: bool = True
+) -> Tuple[Patient, WorkflowStage]:
+    """Marcar una etapa del paciente y guardar el cambio, reintentando ante conflictos."""
+    require_patient(storage, patient_id)
+    try:
+        stage = get_stage(stage_id)
+    except ValueError as exc:
+        raise OperationError(str(exc)) from exc
+    try:
+        patient = update_patient(storage, patient_id, lambda current: current.mark_stage(stage.id, completed))
+    except ConflictError as exc:
+        raise OperationError(str(exc)) from exc
+    if patient is None:
+        raise OperationError("Paciente no encontrado.")
+    return patient, stage
+
+
+def schedule_surgery(storage: StorageBackend, patient_id: str, surgery_date: str) -> Patient:
+    """Registrar la fecha de cirugía (AAAA-MM-DD) del paciente; una cadena vacía la borra."""
+    require_patient(storage, patient_id)
+    if surgery_date:
+        try:
+            surgery_date = date.fromisoformat(surgery_date).isoformat()
+        except ValueError:
+            raise OperationError(f"Fecha de cirugía inválida: '{surgery_date}' (use AAAA-MM-DD).") from None
+
+    def apply(patient: Patient) -> None:
+        patient.surgery_date = surgery_date
+
+    try:
+        patient = update_patient(storage, patient_id, apply)
+    except ConflictError as exc:
+        raise OperationError(str(exc)) from exc
+    if patient is None:
+        raise OperationError("Paciente no encontrado.")
+    return patient
+
+
+def message_history(
+    storage: StorageBackend, patient_id: str, limit: Optional[int] = None, since: Optional[str] = None
+) -> List[MessageRecord]:
+    """Últimos ``limit`` mensajes del paciente desde ``since`` (fecha u hora ISO; con zona se pasa a UTC)."""
+    require_patient(storage, patient_id)
+    if limit is not None and limit < 0:
+        raise OperationError("El límite de mensajes no puede ser negativo.")
+    if since:
+        try:
+            parsed = datetime.fromisoformat(since)
+        except ValueError:
+            raise OperationError(f"Fecha inválida: '{since}' (use AAAA-MM-DD o AAAA-MM-DDTHH:MM:SS).") from None
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        since = parsed.isoformat(timespec="seconds")
+    return storage.message_history(patient_id, limit=limit or None, since=since or None)
+
+
+def compose_message(
+    patient: Patient,
+    subject: Optional[str] = None,
+    body: Optional[str] = None,
+    template: Optional[str] = None,
+    params: Optional[Mapping[str, str]] = None,
+) -> Tuple[str, str]:
+    """Obtener asunto y cuerpo a partir de una plantilla o de texto libre."""
+    if template:
+        try:
+            values = dict(params or {})
+            values.setdefault("name", patient.name)
+            rendered = render_template(template, **values)
+        except Exception as exc:  # pylint: disable=broad-except
+            raise OperationError(f"Error al usar la plantilla: {exc}") from exc
+        return rendered.subject, rendered.body
+    if not subject or not body:
+        raise OperationError("Debe proporcionar --subject y --body si no usa una plantilla.")
+    return subject, body
+
+
+def send_to_patient(
+    storage: StorageBackend,
+    patient_id: str,
+    channel: Optional[str] = None,
+    subject: Optional[str] = None,
+    body: Optional[str] = None,
+    template: Optional[str] = None,
+    params: Optional[Mapping[str, str]] = None,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> MessageRecord:
+    """Componer y enviar un mensaje usando el canal indicado o el preferido del paciente."""
+    patient = require_patient(storage, patient_id)
+    selected = _select_channel(patient, channel)
+    subject, body = compose_message(patient, subject, body, template, params)
+    return MessagingService(storage, rate_limiter).send_message(patient.patient_id, subject, body, selected)
+
+
+def _select_channel(patient: Patient, channel: Optional[str]) -> MessagingChannel:
+    try:
+        return MessagingChannel(channel or patient.preferred_channel.value)
+    except ValueError as exc:
+        raise OperationError(str(exc)) from exc
+
+
+def queue_message(
+    storage: StorageBackend,
+    outbox: Outbox,
+    patient_id: str,
+    channel: Optional[str] = None,
+    subject: Optional[str] = None,
+    body: Optional[str] = None,
+    template: Optional[str] = None,
+    params: Optional[Mapping[str, str]] = None,
+) -> OutboxEntry:
+    """Como :func:`send_to_patient`, pero deja el mensaje en la bandeja para ``despachar``."""
+    from .dispatch import OutboxEntry
+
+    patient = require_patient(storage, patient_id)
+    selected = _select_channel(patient, channel)
+    subject, body = compose_message(patient, subject, body, template, params)
+    entry = OutboxEntry.create(patient.patient_id, subject, body, selected)
+    outbox.enqueue([entry])
+    return entry
+
+
+def queue_campaign(
+    storage: StorageBackend,
+    outbox: Outbox,
+    template: str,
+    params: Optional[Mapping[str, str]] = None,
+    stage_id: Optional[int] = None,
+    state: str = "actual",
+    channel: Optional[str] = None,
+) -> int:
+    """Encolar una plantilla para todos los pacientes (o los de una etapa) con una sola escritura."""
+    from .dispatch import OutboxEntry
+
+    if stage_id is None:
+        patients = storage.iter_patients(include_messages=False)
+    else:
+        try:
+            patients = iter(storage.patients_at_stage(get_stage(stage_id).id, state))
+        except ValueError as exc:
+            raise OperationError(str(exc)) from exc
+    values = dict(params or {})
+    try:
+        # Se valida una vez para toda la campaña en lugar de fallar paciente por paciente.
+        compile_template(template).validate(set(values) | {"name"})
+    except (KeyError, ValueError) as exc:
+        raise OperationError(f"Error al usar la plantilla: {exc}") from exc
+    patients = list(patients)
+    rows = ({} if "name" in values else {"name": patient.name} for patient in patients)
+    entries = [
+        OutboxEntry.create(patient.patient_id, subject, body, _select_channel(patient, channel))
+        for patient, (subject, body) in zip(patients, render_many(template, rows, values))
+    ]
+    return outbox.enqueue(entries)
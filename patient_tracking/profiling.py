@@ -0,0 +1,322 @@
+"""Perfilado opcional de los comandos de la CLI (``--perfil``).
+
+Al activarse se envuelven con cronómetros los puntos donde se va el tiempo de un
+comando: la lectura y escritura del archivo JSON, la bitácora, las consultas
+principales de SQLite, la conversión de pacientes (``Patient.from_dict`` y
+``to_dict``) y ``MessagingService.send_message``. Cada fase acumula llamadas,
+tiempo total, tiempo propio (descontando las fases que llama) y bytes leídos o
+escritos. Sin ``--perfil`` no se envuelve nada.
+
+El resultado puede mostrarse como tabla en stderr, guardarse como salida de
+``cProfile`` y sumarse a un archivo de texto en formato Prometheus para el
+colector ``textfile`` de node exporter. Las mismas opciones se leen de las
+variables ``CLYNICO_PERFIL``, ``CLYNICO_PERFIL_CPROFILE`` y
+``CLYNICO_PERFIL_PROMETHEUS``.
+"""
+from __future__ import annotations
+
+import functools
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Mapping, Optional, TextIO, Tuple
+
+ENV_REPORT = "CLYNICO_PERFIL"
+ENV_CPROFILE = "CLYNICO_PERFIL_CPROFILE"
+ENV_PROMETHEUS = "CLYNICO_PERFIL_PROMETHEUS"
+
+_FALSE = {"", "0", "no", "false", "off"}
+_SAMPLE = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$")
+
+
+@dataclass
+class ProfileOptions:
+    """Qué hacer con las mediciones: tabla en stderr, archivo ``cProfile`` o métricas Prometheus."""
+
+    report: bool = False
+    cprofile: Optional[str] = None
+    prometheus: Optional[str] = None
+
+    @classmethod
+    def resolve(
+        cls,
+        report: bool = False,
+        cprofile: Optional[str] = None,
+        prometheus: Optional[str] = None,
+        environ: Mapping[str, str] = os.environ,
+    ) -> Optional["ProfileOptions"]:
+        """Combinar las opciones de la línea de comandos con las variables de entorno.
+
+        Devuelve ``None`` si el perfilado no se pidió de ninguna forma.
+        """
+        options = cls(
+            report=report or environ.get(ENV_REPORT, "").strip().lower() not in _FALSE,
+            cprofile=cprofile or environ.get(ENV_CPROFILE) or None,
+            prometheus=prometheus or environ.get(ENV_PROMETHEUS) or None,
+        )
+        if not (options.report or options.cprofile or options.prometheus):
+            return None
+        return options
+
+
+@dataclass
+class PhaseStats:
+    calls: int = 0
+    seconds: float = 0.0
+    self_seconds: float = 0.0
+    bytes: int = 0
+
+
+Measure = Tuple[Optional[Callable[[tuple], object]], Callable[[tuple, object], int]]
+
+
+class Profiler:
+    """Envuelve métodos con cronómetros y acumula :class:`PhaseStats` por fase."""
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, PhaseStats] = {}
+        self._local = threading.local()
+        self._patches: List[Tuple[type, str, object]] = []
+
+    def _wrap(self, label: str, function: Callable, measure: Optional[Measure]) -> Callable:
+        stats = self.phases.setdefault(label, PhaseStats())
+        local = self._local
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            # Pila por hilo con el tiempo de las fases hijas de cada llamada en curso.
+            stack = local.__dict__.setdefault("stack", [])
+            before = measure[0](args) if measure and measure[0] else None
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                children = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                stats.calls += 1
+                stats.seconds += elapsed
+                stats.self_seconds += elapsed - children
+                if measure:
+                    stats.bytes += measure[1](args, before)
+
+        return timed
+
+    def patch(self, owner: type, name: str, label: str, measure: Optional[Measure] = None) -> None:
+        original = owner.__dict__[name]
+        if isinstance(original, classmethod):
+            replacement: object = classmethod(self._wrap(label, original.__func__, measure))
+        else:
+            replacement = self._wrap(label, original, measure)
+        setattr(owner, name, replacement)
+        self._patches.append((owner, name, original))
+
+    def install(self) -> None:
+        """Instrumentar las fases conocidas de los motores, los pacientes y la mensajería."""
+        from .journal import JournalStorage
+        from .messaging import MessagingService
+        from .sqlite_storage import SQLiteStorage
+        from .storage import Patient, PatientStorage
+
+        def read_state(args: tuple) -> Optional[int]:
+            storage = args[0]
+            if storage._batch is not None or storage._pending is not None:
+                return None
+            return storage.cache_stats.misses if storage.cache_enabled else -1
+
+        def read_bytes(args: tuple, before: Optional[int]) -> int:
+            storage = args[0]
+            # Un acierto de caché no lee el archivo: solo cuenta si aumentaron los fallos.
+            if before is None or (before >= 0 and storage.cache_stats.misses == before):
+                return 0
+            return _size(storage.path)
+
+        self.patch(PatientStorage, "_read", "PatientStorage._read", (read_state, read_bytes))
+        file_size: Measure = (None, lambda args, _: _size(args[0].path))
+        self.patch(PatientStorage, "_write_file", "PatientStorage._write_file", file_size)
+        self.patch(JournalStorage, "_load_snapshot", "JournalStorage._load_snapshot", file_size)
+        self.patch(
+            JournalStorage,
+            "_replay",
+            "JournalStorage._replay",
+            (lambda args: args[0]._offset, lambda args, before: max(0, args[0]._offset - before)),
+        )
+        self.patch(JournalStorage, "_append", "JournalStorage._append")
+        self.patch(
+            JournalStorage,
+            "_flush",
+            "JournalStorage._flush",
+            (None, lambda args, _: sum(len(line.encode("utf-8")) for line in args[1])),
+        )
+        for name in ("get_patient", "_upsert", "save_message"):
+            self.patch(SQLiteStorage, name, f"SQLiteStorage.{name}")
+        self.patch(Patient, "from_dict", "Patient.from_dict")
+        self.patch(Patient, "to_dict", "Patient.to_dict")
+        self.patch(
+            MessagingService,
+            "send_message",
+            "MessagingService.send_message",
+            (None, lambda args, _: sum(len(str(text).encode("utf-8")) for text in args[2:4])),
+        )
+
+    def uninstall(self) -> None:
+        while self._patches:
+            owner, name, original = self._patches.pop()
+            setattr(owner, name, original)
+
+    def used(self) -> List[Tuple[str, PhaseStats]]:
+        """Fases con al menos una llamada, de mayor a menor tiempo propio."""
+        return sorted(
+            ((label, stats) for label, stats in self.phases.items() if stats.calls),
+            key=lambda item: item[1].self_seconds,
+            reverse=True,
+        )
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return 0
+
+
+def _format_bytes(count: int) -> str:
+    if not count:
+        return "-"
+    for unit in ("B", "KiB", "MiB"):
+        if count < 1024:
+            return f"{count:.0f} {unit}" if unit == "B" else f"{count:.1f} {unit}"
+        count /= 1024
+    return f"{count:.1f} GiB"
+
+
+def print_report(command: str, profiler: Profiler, total: float, stream: Optional[TextIO] = None) -> None:
+    """Tabla por fase; el tiempo propio descuenta las fases anidadas, así que suma como máximo el total."""
+    stream = stream or sys.stderr
+    print(f"Perfil de '{command}': {total * 1000:.1f} ms en total", file=stream)
+    print(f"  {'fase':<32} {'llamadas':>9} {'propio ms':>10} {'total ms':>10} {'%':>6} {'bytes':>10}", file=stream)
+    accounted = 0.0
+    for label, stats in profiler.used():
+        accounted += stats.self_seconds
+        share = 100 * stats.self_seconds / total if total else 0.0
+        print(
+            f"  {label:<32} {stats.calls:>9} {stats.self_seconds * 1000:>10.1f} {stats.seconds * 1000:>10.1f} "
+            f"{share:>5.1f}% {_format_bytes(stats.bytes):>10}",
+            file=stream,
+        )
+    rest = max(0.0, total - accounted)
+    share = 100 * rest / total if total else 0.0
+    print(f"  {'sin instrumentar':<32} {'':>9} {rest * 1000:>10.1f} {'':>10} {share:>5.1f}%", file=stream)
+
+
+_METRICS = {
+    "clynico_cli_runs_total": "Ejecuciones de cada comando de la CLI.",
+    "clynico_cli_seconds_total": "Tiempo total de cada comando de la CLI.",
+    "clynico_phase_calls_total": "Llamadas a cada fase instrumentada.",
+    "clynico_phase_seconds_total": "Tiempo de cada fase, incluidas las fases que llama.",
+    "clynico_phase_self_seconds_total": "Tiempo propio de cada fase, sin las fases que llama.",
+    "clynico_phase_bytes_total": "Bytes leídos o escritos por cada fase.",
+}
+
+
+def _labels(**labels: str) -> str:
+    pairs = []
+    for key, value in sorted(labels.items()):
+        escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _read_samples(path: Path) -> Dict[Tuple[str, str], float]:
+    samples: Dict[Tuple[str, str], float] = {}
+    try:
+        text = path.read_text(encoding="utf-8")
+    except FileNotFoundError:
+        return samples
+    for line in text.splitlines():
+        match = _SAMPLE.match(line)
+        if match and not line.startswith("#") and match.group(1) in _METRICS:
+            try:
+                samples[(match.group(1), match.group(2) or "")] = float(match.group(3))
+            except ValueError:
+                continue
+    return samples
+
+
+def export_prometheus(path: str | Path, command: str, profiler: Profiler, total: float) -> None:
+    """Sumar las mediciones a los contadores del archivo ``path`` (formato de texto de Prometheus).
+
+    Los contadores se acumulan entre ejecuciones, como espera ``rate()``. El
+    archivo se reemplaza de forma atómica para que node exporter nunca lea uno a
+    medio escribir; su nombre debe terminar en ``.prom``.
+    """
+    from .durability import atomic_write
+    from .locking import FileLock
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    increments: Dict[Tuple[str, str], float] = {
+        ("clynico_cli_runs_total", _labels(command=command)): 1,
+        ("clynico_cli_seconds_total", _labels(command=command)): total,
+    }
+    for label, stats in profiler.used():
+        labels = _labels(command=command, phase=label)
+        increments[("clynico_phase_calls_total", labels)] = stats.calls
+        increments[("clynico_phase_seconds_total", labels)] = stats.seconds
+        increments[("clynico_phase_self_seconds_total", labels)] = stats.self_seconds
+        if stats.bytes:
+            increments[("clynico_phase_bytes_total", labels)] = stats.bytes
+
+    lock = FileLock(path.with_name(path.name + ".lock"))
+    try:
+        with lock.exclusive():
+            samples = _read_samples(path)
+            for key, value in increments.items():
+                samples[key] = samples.get(key, 0.0) + value
+
+            def write(fp: TextIO) -> None:
+                for name, description in _METRICS.items():
+                    fp.write(f"# HELP {name} {description}\n# TYPE {name} counter\n")
+                    for (sample, labels), value in sorted(samples.items()):
+                        if sample == name:
+                            fp.write(f"{name}{labels} {value:.17g}\n")
+
+            atomic_write(path, write, sync=False)
+    finally:
+        lock.close()
+
+
+@contextmanager
+def profile_command(command: str, options: ProfileOptions) -> Iterator[Profiler]:
+    """Instrumentar el bloque y, al salir, mostrar o exportar lo medido según ``options``."""
+    profiler = Profiler()
+    profiler.install()
+    cprofile = None
+    if options.cprofile:
+        import cProfile
+
+        cprofile = cProfile.Profile()
+        cprofile.enable()
+    start = time.perf_counter()
+    try:
+        yield profiler
+    finally:
+        total = time.perf_counter() - start
+        if cprofile is not None:
+            cprofile.disable()
+        profiler.uninstall()
+        if options.report:
+            print_report(command, profiler, total)
+        if cprofile is not None:
+            cprofile.dump_stats(options.cprofile)
+            if options.report:
+                print(f"cProfile guardado en {options.cprofile} (ver con 'python -m pstats').", file=sys.stderr)
+        if options.prometheus:
+            export_prometheus(options.prometheus, command, profiler, total)
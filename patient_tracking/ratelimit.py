@@ -0,0 +1,135 @@
+"""Limitación de envíos por canal (token bucket) y separación mínima por paciente."""
+from __future__ import annotations
+
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Mapping, Optional, Tuple
+
+from .messaging import MessagingChannel
+
+
+class TokenBucket:
+    """Cubeta de fichas con reservas: ``rate`` fichas por segundo y hasta ``burst`` acumuladas.
+
+    :meth:`reserve` siempre toma la ficha y devuelve cuántos segundos hay que
+    esperar para usarla, de modo que varios solicitantes concurrentes obtienen
+    turnos sucesivos sin sondear. En lugar del saldo se guarda el instante
+    teórico en que la cubeta vuelve a estar vacía (GCRA): así se puede reservar
+    para un instante futuro ``at`` sin que las reservas lleguen en orden, y en
+    ninguna ventana de ``t`` segundos se conceden más de ``burst + rate * t``.
+    """
+
+    def __init__(
+        self, rate: float, burst: Optional[float] = None, clock: Callable[[], float] = time.monotonic
+    ) -> None:
+        if rate <= 0:
+            raise ValueError("La tasa del limitador debe ser mayor que cero.")
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self._clock = clock
+        self._theoretical = clock()
+
+    def reserve(self, tokens: float = 1.0, at: Optional[float] = None) -> float:
+        """Reservar ``tokens`` para usarlas desde ``at`` (por defecto, ahora); devuelve la espera desde ahora."""
+        now = self._clock()
+        at = now if at is None else max(now, at)
+        granted = max(at, self._theoretical - (self.capacity - tokens) / self.rate)
+        self._theoretical = max(self._theoretical, granted) + tokens / self.rate
+        return granted - now
+
+
+@dataclass
+class ChannelStats:
+    """Métricas de un canal: solicitudes, cuántas debieron esperar, envíos y segundos de espera."""
+
+    queued: int = 0
+    throttled: int = 0
+    sent: int = 0
+    waited: float = 0.0
+
+
+class RateLimiter:
+    """Limita los envíos por canal y, opcionalmente, la frecuencia por paciente.
+
+    ``patient_gap`` es la separación mínima en segundos entre mensajes al mismo
+    paciente. ``limits`` asocia cada canal (``"sms"``, ``"chat"``) a ``(tasa, ráfaga)``; los
+    canales sin límite solo se contabilizan. :meth:`wait` bloquea el hilo y
+    :meth:`acquire` es su equivalente para ``asyncio``.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Mapping[str, Tuple[float, Optional[float]]]] = None,
+        patient_gap: float = 0.0,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self._clock = clock
+        self._buckets: Dict[str, TokenBucket] = {
+            channel: TokenBucket(rate, burst, clock) for channel, (rate, burst) in (limits or {}).items()
+        }
+        self.patient_gap = patient_gap
+        self._next_slot: Dict[str, float] = {}
+        self.stats: Dict[str, ChannelStats] = {}
+
+    def _reserve(self, channel: str, patient_id: str) -> float:
+        """Reservar turno para un envío y devolver la espera necesaria en segundos."""
+        stats = self.stats.setdefault(channel, ChannelStats())
+        stats.queued += 1
+        now = self._clock()
+        send_at = now
+        if self.patient_gap > 0:
+            send_at = max(now, self._next_slot.get(patient_id, now))
+        bucket = self._buckets.get(channel)
+        if bucket is not None:
+            # La ficha del canal se reserva para el instante real del envío, después de
+            # la espera del paciente: varios pacientes cuya separación vence a la vez no
+            # salen juntos por encima de la ráfaga.
+            send_at = now + bucket.reserve(at=send_at)
+        if self.patient_gap > 0:
+            self._next_slot[patient_id] = send_at + self.patient_gap
+        delay = send_at - now
+        if delay > 0:
+            stats.throttled += 1
+            stats.waited += delay
+        return delay
+
+    def _granted(self, channel: str) -> None:
+        self.stats[channel].sent += 1
+
+    def wait(self, channel: str, patient_id: str) -> None:
+        delay = self._reserve(channel, patient_id)
+        if delay > 0:
+            time.sleep(delay)
+        self._granted(channel)
+
+    async def acquire(self, channel: str, patient_id: str) -> None:
+        # asyncio solo se importa aquí: la CLI usa ``wait`` y no debe pagar su carga al arrancar.
+        import asyncio
+
+        delay = self._reserve(channel, patient_id)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._granted(channel)
+
+
+def parse_limits(values: Iterable[str]) -> Dict[str, Tuple[float, Optional[float]]]:
+    """Interpretar límites ``canal=tasa`` o ``canal=tasa/ráfaga`` (tasa en mensajes por segundo)."""
+    limits: Dict[str, Tuple[float, Optional[float]]] = {}
+    for value in values:
+        channel, sep, spec = value.partition("=")
+        if not sep or not channel:
+            raise ValueError(f"El límite '{value}' no tiene el formato canal=tasa[/ráfaga].")
+        rate_text, _, burst_text = spec.partition("/")
+        try:
+            rate = float(rate_text)
+            burst = float(burst_text) if burst_text else None
+        except ValueError:
+            raise ValueError(f"El límite '{value}' no tiene el formato canal=tasa[/ráfaga].") from None
+        if rate <= 0 or (burst is not None and burst < 1):
+            raise ValueError(f"El límite '{value}' debe tener tasa positiva y ráfaga de al menos 1.")
+        try:
+            channel = MessagingChannel(channel.strip().lower()).value
+        except ValueError:
+            raise ValueError(f"Canal desconocido en el límite '{value}'.") from None
+        limits[channel] = (rate, burst)
+    return limits
@@ -0,0 +1,304 @@
+"""Programador de las etapas que dependen del tiempo.
+
+Dos etapas del flujo se disparan por fechas y no por una acción del operador:
+
+* Etapa 2, "Recordatorio 2-3 días": la plantilla ``recordatorio`` se envía
+  ``REMINDER_DELAY`` después de completar la etapa 1 y la etapa 2 queda completada.
+* Etapa 16, "Acompañamiento dieta pre": desde ``DIET_DAYS[0]`` días antes de la
+  fecha de cirugía se envía cada día ``acompanamiento_pre`` con su ``day_offset``;
+  el último mensaje completa la etapa.
+
+:class:`Scheduler` mantiene las acciones futuras en un heap ordenado por
+vencimiento, de modo que cada ciclo solo toca las vencidas. Las acciones ya
+ejecutadas se registran en ``<almacenamiento>.schedule`` para no repetirlas.
+"""
+from __future__ import annotations
+
+import heapq
+import itertools
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .durability import FsyncPolicy, fsync_file
+from .locking import FileLock
+from .operations import OperationError, send_to_patient, set_stage
+from .ratelimit import RateLimiter
+from .storage import Patient, StorageBackend
+
+REMINDER_DELAY = timedelta(days=2)
+DIET_DAYS = (-5, -4, -3, -2, -1)
+DIET_TIPS: Dict[int, str] = {
+    -5: "comenzar la dieta líquida indicada y tomar al menos 2 litros de agua",
+    -4: "mantener la dieta líquida y evitar bebidas con gas o azúcar",
+    -3: "preparar tus caldos y gelatinas sin azúcar para los próximos días",
+    -2: "revisar tus exámenes y documentos para el ingreso",
+    -1: "mantener ayuno desde la medianoche y llegar a la hora indicada",
+}
+
+_REMINDER_STAGE = 2
+_CONTACT_STAGE = 1
+_DIET_STAGE = 16
+_SURGERY_STAGE = 17
+
+
+@dataclass(frozen=True)
+class ScheduledAction:
+    """Mensaje programado para un paciente.
+
+    ``key`` identifica la acción (``recordatorio`` o ``dieta:<fecha>:<día>``);
+    ``expires`` indica hasta cuándo tiene sentido enviarla.
+    """
+
+    due: datetime
+    patient_id: str
+    key: str
+    template: str
+    params: Tuple[Tuple[str, str], ...] = ()
+    completes_stage: Optional[int] = None
+    expires: Optional[datetime] = None
+
+    @property
+    def state_key(self) -> str:
+        return f"{self.patient_id}/{self.key}"
+
+
+def plan_patient(patient: Patient, done: Set[str], hour: int = 9) -> List[ScheduledAction]:
+    """Acciones pendientes del paciente según sus etapas y su fecha de cirugía."""
+    actions: List[ScheduledAction] = []
+    contact_at = patient.stage_time(_CONTACT_STAGE)
+    if (
+        contact_at
+        and patient.is_stage_completed(_CONTACT_STAGE)
+        and not patient.is_stage_completed(_REMINDER_STAGE)
+    ):
+        actions.append(
+            ScheduledAction(
+                due=datetime.fromisoformat(contact_at) + REMINDER_DELAY,
+                patient_id=patient.patient_id,
+                key="recordatorio",
+                template="recordatorio",
+                completes_stage=_REMINDER_STAGE,
+            )
+        )
+    if (
+        patient.surgery_date
+        and not patient.is_stage_completed(_DIET_STAGE)
+        and not patient.is_stage_completed(_SURGERY_STAGE)
+    ):
+        surgery = date.fromisoformat(patient.surgery_date)
+        for offset in DIET_DAYS:
+            day = datetime.combine(surgery + timedelta(days=offset), datetime.min.time())
+            actions.append(
+                ScheduledAction(
+                    due=day + timedelta(hours=hour),
+                    patient_id=patient.patient_id,
+                    key=f"dieta:{patient.surgery_date}:{offset}",
+                    template="acompanamiento_pre",
+                    params=(("day_offset", str(offset)), ("daily_tip", DIET_TIPS[offset])),
+                    completes_stage=_DIET_STAGE if offset == DIET_DAYS[-1] else None,
+                    expires=day + timedelta(days=1),
+                )
+            )
+    return [action for action in actions if action.state_key not in done]
+
+
+class ScheduleState:
+    """Registro de solo anexado (JSONL) de las acciones ya ejecutadas u omitidas."""
+
+    def __init__(self, path: str | Path, fsync: str | FsyncPolicy | None = None) -> None:
+        self.path = Path(path)
+        self.fsync = FsyncPolicy.parse(fsync)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file_lock = FileLock(self.path.with_name(self.path.name + ".lock"))
+        self.done: Set[str] = set()
+        self._offset = 0
+
+    @classmethod
+    def beside(cls, storage_path: str | Path, fsync: str | FsyncPolicy | None = None) -> "ScheduleState":
+        storage_path = Path(storage_path)
+        return cls(storage_path.with_name(storage_path.name + ".schedule"), fsync=fsync)
+
+    def refresh(self) -> Set[str]:
+        """Leer las entradas agregadas desde la última lectura (por ejemplo, por otro proceso)."""
+        if not self.path.exists():
+            return self.done
+        with self._file_lock.shared(), self.path.open("rb") as fp:
+            fp.seek(self._offset)
+            for raw in fp:
+                if not raw.endswith(b"\n"):
+                    break
+                self._offset += len(raw)
+                self.done.add(json.loads(raw)["key"])
+        return self.done
+
+    def record(self, entries: Iterable[Tuple[str, str]]) -> None:
+        """Registrar pares ``(clave, resultado)`` con una sola escritura."""
+        now = datetime.utcnow().isoformat(timespec="seconds")
+        lines = [
+            json.dumps({"key": key, "result": result, "at": now}, ensure_ascii=False) + "\n" for key, result in entries
+        ]
+        if not lines:
+            return
+        with self._file_lock.exclusive():
+            self.refresh()
+            with self.path.open("ab") as fp:
+                data = "".join(lines).encode("utf-8")
+                fp.write(data)
+                if self.fsync.after_write():
+                    fp.flush()
+                    os.fsync(fp.fileno())
+            self._offset += len(data)
+        self.done.update(json.loads(line)["key"] for line in lines)
+
+    def close(self) -> None:
+        if self.fsync.on_close() and self.path.exists():
+            fsync_file(self.path)
+        self._file_lock.close()
+
+
+@dataclass
+class TickReport:
+    """Resultado de un ciclo del programador."""
+
+    sent: int = 0
+    skipped: int = 0
+    errors: List[str] = field(default_factory=list)
+
+
+class Scheduler:
+    """Heap de acciones programadas sobre un almacenamiento.
+
+    :meth:`rebuild` recorre todos los pacientes y arma el heap (O(n));
+    :meth:`run_due` solo extrae las acciones vencidas, revalida cada una contra
+    el paciente actual y las ejecuta en un único lote de escritura.
+    """
+
+    def __init__(
+        self,
+        storage: StorageBackend,
+        state: ScheduleState,
+        hour: int = 9,
+        rate_limiter: Optional[RateLimiter] = None,
+        clock: Callable[[], datetime] = datetime.utcnow,
+    ) -> None:
+        self.storage = storage
+        self.state = state
+        self.hour = hour
+        self.rate_limiter = rate_limiter
+        self.clock = clock
+        self._heap: List[Tuple[datetime, int, ScheduledAction]] = []
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _push(self, action: ScheduledAction) -> None:
+        heapq.heappush(self._heap, (action.due, next(self._counter), action))
+
+    def rebuild(self) -> int:
+        """Volver a planificar todas las acciones desde el almacenamiento."""
+        done = self.state.refresh()
+        entries = []
+        for patient in self.storage.iter_patients(include_messages=False):
+            try:
+                actions = plan_patient(patient, done, self.hour)
+            except ValueError:
+                # Fecha de cirugía o de etapa con formato inválido: el paciente se omite.
+                continue
+            entries.extend((action.due, next(self._counter), action) for action in actions)
+        heapq.heapify(entries)
+        self._heap = entries
+        return len(entries)
+
+    def next_due(self) -> Optional[datetime]:
+        return self._heap[0][0] if self._heap else None
+
+    def upcoming(self, limit: int = 10) -> List[ScheduledAction]:
+        return [action for _, _, action in heapq.nsmallest(limit, self._heap)]
+
+    def _current(self, action: ScheduledAction, done: Set[str]) -> Optional[ScheduledAction]:
+        """La misma acción recalculada con el estado actual del paciente, o ``None`` si ya no aplica."""
+        patient = self.storage.get_patient(action.patient_id)
+        if patient is None:
+            return None
+        for candidate in plan_patient(patient, done, self.hour):
+            if candidate.key == action.key:
+                return candidate
+        return None
+
+    def run_due(self, now: Optional[datetime] = None) -> TickReport:
+        """Ejecutar las acciones vencidas hasta ``now`` y registrarlas."""
+        now = now or self.clock()
+        report = TickReport()
+        results: List[Tuple[str, str]] = []
+        if not self._heap or self._heap[0][0] > now:
+            return report
+        done = self.state.refresh()
+        with self.storage.batch():
+            while self._heap and self._heap[0][0] <= now:
+                _, _, action = heapq.heappop(self._heap)
+                try:
+                    current = self._current(action, done)
+                except ValueError:
+                    current = None
+                if current is None:
+                    continue
+                if current.due > now:
+                    # Cambió la fecha (por ejemplo, se reprogramó la cirugía).
+                    self._push(current)
+                    continue
+                if current.expires is not None and current.expires <= now:
+                    report.skipped += 1
+                    results.append((current.state_key, "omitida"))
+                    continue
+                try:
+                    send_to_patient(
+                        self.storage,
+                        current.patient_id,
+                        template=current.template,
+                        params=dict(current.params),
+                        rate_limiter=self.rate_limiter,
+                    )
+                except OperationError as exc:
+                    report.errors.append(f"{current.state_key}: {exc}")
+                    continue
+                # El mensaje ya salió: se registra aunque falle la etapa, o el próximo ciclo lo repetiría.
+                report.sent += 1
+                results.append((current.state_key, "enviada"))
+                if current.completes_stage is not None:
+                    try:
+                        set_stage(self.storage, current.patient_id, current.completes_stage)
+                    except OperationError as exc:
+                        report.errors.append(f"{current.state_key}: etapa {current.completes_stage}: {exc}")
+        self.state.record(results)
+        return report
+
+    def run_forever(
+        self,
+        interval: float = 30.0,
+        rescan: float = 300.0,
+        on_tick: Optional[Callable[[TickReport], None]] = None,
+    ) -> None:
+        """Ciclo del demonio: ejecutar lo vencido y dormir hasta el próximo vencimiento.
+
+        Cada ``rescan`` segundos se replanifica desde el almacenamiento para
+        incorporar pacientes nuevos o cambios hechos por otros procesos.
+        """
+        next_rescan = 0.0
+        while True:
+            if time.monotonic() >= next_rescan:
+                self.rebuild()
+                next_rescan = time.monotonic() + rescan
+            report = self.run_due()
+            if on_tick is not None and (report.sent or report.skipped or report.errors):
+                on_tick(report)
+            sleep = min(interval, max(0.0, next_rescan - time.monotonic()))
+            due = self.next_due()
+            if due is not None:
+                sleep = min(sleep, max(0.0, (due - self.clock()).total_seconds()))
+            time.sleep(max(sleep, 0.1))
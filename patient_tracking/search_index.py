@@ -0,0 +1,211 @@
+"""Índice invertido de texto sobre pacientes y mensajes para el comando ``buscar``.
+
+El texto se normaliza (minúsculas, sin tildes ni diéresis, ``ñ`` → ``n``) y se
+divide en términos, descartando las palabras vacías más comunes del español.
+Cada paciente (nombre, contacto y notas) y cada mensaje (asunto y cuerpo) es un
+documento. Un término de la consulta coincide con los términos que empiezan por
+él y todos deben aparecer en el mismo documento; los resultados se ordenan por
+BM25. Un término numérico de al menos ``MIN_DIGITS`` cifras coincide además con
+los pacientes cuyo contacto lo contiene, sin importar espacios ni signos.
+"""
+from __future__ import annotations
+
+import bisect
+import heapq
+import math
+import re
+import unicodedata
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+MIN_DIGITS = 4
+STOPWORDS = frozenset(
+    "a al como con de del el en es esta la las le lo los me mi no o para por que se si su sus te tu un una y ya".split()
+)
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_NON_DIGITS = re.compile(r"\D+")
+_K1 = 1.2
+_B = 0.75
+
+
+def fold(text: str) -> str:
+    """Minúsculas y sin diacríticos (``"Endoscopía"`` → ``"endoscopia"``)."""
+    return unicodedata.normalize("NFKD", text.lower()).encode("ascii", "ignore").decode("ascii")
+
+
+@lru_cache(maxsize=8192)
+def tokenize(text: str) -> Tuple[str, ...]:
+    return tuple(token for token in _TOKEN.findall(fold(text)) if token not in STOPWORDS)
+
+
+def query_terms(query: str) -> Tuple[str, ...]:
+    """Términos distintos de la consulta; lanza ``ValueError`` si no queda ninguno."""
+    terms = tuple(dict.fromkeys(tokenize(query)))
+    if not terms:
+        raise ValueError("La búsqueda no contiene términos (se ignoran palabras como 'de' o 'la').")
+    return terms
+
+
+def _is_phone_fragment(term: str) -> bool:
+    return term.isdigit() and len(term) >= MIN_DIGITS
+
+
+def contact_digits(contact: str) -> str:
+    return _NON_DIGITS.sub("", contact)
+
+
+def contact_digit_suffixes(contact: str) -> str:
+    """Sufijos de los dígitos del contacto separados por espacios: un fragmento es prefijo de alguno."""
+    digits = contact_digits(contact)
+    return " ".join(digits[start:] for start in range(len(digits) - MIN_DIGITS + 1))
+
+
+def _idf(matches: int, documents: int) -> float:
+    return math.log(1 + (documents - matches + 0.5) / (matches + 0.5))
+
+
+@dataclass(frozen=True)
+class SearchHit:
+    """Resultado de una búsqueda: un paciente o uno de sus mensajes (``sent_at`` y ``subject``)."""
+
+    patient_id: str
+    name: str
+    score: float
+    sent_at: Optional[str] = None
+    subject: Optional[str] = None
+
+    @property
+    def kind(self) -> str:
+        return "paciente" if self.sent_at is None else "mensaje"
+
+
+class SearchIndex:
+    """Listas de documentos por término, mantenidas incrementalmente.
+
+    Las listas son arreglos de solo anexado; al cambiar los datos de un paciente
+    su documento anterior se marca como eliminado y se agrega uno nuevo. Los
+    mensajes solo se agregan, igual que en el almacenamiento.
+    """
+
+    def __init__(self) -> None:
+        self._postings: Dict[str, Tuple[array, array]] = {}
+        self._vocabulary: List[str] = []
+        self._vocabulary_sorted = True
+        self._doc_patient: List[str] = []
+        self._doc_message: List[Optional[Tuple[str, str]]] = []
+        self._doc_length = array("I")
+        self._dead: Set[int] = set()
+        self._live_length = 0
+        self._patient_doc: Dict[str, int] = {}
+        self._patient_fields: Dict[str, Tuple[str, str, str]] = {}
+        self._contact_digits: Dict[str, str] = {}
+
+    @classmethod
+    def build(cls, patients: Iterable[Tuple[Dict, Iterable[Dict]]]) -> "SearchIndex":
+        """Construir el índice a partir de pares ``(paciente serializado, sus mensajes serializados)``."""
+        index = cls()
+        for payload, messages in patients:
+            patient_id = payload["patient_id"]
+            index.update_patient(patient_id, payload["name"], payload["contact"], payload.get("notes", ""))
+            for message in messages:
+                index.add_message(patient_id, message["subject"], message["body"], message["sent_at"])
+        return index
+
+    def __len__(self) -> int:
+        return len(self._doc_patient) - len(self._dead)
+
+    def _add(self, patient_id: str, terms: Iterable[str], message: Optional[Tuple[str, str]]) -> int:
+        doc = len(self._doc_patient)
+        counts = Counter(terms)
+        length = sum(counts.values())
+        self._doc_patient.append(patient_id)
+        self._doc_message.append(message)
+        self._doc_length.append(length)
+        self._live_length += length
+        for term, count in counts.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array("I"), array("I"))
+                self._vocabulary.append(term)
+                self._vocabulary_sorted = False
+            postings[0].append(doc)
+            postings[1].append(count)
+        return doc
+
+    def update_patient(self, patient_id: str, name: str, contact: str, notes: str = "") -> None:
+        """Indexar los datos del paciente; si no cambiaron no se hace nada."""
+        fields = (name, contact, notes)
+        if self._patient_fields.get(patient_id) == fields:
+            return
+        previous = self._patient_doc.get(patient_id)
+        if previous is not None:
+            self._dead.add(previous)
+            self._live_length -= self._doc_length[previous]
+        self._patient_fields[patient_id] = fields
+        self._contact_digits[patient_id] = contact_digits(contact)
+        self._patient_doc[patient_id] = self._add(
+            patient_id, tokenize(name) + tokenize(contact) + tokenize(notes), None
+        )
+
+    def add_message(self, patient_id: str, subject: str, body: str, sent_at: str) -> None:
+        self._add(patient_id, tokenize(subject) + tokenize(body), (sent_at, subject))
+
+    def _expand(self, term: str) -> List[str]:
+        """Términos del vocabulario que empiezan por ``term``."""
+        if not self._vocabulary_sorted:
+            # Los términos nuevos quedan al final: ordenar una lista casi ordenada es lineal.
+            self._vocabulary.sort()
+            self._vocabulary_sorted = True
+        vocabulary = self._vocabulary
+        position = bisect.bisect_left(vocabulary, term)
+        matches = []
+        while position < len(vocabulary) and vocabulary[position].startswith(term):
+            matches.append(vocabulary[position])
+            position += 1
+        return matches
+
+    def search(self, query: str, limit: int = 20) -> List[SearchHit]:
+        """Los ``limit`` documentos con mayor puntaje BM25 que contienen todos los términos."""
+        terms = query_terms(query)
+        documents = len(self)
+        if not documents:
+            return []
+        average = self._live_length / documents or 1.0
+        expanded = [(term, self._expand(term)) for term in terms]
+        # Los términos con menos coincidencias primero: acotan los candidatos del resto.
+        expanded.sort(key=lambda item: sum(len(self._postings[word][0]) for word in item[1]))
+        scores: Optional[Dict[int, float]] = None
+        for term, words in expanded:
+            matched: Dict[int, float] = {}
+            for word in words:
+                docs, counts = self._postings[word]
+                idf = _idf(len(docs), documents)
+                for doc, count in zip(docs, counts):
+                    if (scores is not None and doc not in scores) or doc in self._dead:
+                        continue
+                    norm = _K1 * (1 - _B + _B * self._doc_length[doc] / average)
+                    matched[doc] = matched.get(doc, 0.0) + idf * count * (_K1 + 1) / (count + norm)
+            if _is_phone_fragment(term):
+                patients = [pid for pid, digits in self._contact_digits.items() if term in digits]
+                idf = _idf(len(patients), documents)
+                for patient_id in patients:
+                    doc = self._patient_doc[patient_id]
+                    if scores is None or doc in scores:
+                        matched[doc] = max(matched.get(doc, 0.0), idf)
+            scores = matched if scores is None else {doc: scores[doc] + weight for doc, weight in matched.items()}
+            if not scores:
+                return []
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        return [self._hit(doc, score) for doc, score in best]
+
+    def _hit(self, doc: int, score: float) -> SearchHit:
+        patient_id = self._doc_patient[doc]
+        name = self._patient_fields.get(patient_id, ("",))[0]
+        message = self._doc_message[doc]
+        if message is None:
+            return SearchHit(patient_id, name, score)
+        return SearchHit(patient_id, name, score, sent_at=message[0], subject=message[1])
@@ -0,0 +1,300 @@
+"""Servicio HTTP/JSON de larga duración sobre el almacenamiento de pacientes.
+
+El motor se abre una vez y queda en memoria (con su caché caliente) mientras el
+servicio corre, en lugar de pagar el arranque de Python y la lectura completa del
+almacenamiento por cada invocación de la CLI. Se usa ``http.server`` con HTTP/1.1,
+de modo que los clientes reutilizan la conexión (keep-alive); cada conexión se
+atiende en su propio hilo y el acceso al almacenamiento se serializa con un candado.
+
+Rutas::
+
+    GET  /pacientes?etapa=N&estado=actual&limit=N&offset=N
+    POST /pacientes                      {"patient_id", "name", "contact", "channel"}
+    GET  /pacientes/<id>                 responde ETag; con If-None-Match igual devuelve 304
+    POST /pacientes/<id>/etapas          {"stage_id", "pendiente"}
+    POST /pacientes/<id>/mensajes        {"template", "params"} o {"subject", "body"}; "channel" opcional
+    GET  /pacientes/<id>/mensajes?limit=N&desde=FECHA
+    POST /lote                           lista de operaciones con el formato del comando ``lote``
+
+Los errores se responden como ``{"error": "..."}`` con el código HTTP adecuado.
+Los envíos masivos siguen yendo por ``campana``/``despachar``: aquí no se aplica
+limitación de tasa para no retener el candado mientras se espera.
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import threading
+from dataclasses import asdict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from .batch import as_bool, run_batch
+from .messaging import MessageRecord
+from .operations import OperationError, message_history, register_patient, send_to_patient, set_stage
+from .storage import Patient, StorageBackend
+
+MAX_BODY = 10 * 1024 * 1024
+
+
+class ApiError(Exception):
+    """Error que se responde al cliente con ``status`` y un mensaje."""
+
+    def __init__(self, status: HTTPStatus, message: str) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+def patient_etag(patient: Patient) -> str:
+    """ETag del paciente: cambia con cada escritura porque ``version`` siempre aumenta.
+
+    Es un resumen del id y la versión: el id puede traer caracteres que no caben
+    en una cabecera HTTP (fuera de latin-1, comillas o saltos de línea).
+    """
+    digest = hashlib.sha1(f"{patient.patient_id}:{patient.version}".encode("utf-8")).hexdigest()
+    return f'"{digest}"'
+
+
+def _patient_json(patient: Patient) -> Dict:
+    data = patient.to_dict(include_messages=False)
+    data["current_stage"] = patient.current_stage()
+    return data
+
+
+def _int_param(query: Dict[str, List[str]], name: str, default: Optional[int] = None) -> Optional[int]:
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        value = int(values[-1])
+    except ValueError:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"El parámetro '{name}' debe ser un entero.") from None
+    if value < 0:
+        raise ApiError(HTTPStatus.BAD_REQUEST, f"El parámetro '{name}' no puede ser negativo.")
+    return value
+
+
+Response = Tuple[HTTPStatus, Optional[object], Dict[str, str]]
+
+
+class PatientApi:
+    """Lógica de las rutas, independiente del transporte HTTP."""
+
+    def __init__(self, storage: StorageBackend) -> None:
+        self.storage = storage
+        self.lock = threading.Lock()
+        self._routes: List[Tuple[str, re.Pattern, Callable[..., Response]]] = [
+            ("GET", re.compile(r"/pacientes"), self.list_patients),
+            ("POST", re.compile(r"/pacientes"), self.register),
+            ("GET", re.compile(r"/pacientes/([^/]+)"), self.show),
+            ("POST", re.compile(r"/pacientes/([^/]+)/etapas"), self.mark),
+            ("GET", re.compile(r"/pacientes/([^/]+)/mensajes"), self.history),
+            ("POST", re.compile(r"/pacientes/([^/]+)/mensajes"), self.send),
+            ("POST", re.compile(r"/lote"), self.batch),
+        ]
+
+    def handle(
+        self, method: str, target: str, headers: Dict[str, str], body: Optional[object]
+    ) -> Response:
+        parts = urlsplit(target)
+        path = parts.path.rstrip("/") or "/"
+        allowed = False
+        for route_method, pattern, handler in self._routes:
+            match = pattern.fullmatch(path)
+            if match is None:
+                continue
+            allowed = True
+            if route_method == method:
+                args = [unquote(group) for group in match.groups()]
+                with self.lock:
+                    return handler(*args, query=parse_qs(parts.query), headers=headers, body=body)
+        if allowed:
+            raise ApiError(HTTPStatus.METHOD_NOT_ALLOWED, f"Método {method} no permitido en {path}.")
+        raise ApiError(HTTPStatus.NOT_FOUND, f"Ruta desconocida: {path}.")
+
+    def _require(self, patient_id: str) -> Patient:
+        patient = self.storage.get_patient(patient_id)
+        if patient is None:
+            raise ApiError(HTTPStatus.NOT_FOUND, "Paciente no encontrado.")
+        return patient
+
+    @staticmethod
+    def _object(body: Optional[object]) -> Dict:
+        if not isinstance(body, dict):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "Se esperaba un objeto JSON en el cuerpo.")
+        return body
+
+    @staticmethod
+    def _field(body: Dict, name: str) -> str:
+        if name not in body:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"Falta el campo '{name}'.")
+        return str(body[name])
+
+    def _patient_response(self, patient: Patient, status: HTTPStatus = HTTPStatus.OK) -> Response:
+        return status, _patient_json(patient), {"ETag": patient_etag(patient)}
+
+    # -- rutas ------------------------------------------------------------------
+
+    def list_patients(self, query: Dict[str, List[str]], **_: object) -> Response:
+        limit = _int_param(query, "limit")
+        offset = _int_param(query, "offset", 0)
+        stage_id = _int_param(query, "etapa")
+        if stage_id is not None:
+            state = query.get("estado", ["actual"])[-1]
+            try:
+                patients = iter(self.storage.patients_at_stage(stage_id, state))
+            except ValueError as exc:
+                raise ApiError(HTTPStatus.BAD_REQUEST, str(exc)) from exc
+        else:
+            patients = self.storage.iter_patients(include_messages=False)
+        stop = None if limit is None else offset + limit
+        return HTTPStatus.OK, {"patients": [_patient_json(p) for p in islice(patients, offset, stop)]}, {}
+
+    def register(self, body: Optional[object], **_: object) -> Response:
+        data = self._object(body)
+        existed = self.storage.get_patient(self._field(data, "patient_id")) is not None
+        patient = register_patient(
+            self.storage,
+            self._field(data, "patient_id"),
+            self._field(data, "name"),
+            self._field(data, "contact"),
+            str(data.get("channel") or "chat"),
+        )
+        return self._patient_response(patient, HTTPStatus.OK if existed else HTTPStatus.CREATED)
+
+    def show(self, patient_id: str, headers: Dict[str, str], **_: object) -> Response:
+        patient = self._require(patient_id)
+        etag = patient_etag(patient)
+        # If-None-Match usa comparación débil: se ignora el prefijo ``W/``.
+        candidates = {tag.strip().removeprefix("W/") for tag in headers.get("if-none-match", "").split(",")}
+        if etag in candidates or "*" in candidates:
+            return HTTPStatus.NOT_MODIFIED, None, {"ETag": etag}
+        return self._patient_response(patient)
+
+    def mark(self, patient_id: str, body: Optional[object], **_: object) -> Response:
+        data = self._object(body)
+        self._require(patient_id)
+        try:
+            stage_id = int(self._field(data, "stage_id"))
+        except ValueError:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"Etapa inválida: '{data['stage_id']}'.") from None
+        patient, _stage = set_stage(self.storage, patient_id, stage_id, not as_bool(data.get("pendiente", False)))
+        return self._patient_response(patient)
+
+    def history(self, patient_id: str, query: Dict[str, List[str]], **_: object) -> Response:
+        self._require(patient_id)
+        since = query.get("desde", [None])[-1]
+        messages = message_history(self.storage, patient_id, limit=_int_param(query, "limit"), since=since)
+        return HTTPStatus.OK, {"messages": [_message_json(message) for message in messages]}, {}
+
+    def send(self, patient_id: str, body: Optional[object], **_: object) -> Response:
+        data = self._object(body)
+        self._require(patient_id)
+        params = data.get("params") or {}
+        if not isinstance(params, dict):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "'params' debe ser un objeto JSON.")
+        message = send_to_patient(
+            self.storage,
+            patient_id,
+            channel=data.get("channel"),
+            subject=data.get("subject"),
+            body=data.get("body"),
+            template=data.get("template"),
+            params={str(key): str(value) for key, value in params.items()},
+        )
+        return HTTPStatus.CREATED, _message_json(message), {}
+
+    def batch(self, body: Optional[object], **_: object) -> Response:
+        if not isinstance(body, list):
+            raise ApiError(HTTPStatus.BAD_REQUEST, "Se esperaba una lista de operaciones.")
+        operations = (
+            (number, operation if isinstance(operation, dict) else {"op": None, "error": "Se esperaba un objeto JSON"})
+            for number, operation in enumerate(body, start=1)
+        )
+        results = run_batch(self.storage, operations)
+        return HTTPStatus.OK, {"results": [asdict(result) for result in results]}, {}
+
+
+def _message_json(message: MessageRecord) -> Dict:
+    data = asdict(message)
+    data["channel"] = message.channel.value
+    return data
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Cabeceras y cuerpo se escriben por separado: sin TCP_NODELAY, Nagle y el ACK
+    # retardado del cliente agregan ~40 ms a cada respuesta en una conexión reutilizada.
+    disable_nagle_algorithm = True
+    server: "ApiServer"
+
+    def _dispatch(self, method: str) -> None:
+        try:
+            body = self._read_body()
+            status, payload, headers = self.server.api.handle(
+                method, self.path, {key.lower(): value for key, value in self.headers.items()}, body
+            )
+        except ApiError as exc:
+            status, payload, headers = exc.status, {"error": str(exc)}, {}
+        except (OperationError, ValueError) as exc:
+            status, payload, headers = HTTPStatus.BAD_REQUEST, {"error": str(exc)}, {}
+        except Exception as exc:  # pylint: disable=broad-except
+            self.log_error("Error inesperado en %s %s: %r", method, self.path, exc)
+            status, payload, headers = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "Error interno."}, {}
+        self._respond(status, payload, headers)
+
+    def _read_body(self) -> Optional[object]:
+        header = (self.headers.get("Content-Length") or "0").strip()
+        if not re.fullmatch(r"[0-9]+", header):
+            # Sin un largo válido no se sabe dónde termina el cuerpo: se cierra la conexión.
+            self.close_connection = True
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"Content-Length inválido: '{header}'.")
+        length = int(header)
+        if length > MAX_BODY:
+            # El cuerpo no se lee: la conexión no puede seguir usándose.
+            self.close_connection = True
+            raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "El cuerpo de la solicitud es demasiado grande.")
+        if not length:
+            return None
+        raw = self.rfile.read(length)
+        try:
+            return json.loads(raw)
+        except (json.JSONDecodeError, UnicodeDecodeError) as exc:
+            raise ApiError(HTTPStatus.BAD_REQUEST, f"JSON inválido: {exc}") from None
+
+    def _respond(self, status: HTTPStatus, payload: Optional[object], headers: Dict[str, str]) -> None:
+        data = b"" if payload is None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != HTTPStatus.NOT_MODIFIED:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if data:
+            self.wfile.write(data)
+
+    def do_GET(self) -> None:  # noqa: N802 - nombre exigido por http.server
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:  # noqa: N802
+        self._dispatch("POST")
+
+    def log_message(self, format: str, *args: object) -> None:  # pylint: disable=redefined-builtin
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ApiServer(ThreadingHTTPServer):
+    """Servidor HTTP con un hilo por conexión sobre una :class:`PatientApi`."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], storage: StorageBackend, verbose: bool = False) -> None:
+        super().__init__(address, _Handler)
+        self.api = PatientApi(storage)
+        self.verbose = verbose
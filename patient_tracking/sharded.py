@@ -0,0 +1,372 @@
+"""Almacenamiento JSON repartido en fragmentos según un hash del ``patient_id``.
+
+Con un único ``patients.json`` cada escritura reescribe a todos los pacientes.
+:class:`ShardedStorage` reparte los pacientes en N archivos con el formato de
+:class:`~patient_tracking.storage.PatientStorage` (``fragmento-G-NNN.json``), de
+modo que una escritura solo reescribe el fragmento del paciente. El archivo
+``layout.json`` del directorio indica cuántos fragmentos hay y su generación;
+:meth:`ShardedStorage.reshard` (``reparticionar`` en la CLI) cambia la cantidad
+escribiendo una generación nueva y reemplazando ``layout.json`` al final.
+"""
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+import zlib
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import ContextManager, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .changes import ChangeFeed
+from .durability import FsyncPolicy, atomic_write, fsync_directory
+from .jsonstream import dump_patients, iter_patient_payloads
+from .locking import FileLock
+from .messaging import MessageRecord
+from .stage_index import FunnelRow, StageIndex
+from .storage import Patient, PatientStorage, StorageBackend
+
+DEFAULT_SHARDS = 16
+LAYOUT_NAME = "layout.json"
+PARALLEL_CHOICES = ("hilos", "procesos")
+
+
+def shard_of(patient_id: str, shards: int) -> int:
+    """Fragmento de ``patient_id``; CRC-32 es estable entre procesos, a diferencia de ``hash()``."""
+    return zlib.crc32(patient_id.encode("utf-8")) % shards
+
+
+def _read_shard(path: str, include_messages: bool) -> List[Patient]:
+    # Se ejecuta en otro proceso: lee el archivo directamente, sin la caché del fragmento.
+    with open(path, "r", encoding="utf-8") as fp:
+        return [
+            Patient.from_dict(payload, include_messages=include_messages)
+            for payload in iter_patient_payloads(fp, skip_messages=not include_messages)
+        ]
+
+
+class ShardedStorage(StorageBackend):
+    """Motor que reparte los pacientes en fragmentos :class:`PatientStorage`.
+
+    ``path`` es ``<directorio>/layout.json``; los archivos auxiliares (bandeja de
+    salida, estado del programador) quedan en el mismo directorio. Cada fragmento
+    tiene su propio candado, caché e índices, así que el costo de una escritura
+    depende del tamaño del fragmento y no del total de pacientes. Todos los
+    fragmentos anotan sus eventos en un único ``layout.json.changes``.
+
+    ``list_patients`` e ``iter_patients`` leen los fragmentos en paralelo con
+    ``workers`` hilos o, con ``parallel="procesos"``, procesos (la decodificación
+    JSON no libera el GIL; con procesos el costo pasa a ser copiar los pacientes
+    de vuelta). ``iter_patients`` entrega un fragmento a la vez y solo adelanta
+    la lectura de ``workers`` fragmentos.
+
+    Cada operación toma un candado compartido sobre ``layout.json.lock`` y vuelve
+    a leer la distribución si cambió; :meth:`reshard` toma el exclusivo, de modo
+    que otros procesos esperan a que termine y luego usan los fragmentos nuevos.
+
+    Un lote toma el candado exclusivo de cada fragmento que usa y lo retiene hasta
+    terminar. Para que dos lotes no se bloqueen mutuamente (``flock`` no detecta
+    interbloqueos) los candados se toman siempre en orden ascendente de fragmento:
+    si el lote necesita uno menor que otro que ya retiene, escribe y suelta los
+    mayores y vuelve a tomarlos en orden. Por eso un lote solo es atómico por
+    fragmento: si el bloque falla se descartan los cambios pendientes de cada
+    fragmento, pero los que ya se escribieron al reordenar quedan guardados.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = "data/pacientes",
+        shards: int = DEFAULT_SHARDS,
+        fsync: str | FsyncPolicy | None = None,
+        workers: Optional[int] = None,
+        parallel: str = "hilos",
+    ) -> None:
+        if shards < 1:
+            raise ValueError("La cantidad de fragmentos debe ser al menos 1.")
+        if parallel not in PARALLEL_CHOICES:
+            raise ValueError(f"Modo paralelo desconocido: '{parallel}'.")
+        self.root = Path(path)
+        self.path = self.root / LAYOUT_NAME
+        self.fsync = fsync
+        self.workers = workers
+        self.parallel = parallel
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.change_feed = ChangeFeed.beside(self.path, fsync=fsync)
+        self._layout_lock = FileLock(self.root / (LAYOUT_NAME + ".lock"))
+        self._layout_key: Optional[Tuple[int, int, int]] = None
+        self._generation = 0
+        self._shards: List[Optional[PatientStorage]] = []
+        # Lotes de fragmento abiertos durante ``batch()``, por índice.
+        self._batch: Optional[Dict[int, ContextManager[None]]] = None
+        with self._layout_lock.exclusive():
+            if not self.path.exists():
+                self._write_layout(shards, 0)
+            self._refresh_layout()
+
+    # -- distribución ---------------------------------------------------------
+
+    @property
+    def shard_count(self) -> int:
+        return len(self._shards)
+
+    def shard_path(self, index: int, generation: Optional[int] = None) -> Path:
+        generation = self._generation if generation is None else generation
+        return self.root / f"fragmento-{generation}-{index:03d}.json"
+
+    def _write_layout(self, shards: int, generation: int) -> None:
+        layout = {"shards": shards, "generation": generation, "hash": "crc32"}
+        atomic_write(self.path, lambda fp: json.dump(layout, fp, indent=2))
+
+    def _refresh_layout(self) -> None:
+        """Volver a leer ``layout.json`` si otro proceso lo reemplazó; requiere el candado de distribución."""
+        stat = self.path.stat()
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key == self._layout_key:
+            return
+        layout = json.loads(self.path.read_text(encoding="utf-8"))
+        self._close_shards()
+        self._generation = layout["generation"]
+        self._shards = [None] * layout["shards"]
+        self._layout_key = key
+
+    @contextmanager
+    def _routing(self) -> Iterator[None]:
+        with self._layout_lock.shared():
+            if self._batch is None:
+                self._refresh_layout()
+            yield
+
+    def _open_shard(self, index: int) -> PatientStorage:
+        shard = self._shards[index]
+        if shard is None:
+            shard = PatientStorage(self.shard_path(index), fsync=self.fsync, changes=self.change_feed)
+            self._shards[index] = shard
+        return shard
+
+    def _shard(self, index: int) -> PatientStorage:
+        if self._batch is not None and index not in self._batch:
+            # Dentro de un lote cada fragmento entra al suyo la primera vez que se usa.
+            self._enter_batches([index])
+        return self._open_shard(index)
+
+    def _enter_batches(self, indexes: Iterable[int]) -> None:
+        """Entrar a los lotes de ``indexes`` tomando los candados en orden ascendente.
+
+        Los lotes ya abiertos de fragmentos mayores que el menor pedido se cierran
+        (escribiendo sus cambios) y se vuelven a abrir después de él.
+        """
+        needed = set(indexes) - set(self._batch)
+        if not needed:
+            return
+        lowest = min(needed)
+        reopen = sorted((index for index in self._batch if index > lowest), reverse=True)
+        for index in reopen:
+            self._batch.pop(index).__exit__(None, None, None)
+        for index in sorted(needed.union(reopen)):
+            context = self._open_shard(index).batch()
+            context.__enter__()
+            self._batch[index] = context
+
+    def _shard_for(self, patient_id: str) -> PatientStorage:
+        return self._shard(shard_of(patient_id, len(self._shards)))
+
+    def _all_shards(self) -> List[PatientStorage]:
+        if self._batch is not None:
+            self._enter_batches(range(len(self._shards)))
+        return [self._shard(index) for index in range(len(self._shards))]
+
+    def _close_shards(self) -> None:
+        for shard in self._shards:
+            if shard is not None:
+                shard.close()
+        self._shards = []
+
+    def _shard_streams(self, include_messages: bool) -> Iterator[Iterable[Patient]]:
+        """Pacientes de cada fragmento, en orden de fragmento.
+
+        Con más de un ``workers`` se leen por adelantado a lo sumo ``workers``
+        fragmentos, así que la memoria queda acotada por esos fragmentos y no por
+        el total. Los archivos se reemplazan de forma atómica y el candado de
+        distribución mantiene viva la generación, de modo que la lectura no
+        necesita el candado de cada fragmento.
+        """
+        shards = self._all_shards()
+        workers = min(len(shards), self.workers or os.cpu_count() or 1)
+        if workers <= 1 or self._batch is not None:
+            # En un lote cada fragmento retiene su ``RLock`` en este hilo.
+            for shard in shards:
+                yield shard.iter_patients(include_messages)
+            return
+        processes = self.parallel == "procesos"
+        pool: Executor = ProcessPoolExecutor(workers) if processes else ThreadPoolExecutor(workers)
+        with pool:
+            pending: Deque[Future] = deque()
+            for shard in shards:
+                if processes:
+                    pending.append(pool.submit(_read_shard, str(shard.path), include_messages))
+                else:
+                    # El generador se consume en el hilo del grupo.
+                    pending.append(pool.submit(list, shard.iter_patients(include_messages)))
+                if len(pending) > workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    # -- interfaz de StorageBackend ------------------------------------------
+
+    def list_patients(self) -> List[Patient]:
+        with self._routing():
+            return [patient for patients in self._shard_streams(True) for patient in patients]
+
+    def iter_patients(self, include_messages: bool = True) -> Iterator[Patient]:
+        # El candado de distribución se retiene mientras se recorre: un ``reshard``
+        # espera a que termine el recorrido en vez de borrar los fragmentos leídos.
+        with self._routing():
+            for patients in self._shard_streams(include_messages):
+                yield from patients
+
+    def get_patient(self, patient_id: str) -> Optional[Patient]:
+        with self._routing():
+            return self._shard_for(patient_id).get_patient(patient_id)
+
+    def save_patient(self, patient: Patient) -> None:
+        with self._routing():
+            self._shard_for(patient.patient_id).save_patient(patient)
+
+    def save_message(self, message: MessageRecord) -> None:
+        with self._routing():
+            self._shard_for(message.patient_id).save_message(message)
+
+    def message_history(
+        self, patient_id: str, limit: Optional[int] = None, since: Optional[str] = None
+    ) -> List[MessageRecord]:
+        with self._routing():
+            return self._shard_for(patient_id).message_history(patient_id, limit, since)
+
+    def import_patients(self, patients: Iterable[Patient]) -> int:
+        with self._routing():
+            groups: Dict[int, List[Patient]] = {}
+            for patient in patients:
+                groups.setdefault(shard_of(patient.patient_id, len(self._shards)), []).append(patient)
+            return sum(self._shard(index).import_patients(group) for index, group in sorted(groups.items()))
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Agrupar operaciones: cada fragmento tocado se escribe al terminar el bloque.
+
+        La atomicidad es por fragmento. Si el bloque usa un fragmento menor que
+        otro ya tomado, los mayores se escriben en ese momento para respetar el
+        orden de los candados, y una excepción posterior ya no los deshace.
+        """
+        if self._batch is not None:
+            yield
+            return
+        with self._layout_lock.shared():
+            self._refresh_layout()
+            self._batch = {}
+            with ExitStack() as stack:
+                stack.push(self._exit_batches)
+                yield
+
+    def _exit_batches(self, *exc_info: object) -> bool:
+        """Cerrar los lotes de fragmento abiertos: cada uno escribe, o descarta si el bloque falló."""
+        batches, self._batch = self._batch or {}, None
+        stack = ExitStack()
+        for index in sorted(batches):
+            stack.push(batches[index])
+        return stack.__exit__(*exc_info)
+
+    def stage_index(self) -> StageIndex:
+        with self._routing():
+            indexes = [shard.stage_index() for shard in self._all_shards()]
+        return StageIndex.build(entry for index in indexes for entry in index.entries())
+
+    def patients_at_stage(self, stage_id: int, state: str = "actual") -> List[Patient]:
+        with self._routing():
+            patients = [
+                patient for shard in self._all_shards() for patient in shard.patients_at_stage(stage_id, state)
+            ]
+        return sorted(patients, key=lambda patient: patient.patient_id)
+
+    def stage_funnel(self) -> List[FunnelRow]:
+        with self._routing():
+            funnels = [shard.stage_funnel() for shard in self._all_shards()]
+        return [
+            FunnelRow(
+                stage=rows[0].stage,
+                completed=sum(row.completed for row in rows),
+                current=sum(row.current for row in rows),
+                pending=sum(row.pending for row in rows),
+            )
+            for rows in zip(*funnels)
+        ]
+
+    def close(self) -> None:
+        self._close_shards()
+        self.change_feed.close()
+        self._layout_lock.close()
+
+    # -- reparticionar --------------------------------------------------------
+
+    def reshard(self, shards: int) -> Tuple[int, int]:
+        """Repartir a todos los pacientes en ``shards`` fragmentos y devolver ``(pacientes, fragmentos anteriores)``.
+
+        Los registros se copian tal como están en disco (con historial y
+        ``version``) y no generan eventos de cambio. La nueva generación se escribe completa antes de reemplazar
+        ``layout.json``; si el proceso se interrumpe antes, la distribución
+        anterior sigue vigente y los archivos a medias se borran en el próximo intento.
+        """
+        if shards < 1:
+            raise ValueError("La cantidad de fragmentos debe ser al menos 1.")
+        with self._layout_lock.exclusive():
+            self._refresh_layout()
+            previous, generation = len(self._shards), self._generation
+            old_paths = [self.shard_path(index) for index in range(previous)]
+            self._remove_stale(keep=set(old_paths))
+            sync = FsyncPolicy.parse(self.fsync).mode != "never"
+            count = 0
+            # Primero se reparten los registros en un archivo temporal por fragmento
+            # nuevo (una línea JSON cada uno) y luego se escribe cada fragmento desde
+            # el suyo: en memoria nunca hay más que un registro a la vez.
+            with tempfile.TemporaryDirectory(dir=self.root, prefix=".reparto-") as tmp, ExitStack() as parts_stack:
+                parts = [
+                    parts_stack.enter_context(open(Path(tmp) / f"{index:03d}.jsonl", "w+", encoding="utf-8"))
+                    for index in range(shards)
+                ]
+                for shard in self._all_shards():
+                    with shard._file_lock.shared(), shard.path.open("r", encoding="utf-8") as fp:
+                        for payload in iter_patient_payloads(fp):
+                            parts[shard_of(payload["patient_id"], shards)].write(
+                                json.dumps(payload, ensure_ascii=False) + "\n"
+                            )
+                            count += 1
+                for index, part in enumerate(parts):
+                    part.seek(0)
+                    atomic_write(
+                        self.shard_path(index, generation + 1),
+                        lambda fp, part=part: dump_patients(
+                            fp, ((payload["patient_id"], payload) for payload in map(json.loads, part))
+                        ),
+                        sync=sync,
+                    )
+            self._write_layout(shards, generation + 1)
+            if sync:
+                fsync_directory(self.root)
+            self._refresh_layout()
+            self._remove_stale(keep={self.shard_path(index) for index in range(shards)})
+        return count, previous
+
+    def _remove_stale(self, keep: set) -> None:
+        """Borrar fragmentos (y sus candados) que no pertenecen a la distribución ``keep``.
+
+        También se borran los temporales de un ``reshard`` interrumpido.
+        """
+        for tmp in self.root.glob(".reparto-*"):
+            shutil.rmtree(tmp, ignore_errors=True)
+        for path in self.root.glob("fragmento-*.json"):
+            if path not in keep:
+                path.unlink()
+                path.with_name(path.name + ".lock").unlink(missing_ok=True)
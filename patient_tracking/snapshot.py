@@ -0,0 +1,362 @@
+"""Instantánea binaria de pacientes con índice, pensada para abrirse con ``mmap``.
+
+El documento JSON con sangría ocupa cerca del doble que sus datos y hay que
+decodificarlo entero antes de responder cualquier consulta. La instantánea
+binaria guarda lo mismo en secciones de posición fija::
+
+    cabecera   MAGIC, versión, cantidad y desplazamiento de cada sección (HEADER)
+    registros  un paciente por registro, JSON compacto en UTF-8, de largo variable
+    claves     los ``patient_id`` en UTF-8, uno tras otro
+    índice     por paciente, en orden de inserción: desplazamiento y largo del
+               registro y de su clave (ENTRY)
+    orden      números de entrada del índice ordenados por clave (``uint32``)
+    extra      JSON con las claves del documento distintas de ``patients``
+
+Al abrirla solo se leen la cabecera y ``extra``; ``get_patient`` busca la clave
+con una búsqueda binaria sobre la sección ``orden`` y decodifica un único
+registro. Al reescribir el archivo, los registros que no se tocaron se copian
+byte a byte sin volver a codificarlos.
+
+Los enteros son little-endian. ``convertir`` pasa un almacenamiento entre este
+formato y el JSON tradicional.
+"""
+from __future__ import annotations
+
+import json
+import mmap
+import shutil
+import struct
+from collections.abc import MutableMapping
+from pathlib import Path
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .durability import atomic_write
+from .jsonstream import dump_patients
+from .locking import FileLock
+from .storage import Patient, PatientStorage
+
+MAGIC = b"CLYNSNAP"
+VERSION = 1
+# MAGIC, versión, reservado, pacientes, y desplazamientos de índice, orden, claves y extra.
+HEADER = struct.Struct("<8sHHIQQQQ")
+# Desplazamiento y largo del registro; desplazamiento (dentro de la sección de claves) y largo de la clave.
+ENTRY = struct.Struct("<QIII")
+ORDER = struct.Struct("<I")
+SNAPSHOT_FORMATS = ("json", "binary")
+
+
+def encode_record(payload: Dict) -> bytes:
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class SnapshotReader:
+    """Vista de solo lectura de una instantánea mapeada en memoria.
+
+    El archivo se reemplaza entero en cada escritura, así que el mapa sigue
+    mostrando la versión que se abrió aunque otro proceso escriba después.
+    """
+
+    def __init__(self, path: str | Path) -> None:
+        self.path = Path(path)
+        with self.path.open("rb") as fp:
+            try:
+                self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # archivo vacío
+                self._map = b""
+        if len(self._map) < HEADER.size or self._map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{self.path}' no es una instantánea binaria de pacientes.")
+        _, version, _, self.count, self._index, self._order, self._keys, extra = HEADER.unpack_from(self._map)
+        if version != VERSION:
+            raise ValueError(f"Versión de instantánea no soportada en '{self.path}': {version}.")
+        self.extra: Dict = json.loads(self._map[extra:]) if extra < len(self._map) else {}
+
+    def _entry(self, number: int) -> Tuple[int, int, int, int]:
+        return ENTRY.unpack_from(self._map, self._index + number * ENTRY.size)
+
+    def _key(self, number: int) -> bytes:
+        _, _, key_offset, key_length = self._entry(number)
+        start = self._keys + key_offset
+        return self._map[start:start + key_length]
+
+    def find(self, patient_id: str) -> Optional[int]:
+        """Número de entrada de ``patient_id`` en el índice (búsqueda binaria), o ``None``."""
+        key = patient_id.encode("utf-8")
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            (number,) = ORDER.unpack_from(self._map, self._order + middle * ORDER.size)
+            found = self._key(number)
+            if found == key:
+                return number
+            if found < key:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def raw(self, patient_id: str) -> Optional[bytes]:
+        """Registro codificado de ``patient_id``, o ``None`` si no está."""
+        number = self.find(patient_id)
+        if number is None:
+            return None
+        offset, length, _, _ = self._entry(number)
+        return self._map[offset:offset + length]
+
+    def get(self, patient_id: str) -> Optional[Dict]:
+        raw = self.raw(patient_id)
+        return None if raw is None else json.loads(raw)
+
+    def keys(self) -> List[str]:
+        """Los ``patient_id`` en orden de inserción."""
+        return [self._key(number).decode("utf-8") for number in range(self.count)]
+
+    def records(self) -> Iterator[Tuple[str, bytes]]:
+        """Pares ``(patient_id, registro codificado)`` en orden de inserción."""
+        for number in range(self.count):
+            offset, length, key_offset, key_length = self._entry(number)
+            start = self._keys + key_offset
+            yield self._map[start:start + key_length].decode("utf-8"), self._map[offset:offset + length]
+
+
+class SnapshotPatients(MutableMapping):
+    """``data["patients"]`` de una instantánea: decodifica cada registro al pedirlo.
+
+    Los registros pedidos quedan decodificados (y pueden modificarse en el lugar,
+    como hace ``save_message``); los demás se escriben de vuelta sin decodificar.
+    """
+
+    def __init__(self, reader: Optional[SnapshotReader] = None) -> None:
+        self._reader = reader
+        self._decoded: Dict[str, Dict] = {}
+        self._deleted: Set[str] = set()
+        self._added: Dict[str, None] = {}  # claves que no están en el archivo, en orden de inserción
+
+    def _stored(self, patient_id: str) -> bool:
+        return self._reader is not None and self._reader.find(patient_id) is not None
+
+    def __getitem__(self, patient_id: str) -> Dict:
+        payload = self._decoded.get(patient_id)
+        if payload is not None:
+            return payload
+        if patient_id in self._deleted or self._reader is None:
+            raise KeyError(patient_id)
+        payload = self._reader.get(patient_id)
+        if payload is None:
+            raise KeyError(patient_id)
+        self._decoded[patient_id] = payload
+        return payload
+
+    def __setitem__(self, patient_id: str, payload: Dict) -> None:
+        if patient_id not in self._decoded and patient_id not in self._added and not self._stored(patient_id):
+            self._added[patient_id] = None
+        self._decoded[patient_id] = payload
+        self._deleted.discard(patient_id)
+
+    def __delitem__(self, patient_id: str) -> None:
+        if patient_id not in self:
+            raise KeyError(patient_id)
+        self._decoded.pop(patient_id, None)
+        if patient_id in self._added:
+            del self._added[patient_id]
+        else:
+            self._deleted.add(patient_id)
+
+    def __contains__(self, patient_id: object) -> bool:
+        if patient_id in self._decoded:
+            return True
+        return isinstance(patient_id, str) and patient_id not in self._deleted and self._stored(patient_id)
+
+    def __iter__(self) -> Iterator[str]:
+        if self._reader is not None:
+            for patient_id in self._reader.keys():
+                if patient_id not in self._deleted:
+                    yield patient_id
+        yield from list(self._added)
+
+    def __len__(self) -> int:
+        stored = self._reader.count if self._reader is not None else 0
+        return stored - len(self._deleted) + len(self._added)
+
+    def items(self) -> List[Tuple[str, Dict]]:  # type: ignore[override]
+        """Todos los pares en orden, decodificando en una pasada secuencial (sin buscar cada clave)."""
+        pairs: List[Tuple[str, Dict]] = []
+        if self._reader is not None:
+            for patient_id, raw in self._reader.records():
+                if patient_id in self._deleted:
+                    continue
+                payload = self._decoded.get(patient_id)
+                if payload is None:
+                    payload = self._decoded[patient_id] = json.loads(raw)
+                pairs.append((patient_id, payload))
+        pairs.extend((patient_id, self._decoded[patient_id]) for patient_id in self._added)
+        return pairs
+
+    def values(self) -> List[Dict]:  # type: ignore[override]
+        return [payload for _, payload in self.items()]
+
+    def payloads(self) -> Iterator[Dict]:
+        """Recorrer los registros en orden sin dejarlos decodificados en memoria.
+
+        Lo ya decodificado, borrado o agregado se toma al llamar, de modo que basta
+        con llamarla bajo el candado del almacenamiento.
+        """
+        decoded, deleted, added = dict(self._decoded), set(self._deleted), list(self._added)
+        reader = self._reader
+
+        def walk() -> Iterator[Dict]:
+            if reader is not None:
+                for patient_id, raw in reader.records():
+                    if patient_id not in deleted:
+                        payload = decoded.get(patient_id)
+                        yield payload if payload is not None else json.loads(raw)
+            for patient_id in added:
+                yield decoded[patient_id]
+
+        return walk()
+
+    def encoded(self) -> Iterator[Tuple[str, bytes]]:
+        """Pares ``(patient_id, registro codificado)``: los no decodificados se copian tal cual."""
+        if self._reader is not None:
+            for patient_id, raw in self._reader.records():
+                if patient_id in self._deleted:
+                    continue
+                payload = self._decoded.get(patient_id)
+                yield patient_id, raw if payload is None else encode_record(payload)
+        for patient_id in list(self._added):
+            yield patient_id, encode_record(self._decoded[patient_id])
+
+
+def write_snapshot(fp: IO[bytes], records: Iterable[Tuple[str, bytes]], extra: Optional[Dict] = None) -> int:
+    """Escribir una instantánea en ``fp`` (binario y con ``seek``); devuelve la cantidad de pacientes."""
+    fp.write(b"\0" * HEADER.size)
+    position = HEADER.size
+    keys: List[bytes] = []
+    entries: List[Tuple[int, int]] = []
+    for patient_id, raw in records:
+        fp.write(raw)
+        keys.append(patient_id.encode("utf-8"))
+        entries.append((position, len(raw)))
+        position += len(raw)
+    keys_offset = position
+    fp.write(b"".join(keys))
+    position += sum(len(key) for key in keys)
+    index_offset = position
+    key_offset = 0
+    index = bytearray()
+    for key, (offset, length) in zip(keys, entries):
+        index += ENTRY.pack(offset, length, key_offset, len(key))
+        key_offset += len(key)
+    fp.write(index)
+    position += len(index)
+    order_offset = position
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    fp.write(struct.pack(f"<{len(order)}I", *order))
+    position += len(order) * ORDER.size
+    extra_offset = position
+    if extra:
+        fp.write(json.dumps(extra, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    fp.seek(0)
+    fp.write(HEADER.pack(MAGIC, VERSION, 0, len(keys), index_offset, order_offset, keys_offset, extra_offset))
+    fp.seek(0, 2)
+    return len(keys)
+
+
+class BinaryStorage(PatientStorage):
+    """:class:`PatientStorage` sobre una instantánea binaria (``binary:///ruta``).
+
+    Conserva la semántica del almacenamiento JSON (candados, ``version``, lotes,
+    caché y registro de cambios); solo cambian la lectura, que mapea el archivo
+    y decodifica los pacientes a medida que se piden, y la escritura, que vuelve
+    a codificar únicamente los registros decodificados.
+    """
+
+    def __init__(self, path: str | Path = "data/patients.bin", **options) -> None:
+        super().__init__(path, **options)
+        if snapshot_format(self.path) != "binary":
+            raise ValueError(
+                f"'{self.path}' no es una instantánea binaria; conviértalo con 'convertir {self.path} DESTINO'."
+            )
+
+    def _load(self) -> Dict:
+        reader = SnapshotReader(self.path)
+        return {"patients": SnapshotPatients(reader), **reader.extra}
+
+    def _dump(self, data: Dict) -> None:
+        patients = data.get("patients", {})
+        if isinstance(patients, SnapshotPatients):
+            records = patients.encoded()
+        else:
+            records = ((patient_id, encode_record(payload)) for patient_id, payload in patients.items())
+        extra = {key: value for key, value in data.items() if key != "patients"}
+        sync = self.fsync.after_write()
+        atomic_write(self.path, lambda fp: write_snapshot(fp, records, extra), sync=sync, binary=True)
+
+    def iter_patients(self, include_messages: bool = True) -> Iterator[Patient]:
+        with self._lock:
+            patients = self._read().get("patients", {})
+            payloads = patients.payloads() if isinstance(patients, SnapshotPatients) else list(patients.values())
+        for payload in payloads:
+            yield Patient.from_dict(payload, include_messages=include_messages)
+
+
+def snapshot_format(path: str | Path) -> str:
+    """``"binary"`` si ``path`` empieza con la firma de la instantánea, ``"json"`` si no."""
+    with Path(path).open("rb") as fp:
+        return "binary" if fp.read(len(MAGIC)) == MAGIC else "json"
+
+
+def convert_snapshot(source: str | Path, target: str | Path, fmt: Optional[str] = None) -> Tuple[str, int]:
+    """Copiar el almacenamiento ``source`` a ``target`` en formato ``fmt`` (por defecto, el otro).
+
+    Se conservan los registros tal cual (``version`` e historial incluidos) y las
+    claves extra del documento. Si ``target`` aún no tiene registro de cambios se
+    copia el de ``source``, para que los cursores de ``exportar`` sigan valiendo.
+    Devuelve ``(formato escrito, cantidad de pacientes)``.
+    """
+    source, target = Path(source), Path(target)
+    if source.resolve() == target.resolve():
+        raise ValueError("El origen y el destino deben ser archivos distintos.")
+    source_format = snapshot_format(source)
+    fmt = fmt or ("json" if source_format == "binary" else "binary")
+    if fmt not in SNAPSHOT_FORMATS:
+        raise ValueError(f"Formato de instantánea desconocido: '{fmt}'.")
+    target.parent.mkdir(parents=True, exist_ok=True)
+    source_lock = FileLock(source.with_name(source.name + ".lock"))
+    target_lock = FileLock(target.with_name(target.name + ".lock"))
+    try:
+        with source_lock.shared(), target_lock.exclusive():
+            if source_format == "binary":
+                reader = SnapshotReader(source)
+                extra = reader.extra
+                records: Iterable[Tuple[str, bytes]] = reader.records()
+            else:
+                try:
+                    with source.open("r", encoding="utf-8") as fp:
+                        document = json.load(fp)
+                except json.JSONDecodeError as exc:
+                    raise ValueError(f"'{source}' no es un almacenamiento JSON válido: {exc.msg}.") from None
+                if not isinstance(document, dict) or not isinstance(document.get("patients", {}), dict):
+                    raise ValueError(f"'{source}' no es un almacenamiento JSON de pacientes.")
+                patients = document.pop("patients", {})
+                extra = document
+                records = ((patient_id, encode_record(payload)) for patient_id, payload in patients.items())
+            count = 0
+
+            def counted() -> Iterator[Tuple[str, bytes]]:
+                nonlocal count
+                for count, record in enumerate(records, start=1):
+                    yield record
+
+            if fmt == "binary":
+                atomic_write(target, lambda fp: write_snapshot(fp, counted(), extra), binary=True)
+            else:
+                decoded = ((patient_id, json.loads(raw)) for patient_id, raw in counted())
+                atomic_write(target, lambda fp: dump_patients(fp, decoded, extra))
+            changes = source.with_name(source.name + ".changes")
+            target_changes = target.with_name(target.name + ".changes")
+            if changes.exists() and not target_changes.exists():
+                shutil.copyfile(changes, target_changes)
+    finally:
+        source_lock.close()
+        target_lock.close()
+    return fmt, count
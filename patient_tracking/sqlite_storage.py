@@ -0,0 +1,526 @@
+"""Almacenamiento de pacientes en SQLite con índices y escrituras incrementales."""
+from __future__ import annotations
+
+import json
+import sqlite3
+from contextlib import contextmanager
+from dataclasses import asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence
+
+from .changes import message_change, patient_changes
+from .durability import FsyncPolicy
+from .messaging import MessageRecord, MessagingChannel
+from .search_index import SearchHit, contact_digit_suffixes, query_terms
+from .stage_index import FunnelRow, STAGE_STATES
+from .storage import Patient, StorageBackend, check_version
+from .workflow import STAGES
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS patients (
+    patient_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    contact TEXT NOT NULL,
+    preferred_channel TEXT NOT NULL,
+    notes TEXT NOT NULL DEFAULT '',
+    surgery_date TEXT NOT NULL DEFAULT '',
+    version INTEGER NOT NULL DEFAULT 0,
+    current_stage INTEGER
+);
+CREATE TABLE IF NOT EXISTS stage_status (
+    patient_id TEXT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+    stage_id INTEGER NOT NULL,
+    completed INTEGER NOT NULL,
+    completed_at TEXT,
+    PRIMARY KEY (patient_id, stage_id)
+);
+CREATE INDEX IF NOT EXISTS idx_stage_status_stage ON stage_status (stage_id, completed);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    patient_id TEXT NOT NULL REFERENCES patients(patient_id) ON DELETE CASCADE,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    sent_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_patient ON messages (patient_id, sent_at);
+CREATE INDEX IF NOT EXISTS idx_messages_patient_id ON messages (patient_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_sent_at ON messages (sent_at);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    at TEXT NOT NULL,
+    op TEXT NOT NULL,
+    patient_id TEXT NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+# Índices de texto completo (FTS5); ``remove_diacritics 2`` normaliza igual que
+# :func:`~patient_tracking.search_index.fold`. Los mensajes usan la tabla ``messages``
+# como contenido externo y se mantienen con disparadores. ``patients_search`` se
+# mantiene desde ``_upsert`` porque su columna ``digits`` guarda los sufijos de los
+# dígitos del contacto: así un fragmento de teléfono se resuelve como prefijo. Cada
+# fila usa el ``rowid`` del paciente en ``patients``, de modo que reemplazarla es
+# una búsqueda por clave y no un recorrido de la columna ``patient_id`` (UNINDEXED).
+# Un ``VACUUM`` manual puede renumerar esos ``rowid``: después basta con
+# ``PRAGMA user_version = 0`` para que la próxima apertura rehaga el índice.
+_SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS patients_search USING fts5(
+    patient_id UNINDEXED, name, contact, notes, digits, tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_search USING fts5(
+    subject, body, content = 'messages', content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_search_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_search (rowid, subject, body) VALUES (new.id, new.subject, new.body);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_search_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_search (messages_search, rowid, subject, body)
+    VALUES ('delete', old.id, old.subject, old.body);
+END;
+"""
+
+# Objetos que crea ``_SEARCH_SCHEMA``, como ``(type, name)`` de ``sqlite_master``.
+_SEARCH_OBJECTS = frozenset(
+    {
+        ("table", "patients_search"),
+        ("table", "messages_search"),
+        ("trigger", "messages_search_insert"),
+        ("trigger", "messages_search_delete"),
+    }
+)
+
+# ``PRAGMA user_version`` desde el que ``patients_search`` usa el ``rowid`` de ``patients``.
+_SEARCH_VERSION = 1
+
+_PATIENT_COLUMNS = "patient_id, name, contact, preferred_channel, notes, version, surgery_date"
+
+# Equivalencia entre las políticas de fsync y ``PRAGMA synchronous`` en modo WAL.
+_SYNCHRONOUS = {"always": "FULL", "every": "NORMAL", "close": "NORMAL", "never": "OFF"}
+
+
+def _match_expression(terms: Sequence[str]) -> str:
+    """Consulta FTS5 en la que cada término debe aparecer como prefijo."""
+    return " AND ".join(f'"{term}"*' for term in terms)
+
+
+class SQLiteStorage(StorageBackend):
+    """Motor sobre ``sqlite3`` en modo WAL.
+
+    Cada paciente ocupa una fila y sus etapas y mensajes viven en tablas aparte,
+    por lo que leer o modificar un paciente no requiere procesar el resto.
+    Los mensajes son de solo anexado: ``get_patient`` no los lee y
+    :meth:`message_history` recorre el índice ``(patient_id, id)`` desde el final,
+    de modo que solo se leen las filas pedidas. ``import_patients`` agrega
+    únicamente los mensajes del paciente que aún no estén guardados. La columna ``version``
+    permite rechazar escrituras basadas en una lectura desactualizada.
+    Los eventos de cambio se insertan en la tabla ``changes`` en la misma
+    transacción que el cambio, y :meth:`changes_since` los lee por su clave.
+    """
+
+    def __init__(self, path: str | Path = "data/patients.db", fsync: str | FsyncPolicy | None = None) -> None:
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Las transacciones se abren explícitamente con BEGIN IMMEDIATE (ver ``_transaction``).
+        # La conexión puede usarse desde otros hilos siempre que el llamador serialice
+        # el acceso, como hace el servidor HTTP.
+        self._conn = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"PRAGMA synchronous={_SYNCHRONOUS[FsyncPolicy.parse(fsync).mode]}")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._in_batch = False
+        self._conn.executescript(_SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(patients)")}
+        if "version" not in columns:
+            # Bases creadas antes del control de versiones.
+            self._conn.execute("ALTER TABLE patients ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        if "surgery_date" not in columns:
+            # Bases creadas antes de registrar la fecha de cirugía.
+            self._conn.execute("ALTER TABLE patients ADD COLUMN surgery_date TEXT NOT NULL DEFAULT ''")
+        if "completed_at" not in {row[1] for row in self._conn.execute("PRAGMA table_info(stage_status)")}:
+            # Bases creadas antes de registrar la fecha de cada etapa.
+            self._conn.execute("ALTER TABLE stage_status ADD COLUMN completed_at TEXT")
+        if "current_stage" not in columns:
+            # Bases creadas antes del índice de etapa actual; la columna y su
+            # relleno se aplican en la misma transacción.
+            with self._transaction():
+                self._conn.execute("ALTER TABLE patients ADD COLUMN current_stage INTEGER")
+                self._backfill_current_stage()
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_current_stage ON patients (current_stage)")
+        self._fts = self._create_search_tables()
+
+    def _create_search_tables(self) -> bool:
+        """Crear los índices de texto (y poblarlos en bases anteriores); ``False`` si SQLite no trae FTS5."""
+        names = sorted(name for _, name in _SEARCH_OBJECTS)
+        found = set(
+            self._conn.execute(
+                f"SELECT type, name FROM sqlite_master WHERE name IN ({', '.join('?' * len(names))})", names
+            )
+        )
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if found == _SEARCH_OBJECTS and version >= _SEARCH_VERSION:
+            # Ya existen: una transacción de escritura aquí haría esperar a los comandos
+            # de solo lectura mientras otro proceso escribe (en WAL los lectores no esperan).
+            return True
+        existing = ("table", "patients_search") in found
+        try:
+            self._conn.executescript(f"BEGIN IMMEDIATE;{_SEARCH_SCHEMA}")
+        except sqlite3.OperationalError as exc:
+            if self._conn.in_transaction:
+                self._conn.execute("ROLLBACK")
+            if "fts5" not in str(exc):
+                raise
+            return False
+        try:
+            if not existing or version < _SEARCH_VERSION:
+                # Base anterior a la búsqueda, o con filas de ``patients_search`` que no
+                # usan el ``rowid`` del paciente: se indexa de nuevo lo que ya tiene.
+                self._conn.execute("DELETE FROM patients_search")
+                self._conn.executemany(
+                    "INSERT INTO patients_search (rowid, patient_id, name, contact, notes, digits) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (*row, contact_digit_suffixes(row[3]))
+                        for row in self._conn.execute("SELECT rowid, patient_id, name, contact, notes FROM patients")
+                    ],
+                )
+            if not existing:
+                self._conn.execute("INSERT INTO messages_search (messages_search) VALUES ('rebuild')")
+            self._conn.execute(f"PRAGMA user_version = {_SEARCH_VERSION}")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+        return True
+
+    def _backfill_current_stage(self) -> None:
+        updates = [
+            (patient.current_stage(), patient.patient_id) for patient in self.iter_patients(include_messages=False)
+        ]
+        self._conn.executemany("UPDATE patients SET current_stage = ? WHERE patient_id = ?", updates)
+
+    # -- lectura ----------------------------------------------------------------
+
+    @staticmethod
+    def _build_patient(row: sqlite3.Row | tuple) -> Patient:
+        patient_id, name, contact, channel, notes, version, surgery_date = row
+        return Patient(
+            patient_id=patient_id,
+            name=name,
+            contact=contact,
+            preferred_channel=MessagingChannel(channel),
+            notes=notes,
+            surgery_date=surgery_date,
+            version=version,
+        )
+
+    @staticmethod
+    def _load_stages(patient: Patient, rows: Iterable[tuple]) -> None:
+        status: Dict[str, bool] = {}
+        times: Dict[str, str] = {}
+        for stage_id, completed, completed_at in rows:
+            status[str(stage_id)] = bool(completed)
+            if completed_at:
+                times[str(stage_id)] = completed_at
+        patient.load_stage_status(status, times)
+
+    @staticmethod
+    def _build_message(row: tuple) -> MessageRecord:
+        patient_id, subject, body, channel, sent_at = row
+        return MessageRecord(
+            patient_id=patient_id,
+            subject=subject,
+            body=body,
+            channel=MessagingChannel(channel),
+            sent_at=sent_at,
+        )
+
+    def list_patients(self) -> List[Patient]:
+        patients: Dict[str, Patient] = {}
+        for row in self._conn.execute(
+            f"SELECT {_PATIENT_COLUMNS} FROM patients ORDER BY rowid"
+        ):
+            patients[row[0]] = self._build_patient(row)
+        stage_rows: Dict[str, List[tuple]] = {}
+        for patient_id, *row in self._conn.execute(
+            "SELECT patient_id, stage_id, completed, completed_at FROM stage_status"
+        ):
+            stage_rows.setdefault(patient_id, []).append(row)
+        for patient_id, rows in stage_rows.items():
+            self._load_stages(patients[patient_id], rows)
+        for row in self._conn.execute(
+            "SELECT patient_id, subject, body, channel, sent_at FROM messages ORDER BY id"
+        ):
+            patients[row[0]].messages.append(self._build_message(row))
+        return list(patients.values())
+
+    def iter_patients(self, include_messages: bool = True) -> Iterator[Patient]:
+        """Recorrer los pacientes en orden de ``patient_id`` combinando cursores ordenados.
+
+        Solo se mantiene en memoria el paciente en curso, sin importar el tamaño de la base.
+        """
+        stages = self._conn.execute(
+            "SELECT patient_id, stage_id, completed, completed_at FROM stage_status ORDER BY patient_id"
+        )
+        messages = (
+            self._conn.execute(
+                "SELECT patient_id, subject, body, channel, sent_at FROM messages ORDER BY patient_id, id"
+            )
+            if include_messages
+            else iter(())
+        )
+        stage_row = next(stages, None)
+        message_row = next(messages, None)
+        for row in self._conn.execute(
+            f"SELECT {_PATIENT_COLUMNS} FROM patients ORDER BY patient_id"
+        ):
+            patient = self._build_patient(row)
+            rows = []
+            while stage_row is not None and stage_row[0] <= patient.patient_id:
+                if stage_row[0] == patient.patient_id:
+                    rows.append(stage_row[1:])
+                stage_row = next(stages, None)
+            self._load_stages(patient, rows)
+            while message_row is not None and message_row[0] <= patient.patient_id:
+                if message_row[0] == patient.patient_id:
+                    patient.messages.append(self._build_message(message_row))
+                message_row = next(messages, None)
+            yield patient
+
+    def get_patient(self, patient_id: str) -> Optional[Patient]:
+        row = self._conn.execute(
+            f"SELECT {_PATIENT_COLUMNS} FROM patients WHERE patient_id = ?",
+            (patient_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        patient = self._build_patient(row)
+        self._load_stages(
+            patient,
+            self._conn.execute(
+                "SELECT stage_id, completed, completed_at FROM stage_status WHERE patient_id = ?", (patient_id,)
+            ),
+        )
+        return patient
+
+    def message_history(
+        self, patient_id: str, limit: Optional[int] = None, since: Optional[str] = None
+    ) -> List[MessageRecord]:
+        # Sin ``since`` se recorre idx_messages_patient_id hacia atrás y se detiene en
+        # ``limit``; con ``since`` conviene el rango sobre idx_messages_patient.
+        where, params = "patient_id = ?", [patient_id]
+        if since:
+            where += " AND sent_at >= ?"
+            params.append(since)
+        rows = self._conn.execute(
+            "SELECT patient_id, subject, body, channel, sent_at FROM messages "
+            f"WHERE {where} ORDER BY id DESC LIMIT ?",
+            (*params, -1 if limit is None else limit),
+        ).fetchall()
+        return [self._build_message(row) for row in reversed(rows)]
+
+    def patients_at_stage(self, stage_id: int, state: str = "actual") -> List[Patient]:
+        """Resolver la lista de trabajo con los índices de ``current_stage`` y ``stage_status``."""
+        if stage_id not in {stage.id for stage in STAGES}:
+            raise ValueError(f"No existe etapa con id {stage_id}.")
+        if state not in STAGE_STATES:
+            raise ValueError(f"Estado de etapa desconocido: '{state}'.")
+        done = "SELECT patient_id FROM stage_status WHERE stage_id = ? AND completed = 1"
+        query = {
+            "actual": "SELECT patient_id FROM patients WHERE current_stage = ?",
+            "pendiente": f"SELECT patient_id FROM patients WHERE patient_id NOT IN ({done})",
+            "completada": done,
+        }[state]
+        patient_ids = sorted(row[0] for row in self._conn.execute(query, (stage_id,)))
+        patients = (self.get_patient(patient_id) for patient_id in patient_ids)
+        return [patient for patient in patients if patient is not None]
+
+    def stage_funnel(self) -> List[FunnelRow]:
+        (total,) = self._conn.execute("SELECT COUNT(*) FROM patients").fetchone()
+        completed = dict(
+            self._conn.execute(
+                "SELECT stage_id, COUNT(*) FROM stage_status WHERE completed = 1 GROUP BY stage_id"
+            ).fetchall()
+        )
+        current = dict(
+            self._conn.execute(
+                "SELECT current_stage, COUNT(*) FROM patients WHERE current_stage IS NOT NULL GROUP BY current_stage"
+            ).fetchall()
+        )
+        return [
+            FunnelRow(
+                stage=stage,
+                completed=completed.get(stage.id, 0),
+                current=current.get(stage.id, 0),
+                pending=total - completed.get(stage.id, 0),
+            )
+            for stage in STAGES
+        ]
+
+    def search(self, query: str, limit: int = 20) -> List[SearchHit]:
+        """Buscar con los índices FTS5, ordenando cada tabla con ``bm25``.
+
+        Sin FTS5 se usa el índice en memoria de la clase base.
+        """
+        if not self._fts:
+            return super().search(query, limit)
+        match = _match_expression(query_terms(query))
+        rows = self._conn.execute(
+            "SELECT patient_id, name, -bm25(patients_search) FROM patients_search "
+            "WHERE patients_search MATCH ? ORDER BY rank LIMIT ?",
+            (match, limit),
+        ).fetchall()
+        rows += self._conn.execute(
+            "SELECT m.patient_id, p.name, -bm25(messages_search), m.sent_at, m.subject FROM messages_search "
+            "JOIN messages m ON m.id = messages_search.rowid JOIN patients p ON p.patient_id = m.patient_id "
+            "WHERE messages_search MATCH ? ORDER BY rank LIMIT ?",
+            (match, limit),
+        ).fetchall()
+        hits = sorted((SearchHit(*row) for row in rows), key=lambda hit: hit.score, reverse=True)
+        return hits[:limit]
+
+    # -- escritura --------------------------------------------------------------
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """Abrir una transacción de escritura (BEGIN IMMEDIATE) salvo dentro de un lote."""
+        if self._in_batch:
+            yield
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Ejecutar todas las operaciones del bloque en una única transacción."""
+        if self._in_batch:
+            yield
+            return
+        with self._transaction():
+            self._in_batch = True
+            try:
+                yield
+            finally:
+                self._in_batch = False
+
+    def _record_changes(self, events: List[Dict]) -> None:
+        at = datetime.utcnow().isoformat(timespec="seconds")
+        self._conn.executemany(
+            "INSERT INTO changes (at, op, patient_id, data) VALUES (?, ?, ?, ?)",
+            [(at, event["op"], event["patient_id"], json.dumps(event["data"], ensure_ascii=False)) for event in events],
+        )
+
+    def changes_since(self, cursor: int = 0) -> Iterator[Dict]:
+        rows = self._conn.execute(
+            "SELECT seq, at, op, patient_id, data FROM changes WHERE seq > ? ORDER BY seq", (cursor,)
+        )
+        for seq, at, op, patient_id, data in rows:
+            yield {"seq": seq, "at": at, "op": op, "patient_id": patient_id, "data": json.loads(data)}
+
+    def _upsert(self, patient: Patient, check: bool = True) -> None:
+        row = self._conn.execute(
+            "SELECT version, name, contact, notes, rowid FROM patients WHERE patient_id = ?", (patient.patient_id,)
+        ).fetchone()
+        current = {"version": row[0]} if row else None
+        if row is not None:
+            current["stage_status"] = {
+                str(stage_id): bool(completed)
+                for stage_id, completed in self._conn.execute(
+                    "SELECT stage_id, completed FROM stage_status WHERE patient_id = ?", (patient.patient_id,)
+                )
+            }
+        stored_version = check_version(patient, current) if check else (row[0] if row else 0)
+        cursor = self._conn.execute(
+            "INSERT INTO patients "
+            "(patient_id, name, contact, preferred_channel, notes, version, current_stage, surgery_date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(patient_id) DO UPDATE SET name = excluded.name, contact = excluded.contact, "
+            "preferred_channel = excluded.preferred_channel, notes = excluded.notes, version = excluded.version, "
+            "current_stage = excluded.current_stage, surgery_date = excluded.surgery_date",
+            (
+                patient.patient_id,
+                patient.name,
+                patient.contact,
+                patient.preferred_channel.value,
+                patient.notes,
+                stored_version + 1,
+                patient.current_stage(),
+                patient.surgery_date,
+            ),
+        )
+        if self._fts and (row is None or row[1:4] != (patient.name, patient.contact, patient.notes)):
+            # En una inserción ``lastrowid`` es la fila nueva; en una actualización el ``rowid`` no cambia.
+            self._index_patient(patient, row[4] if row else cursor.lastrowid, replace=row is not None)
+        self._conn.execute("DELETE FROM stage_status WHERE patient_id = ?", (patient.patient_id,))
+        self._conn.executemany(
+            "INSERT INTO stage_status (patient_id, stage_id, completed, completed_at) VALUES (?, ?, ?, ?)",
+            [
+                (patient.patient_id, int(stage_id), int(done), patient.stage_time(stage_id))
+                for stage_id, done in patient.stage_status.items()
+            ],
+        )
+        patient.version = stored_version + 1
+        self._record_changes(patient_changes(current, patient.to_dict(include_messages=False)))
+
+    def _index_patient(self, patient: Patient, rowid: int, replace: bool) -> None:
+        if replace:
+            self._conn.execute("DELETE FROM patients_search WHERE rowid = ?", (rowid,))
+        self._conn.execute(
+            "INSERT INTO patients_search (rowid, patient_id, name, contact, notes, digits) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                rowid,
+                patient.patient_id,
+                patient.name,
+                patient.contact,
+                patient.notes,
+                contact_digit_suffixes(patient.contact),
+            ),
+        )
+
+    def _insert_messages(self, messages: Iterable[MessageRecord]) -> None:
+        self._conn.executemany(
+            "INSERT INTO messages (patient_id, subject, body, channel, sent_at) VALUES (?, ?, ?, ?, ?)",
+            [
+                (msg.patient_id, msg.subject, msg.body, MessagingChannel(msg.channel).value, msg.sent_at)
+                for msg in messages
+            ],
+        )
+
+    def save_patient(self, patient: Patient) -> None:
+        with self._transaction():
+            self._upsert(patient)
+
+    def save_message(self, message: MessageRecord) -> None:
+        with self._transaction():
+            exists = self._conn.execute(
+                "SELECT 1 FROM patients WHERE patient_id = ?", (message.patient_id,)
+            ).fetchone()
+            if not exists:
+                raise ValueError(f"Paciente {message.patient_id} no existe.")
+            self._insert_messages([message])
+            self._record_changes([message_change(asdict(message))])
+            self._conn.execute(
+                "UPDATE patients SET version = version + 1 WHERE patient_id = ?", (message.patient_id,)
+            )
+
+    def import_patients(self, patients: Iterable[Patient]) -> int:
+        count = 0
+        with self._transaction():
+            for patient in patients:
+                self._upsert(patient, check=False)
+                (stored,) = self._conn.execute(
+                    "SELECT COUNT(*) FROM messages WHERE patient_id = ?", (patient.patient_id,)
+                ).fetchone()
+                self._insert_messages(patient.messages[stored:])
+                self._record_changes([message_change(asdict(message)) for message in patient.messages[stored:]])
+                count += 1
+        return count
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,104 @@
+"""Índice secundario etapa → pacientes para consultas de listas de trabajo."""
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .workflow import STAGES, WorkflowStage
+
+STAGE_STATES = ("actual", "pendiente", "completada")
+
+
+def current_stage_id(completed: Iterable[int]) -> Optional[int]:
+    """Primera etapa del flujo que no está completada, o ``None`` si terminó todo."""
+    done = set(completed)
+    for stage in STAGES:
+        if stage.id not in done:
+            return stage.id
+    return None
+
+
+@dataclass(frozen=True)
+class FunnelRow:
+    """Conteos de una etapa dentro del embudo del flujo."""
+
+    stage: WorkflowStage
+    completed: int
+    current: int
+    pending: int
+
+
+class StageIndex:
+    """Conjuntos de ``patient_id`` por etapa: completada, pendiente y etapa actual.
+
+    Se actualiza incrementalmente con :meth:`update`, de modo que cada consulta
+    cuesta lo que mida el resultado y no el total de pacientes.
+    """
+
+    def __init__(self) -> None:
+        self._completed: Dict[int, Set[str]] = {stage.id: set() for stage in STAGES}
+        self._pending: Dict[int, Set[str]] = {stage.id: set() for stage in STAGES}
+        self._current: Dict[int, Set[str]] = {stage.id: set() for stage in STAGES}
+        self._by_patient: Dict[str, FrozenSet[int]] = {}
+
+    @classmethod
+    def build(cls, entries: Iterable[Tuple[str, Iterable[int]]]) -> "StageIndex":
+        """Construir el índice a partir de pares ``(patient_id, etapas completadas)``."""
+        index = cls()
+        for patient_id, completed in entries:
+            index.update(patient_id, completed)
+        return index
+
+    def __len__(self) -> int:
+        return len(self._by_patient)
+
+    def update(self, patient_id: str, completed: Iterable[int]) -> None:
+        """Registrar las etapas completadas de un paciente, tocando solo las que cambiaron."""
+        new = frozenset(stage_id for stage_id in completed if stage_id in self._completed)
+        old = self._by_patient.get(patient_id)
+        if old == new:
+            return
+        if old is None:
+            for stage_id in self._pending:
+                (self._completed if stage_id in new else self._pending)[stage_id].add(patient_id)
+        else:
+            for stage_id in old - new:
+                self._completed[stage_id].discard(patient_id)
+                self._pending[stage_id].add(patient_id)
+            for stage_id in new - old:
+                self._pending[stage_id].discard(patient_id)
+                self._completed[stage_id].add(patient_id)
+            previous = current_stage_id(old)
+            if previous is not None:
+                self._current[previous].discard(patient_id)
+        current = current_stage_id(new)
+        if current is not None:
+            self._current[current].add(patient_id)
+        self._by_patient[patient_id] = new
+
+    def entries(self) -> Iterator[Tuple[str, FrozenSet[int]]]:
+        """Pares ``(patient_id, etapas completadas)``, aptos para :meth:`build`."""
+        return iter(self._by_patient.items())
+
+    def patient_ids(self, stage_id: int, state: str = "actual") -> Set[str]:
+        """Pacientes con la etapa en el estado indicado (``actual``, ``pendiente`` o ``completada``)."""
+        if stage_id not in self._completed:
+            raise ValueError(f"No existe etapa con id {stage_id}.")
+        if state == "actual":
+            return set(self._current[stage_id])
+        if state == "pendiente":
+            return set(self._pending[stage_id])
+        if state == "completada":
+            return set(self._completed[stage_id])
+        raise ValueError(f"Estado de etapa desconocido: '{state}'.")
+
+    def funnel(self) -> List[FunnelRow]:
+        return [
+            FunnelRow(
+                stage=stage,
+                completed=len(self._completed[stage.id]),
+                current=len(self._current[stage.id]),
+                pending=len(self._pending[stage.id]),
+            )
+            for stage in STAGES
+        ]
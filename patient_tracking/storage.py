@@ -2,127 +2,760 @@
 from __future__ import annotations
 
 import json
-from dataclasses import dataclass, field, asdict
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import InitVar, dataclass, field, asdict
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
+from .changes import ChangeFeed, message_change, patient_changes
+from .durability import FsyncPolicy, atomic_write, fsync_file
+from .jsonstream import dump_patients, iter_patient_payloads
+from .locking import FileLock
 from .messaging import MessageRecord, MessagingChannel
+from .search_index import SearchHit, SearchIndex
+from .stage_index import FunnelRow, StageIndex
 from .workflow import STAGES
 
 
-@dataclass
+class ConflictError(RuntimeError):
+    """Otro proceso modificó el paciente desde que fue leído."""
+
+
+def _stage_bit(stage_id: int | str) -> int:
+    return 1 << int(stage_id)
+
+
+_STAGE_BITS: List[Tuple[int, int]] = [(stage.id, 1 << stage.id) for stage in STAGES]
+
+
+def _mask_ids(mask: int) -> List[int]:
+    """Ids de etapa de los bits encendidos de ``mask``, de menor a mayor."""
+    ids = []
+    while mask:
+        lowest = mask & -mask
+        ids.append(lowest.bit_length() - 1)
+        mask ^= lowest
+    return ids
+
+
+@dataclass(slots=True)
 class Patient:
-    """Representa la información clave del paciente."""
+    """Representa la información clave del paciente.
+
+    El estado de las etapas se guarda en dos máscaras de bits (el bit ``n``
+    corresponde a la etapa con id ``n``): ``stage_mask`` marca las completadas y
+    ``stage_known`` las que alguna vez se marcaron, completas o pendientes, para
+    conservar el mismo ``stage_status`` que se serializa en disco. El constructor
+    sigue aceptando ``stage_status={"<id>": bool}`` (solo por nombre) y llena las
+    máscaras. ``stage_times`` es ``None`` hasta que se completa la primera etapa,
+    para no reservar un diccionario vacío por paciente.
+
+    ``version`` aumenta con cada cambio guardado y permite detectar escrituras
+    concurrentes (control optimista).
+
+    ``messages`` solo se completa al recorrer pacientes con ``include_messages``;
+    ``get_patient`` entrega el registro sin historial, que se consulta aparte con
+    :meth:`StorageBackend.message_history`.
+    """
 
     patient_id: str
     name: str
     contact: str
     preferred_channel: MessagingChannel = MessagingChannel.CHAT
     notes: str = ""
-    stage_status: Dict[str, bool] = field(default_factory=dict)
+    surgery_date: str = ""
+    stage_mask: int = 0
+    stage_known: int = 0
+    stage_times: Optional[Dict[str, str]] = None
     messages: List[MessageRecord] = field(default_factory=list)
+    version: int = 0
+    # Campo anterior a las máscaras; ver ``__post_init__`` y la propiedad definida tras la clase.
+    stage_status: InitVar[Optional[Dict[str, bool]]] = field(default=None, kw_only=True)
+
+    def __post_init__(self, stage_status: Optional[Dict[str, bool]]) -> None:
+        if stage_status:
+            self.load_stage_status(stage_status, self.stage_times)
+
+    def mark_stage(self, stage_id: int, completed: bool = True, at: Optional[str] = None) -> None:
+        """Marcar la etapa; al completarla se registra cuándo (``at`` o la hora actual UTC)."""
+        bit = _stage_bit(stage_id)
+        self.stage_known |= bit
+        if completed:
+            if at is None and not self.stage_mask & bit:
+                at = datetime.utcnow().isoformat(timespec="seconds")
+            if at is not None:
+                if self.stage_times is None:
+                    self.stage_times = {}
+                self.stage_times[str(stage_id)] = at
+            self.stage_mask |= bit
+        else:
+            self.stage_mask &= ~bit
+            if self.stage_times:
+                self.stage_times.pop(str(stage_id), None)
+
+    def is_stage_completed(self, stage_id: int) -> bool:
+        return bool(self.stage_mask & _stage_bit(stage_id))
 
-    def mark_stage(self, stage_id: int, completed: bool = True) -> None:
-        self.stage_status[str(stage_id)] = completed
+    def stage_time(self, stage_id: int | str) -> Optional[str]:
+        """Cuándo se completó la etapa, o ``None`` si no hay registro."""
+        return self.stage_times.get(str(stage_id)) if self.stage_times else None
 
-    def to_dict(self) -> Dict:
-        return {
+    def _stage_status(self) -> Dict[str, bool]:
+        return {str(stage_id): bool(self.stage_mask & _stage_bit(stage_id)) for stage_id in _mask_ids(self.stage_known)}
+
+    def load_stage_status(self, status: Dict[str, bool], times: Optional[Dict[str, str]] = None) -> None:
+        """Reemplazar el estado de etapas; las fechas ausentes (datos antiguos) quedan sin registrar."""
+        self.stage_mask = 0
+        self.stage_known = 0
+        for stage_id, completed in status.items():
+            bit = _stage_bit(stage_id)
+            self.stage_known |= bit
+            if completed:
+                self.stage_mask |= bit
+        self.stage_times = {
+            stage_id: at for stage_id, at in (times or {}).items() if self.stage_mask & _stage_bit(stage_id)
+        } or None
+
+    def to_dict(self, include_messages: bool = True) -> Dict:
+        data = {
             "patient_id": self.patient_id,
             "name": self.name,
             "contact": self.contact,
             "preferred_channel": self.preferred_channel.value,
             "notes": self.notes,
+            "surgery_date": self.surgery_date,
             "stage_status": self.stage_status,
+            "stage_times": dict(self.stage_times or {}),
             "messages": [asdict(message) for message in self.messages],
+            "version": self.version,
         }
+        if not include_messages:
+            del data["messages"]
+        return data
 
     @classmethod
-    def from_dict(cls, data: Dict) -> "Patient":
+    def from_dict(cls, data: Dict, include_messages: bool = True) -> "Patient":
+        """Construir el paciente; sin ``include_messages`` no se decodifica el historial."""
         patient = cls(
             patient_id=data["patient_id"],
             name=data["name"],
             contact=data["contact"],
             preferred_channel=MessagingChannel(data.get("preferred_channel", "chat")),
             notes=data.get("notes", ""),
+            surgery_date=data.get("surgery_date", ""),
+            version=data.get("version", 0),
         )
-        patient.stage_status = data.get("stage_status", {})
-        patient.messages = [
-            MessageRecord(
-                patient_id=msg["patient_id"],
-                subject=msg["subject"],
-                body=msg["body"],
-                channel=MessagingChannel(msg["channel"]),
-                sent_at=msg["sent_at"],
-            )
-            for msg in data.get("messages", [])
-        ]
+        patient.load_stage_status(data.get("stage_status", {}), data.get("stage_times"))
+        if include_messages:
+            patient.messages = [MessageRecord.from_dict(msg) for msg in data.get("messages", [])]
         return patient
 
     def completed_stages(self) -> List[int]:
-        return [int(stage_id) for stage_id, completed in self.stage_status.items() if completed]
+        return _mask_ids(self.stage_mask)
 
     def pending_stages(self) -> List[int]:
-        completed = set(self.completed_stages())
-        return [stage.id for stage in STAGES if stage.id not in completed]
+        mask = self.stage_mask
+        return [stage_id for stage_id, bit in _STAGE_BITS if not mask & bit]
+
+    def current_stage(self) -> Optional[int]:
+        """Primera etapa pendiente del flujo, o ``None`` si el paciente completó todas."""
+        mask = self.stage_mask
+        for stage_id, bit in _STAGE_BITS:
+            if not mask & bit:
+                return stage_id
+        return None
+
+
+# Definida tras la clase: con el mismo nombre en el cuerpo, ``dataclass`` la tomaría
+# como valor por defecto del argumento ``stage_status`` del constructor.
+Patient.stage_status = property(  # type: ignore[assignment]
+    Patient._stage_status, doc="""Copia del estado de etapas con el formato de disco (``{"<id>": bool}``)."""
+)
+
+
+def tail_messages(
+    payloads: Sequence[Dict], limit: Optional[int] = None, since: Optional[str] = None
+) -> List[MessageRecord]:
+    """Decodificar solo los últimos ``limit`` mensajes serializados enviados desde ``since``.
+
+    ``payloads`` está en orden de envío; se recorre desde el final y se detiene al
+    reunir ``limit`` mensajes. El resultado queda en orden cronológico.
+    """
+    selected: List[Dict] = []
+    for payload in reversed(payloads):
+        if limit is not None and len(selected) >= limit:
+            break
+        if since is None or payload["sent_at"] >= since:
+            selected.append(payload)
+    return [MessageRecord.from_dict(payload) for payload in reversed(selected)]
+
+
+def payload_completed_stages(payload: Dict) -> List[int]:
+    """Etapas completadas de un paciente serializado, sin decodificar el resto del registro."""
+    return [int(stage_id) for stage_id, completed in payload.get("stage_status", {}).items() if completed]
+
+
+@dataclass
+class CacheStats:
+    """Contadores de aciertos y fallos de la caché de lectura."""
+
+    hits: int = 0
+    misses: int = 0
+
+
+class StorageBackend:
+    """Interfaz común de los motores de almacenamiento de pacientes.
+
+    ``path`` es el archivo principal del motor; junto a él se guardan archivos
+    auxiliares como la bandeja de salida de mensajes o el registro de cambios
+    (``change_feed``, ver :mod:`patient_tracking.changes`).
+    """
+
+    path: Path
+    change_feed: Optional[ChangeFeed] = None
+    _held_changes: Optional[List[Dict]] = None
+
+    def list_patients(self) -> List[Patient]:  # pragma: no cover - interface
+        raise NotImplementedError
+
+    def get_patient(self, patient_id: str) -> Optional[Patient]:  # pragma: no cover - interface
+        """Registro del paciente sin su historial de mensajes (ver :meth:`message_history`)."""
+        raise NotImplementedError
+
+    def save_patient(self, patient: Patient) -> None:  # pragma: no cover - interface
+        """Guardar el registro del paciente; el historial guardado no se modifica."""
+        raise NotImplementedError
+
+    def iter_patients(self, include_messages: bool = True) -> Iterator[Patient]:
+        """Iterar los pacientes; sin ``include_messages`` la lista de mensajes queda vacía."""
+        for patient in self.list_patients():
+            if not include_messages:
+                patient.messages = []
+            yield patient
+
+    def save_message(self, message: MessageRecord) -> None:  # pragma: no cover - interface
+        raise NotImplementedError
+
+    def message_history(
+        self, patient_id: str, limit: Optional[int] = None, since: Optional[str] = None
+    ) -> List[MessageRecord]:
+        """Últimos ``limit`` mensajes del paciente enviados desde ``since`` (ISO), en orden cronológico.
+
+        Por defecto se recorre el almacenamiento; los motores lo reemplazan por una
+        lectura del final del historial de ese paciente.
+        """
+        for patient in self.iter_patients():
+            if patient.patient_id == patient_id:
+                return tail_messages([asdict(message) for message in patient.messages], limit, since)
+        return []
+
+    def import_patients(self, patients: Iterable[Patient]) -> int:
+        """Guardar varios pacientes completos (con su historial) y devolver cuántos fueron."""
+        count = 0
+        for patient in patients:
+            self.save_patient(patient)
+            for message in patient.messages:
+                self.save_message(message)
+            count += 1
+        return count
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Agrupar varias operaciones en una sola escritura; por defecto no agrupa nada."""
+        yield
+
+    def changes_since(self, cursor: int = 0) -> Iterator[Dict]:
+        """Eventos de cambio con ``seq`` mayor que ``cursor``, en orden (ver :mod:`patient_tracking.changes`)."""
+        if self.change_feed is None:
+            return iter(())
+        return self.change_feed.since(cursor)
+
+    def _record_changes(self, events: List[Dict]) -> None:
+        """Anotar eventos en el registro de cambios; dentro de :meth:`_holding_changes` se retienen."""
+        if self.change_feed is None or not events:
+            return
+        if self._held_changes is not None:
+            self._held_changes.extend(events)
+        else:
+            self.change_feed.append(events)
+
+    def _publish_changes(self) -> None:
+        """Anotar ya los eventos retenidos por :meth:`_holding_changes`; se llama antes de escribir los datos."""
+        if self._held_changes is None:
+            return
+        events, self._held_changes = self._held_changes, []
+        if events and self.change_feed is not None:
+            self.change_feed.append(events)
+
+    @contextmanager
+    def _holding_changes(self) -> Iterator[None]:
+        """Retener los eventos del bloque y anotarlos al terminar; si el bloque falla se descartan.
+
+        Los motores lo usan en ``batch`` y llaman a :meth:`_publish_changes` justo
+        antes de escribir los datos, sin soltar el candado de escritura.
+        """
+        if self._held_changes is not None:
+            yield
+            return
+        self._held_changes = []
+        try:
+            yield
+        except BaseException:
+            self._held_changes = None
+            raise
+        events, self._held_changes = self._held_changes, None
+        if events and self.change_feed is not None:
+            self.change_feed.append(events)
+
+    def stage_index(self) -> StageIndex:
+        """Índice etapa → pacientes; por defecto se construye recorriendo el almacenamiento."""
+        return StageIndex.build(
+            (patient.patient_id, patient.completed_stages()) for patient in self.iter_patients(include_messages=False)
+        )
+
+    def patients_at_stage(self, stage_id: int, state: str = "actual") -> List[Patient]:
+        """Pacientes cuya etapa ``stage_id`` está en ``state`` (``actual``, ``pendiente`` o ``completada``)."""
+        patient_ids = sorted(self.stage_index().patient_ids(stage_id, state))
+        patients = (self.get_patient(patient_id) for patient_id in patient_ids)
+        return [patient for patient in patients if patient is not None]
+
+    def stage_funnel(self) -> List[FunnelRow]:
+        """Conteos por etapa de pacientes que la completaron, la tienen como actual o pendiente."""
+        return self.stage_index().funnel()
+
+    def search_index(self) -> SearchIndex:
+        """Índice de texto de pacientes y mensajes; por defecto se construye recorriendo el almacenamiento."""
+        payloads = (patient.to_dict() for patient in self.iter_patients())
+        return SearchIndex.build((payload, payload["messages"]) for payload in payloads)
+
+    def search(self, query: str, limit: int = 20) -> List[SearchHit]:
+        """Pacientes y mensajes que contienen todos los términos de ``query``, del más relevante al menos."""
+        return self.search_index().search(query, limit)
+
+    def close(self) -> None:
+        """Liberar recursos del motor; por defecto no hace nada."""
+
+    def __enter__(self) -> "StorageBackend":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
 
 
-class PatientStorage:
-    """Wrapper sobre un archivo JSON para persistencia sencilla."""
+class PatientStorage(StorageBackend):
+    """Wrapper sobre un archivo JSON para persistencia sencilla.
 
-    def __init__(self, path: str | Path = "data/patients.json") -> None:
+    El documento decodificado se conserva en memoria y solo se vuelve a leer
+    cuando cambian el inodo, la fecha de modificación o el tamaño del archivo.
+
+    Cada escritura se hace en un archivo temporal que luego reemplaza al original,
+    sincronizando a disco según ``fsync`` (ver :class:`FsyncPolicy`). Con
+    ``group_commit`` (segundos) las escrituras emitidas dentro de esa ventana se
+    combinan en una sola; ``close()`` vuelca lo que quede pendiente.
+
+    Varios procesos pueden compartir el archivo: las lecturas toman un candado
+    compartido y cada escritura relee el documento bajo un candado exclusivo,
+    rechazando con :class:`ConflictError` un paciente cuya ``version`` ya no
+    coincide. ``group_commit`` retiene escrituras en memoria, por lo que solo
+    conviene con un único proceso escritor.
+
+    Los cambios se anotan en ``<ruta>.changes`` (o en el ``changes`` recibido,
+    que puede compartirse entre varios archivos; ``False`` lo desactiva) bajo el
+    mismo candado exclusivo de la escritura, así que su orden es el de los datos.
+    Se anotan antes de reemplazar el archivo: un corte entre ambos pasos deja un
+    evento de más, nunca uno de menos (ver :mod:`patient_tracking.changes`).
+    """
+
+    def __init__(
+        self,
+        path: str | Path = "data/patients.json",
+        cache: bool = True,
+        fsync: str | FsyncPolicy | None = None,
+        group_commit: float = 0.0,
+        changes: ChangeFeed | bool = True,
+    ) -> None:
         self.path = Path(path)
+        self.cache_enabled = cache
+        self.cache_stats = CacheStats()
+        self.fsync = FsyncPolicy.parse(fsync)
+        self.group_commit = group_commit
+        self._cache: Optional[Dict] = None
+        self._cache_key: Optional[Tuple[int, int, int, int]] = None
+        self._batch: Optional[Dict] = None
+        self._batch_dirty = False
+        self._pending: Optional[Dict] = None
+        self._timer: Optional[threading.Timer] = None
+        self._lock = threading.RLock()
+        self._stage_index: Optional[StageIndex] = None
+        self._stage_index_source: Optional[Dict] = None
+        self._search_index: Optional[SearchIndex] = None
+        self._search_index_source: Optional[Dict] = None
         self.path.parent.mkdir(parents=True, exist_ok=True)
-        if not self.path.exists():
-            self._write({"patients": {}})
+        if changes is True:
+            self.change_feed = ChangeFeed.beside(self.path, fsync=fsync)
+        elif changes:
+            self.change_feed = changes
+        self._file_lock = FileLock(self.path.with_name(self.path.name + ".lock"))
+        with self._file_lock.exclusive():
+            if not self.path.exists():
+                self._write_file({"patients": {}})
+
+    def _file_key(self) -> Tuple[int, int, int, int]:
+        stat = self.path.stat()
+        return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def invalidate_cache(self) -> None:
+        """Descartar el documento en caché para forzar la próxima lectura desde disco."""
+        self._cache = None
+        self._cache_key = None
 
     def _read(self) -> Dict:
+        if self._batch is not None:
+            return self._batch
+        if self._pending is not None:
+            return self._pending
+        with self._lock, self._file_lock.shared():
+            if self.cache_enabled:
+                key = self._file_key()
+                if self._cache is not None and key == self._cache_key:
+                    self.cache_stats.hits += 1
+                    return self._cache
+                self.cache_stats.misses += 1
+            data = self._load()
+            if self.cache_enabled:
+                self._cache = data
+                self._cache_key = key
+            return data
+
+    def _write(self, data: Dict) -> None:
+        if self._batch is not None:
+            self._batch_dirty = True
+            return
+        if self.group_commit > 0:
+            with self._lock:
+                self._pending = data
+                if self._timer is None:
+                    self._timer = threading.Timer(self.group_commit, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+            return
+        self._write_file(data)
+
+    def _load(self) -> Dict:
+        """Decodificar el documento completo desde disco (con el candado compartido tomado)."""
         with self.path.open("r", encoding="utf-8") as fp:
             return json.load(fp)
 
-    def _write(self, data: Dict) -> None:
-        with self.path.open("w", encoding="utf-8") as fp:
-            json.dump(data, fp, indent=2, ensure_ascii=False)
+    def _dump(self, data: Dict) -> None:
+        """Reemplazar el archivo por ``data`` de forma atómica."""
+
+        def dump(fp) -> None:
+            extra = {key: value for key, value in data.items() if key != "patients"}
+            dump_patients(fp, data.get("patients", {}).items(), extra)
+
+        atomic_write(self.path, dump, sync=self.fsync.after_write())
+
+    def _write_file(self, data: Dict) -> None:
+        try:
+            self._dump(data)
+        except BaseException:
+            # El documento en memoria pudo quedar a medio modificar.
+            self.invalidate_cache()
+            raise
+        if self.cache_enabled:
+            self._cache = data
+            self._cache_key = self._file_key()
+
+    def flush(self) -> None:
+        """Escribir de inmediato los cambios retenidos por ``group_commit``."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            data, self._pending = self._pending, None
+            if data is not None:
+                with self._file_lock.exclusive():
+                    self._write_file(data)
+
+    def close(self) -> None:
+        self.flush()
+        if self.fsync.on_close():
+            fsync_file(self.path)
+        if self.change_feed is not None:
+            self.change_feed.close()
+        self._file_lock.close()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Cargar el documento una vez y escribirlo una sola vez al terminar el bloque.
+
+        El candado exclusivo se mantiene durante todo el bloque para que ningún
+        otro proceso escriba entre la lectura y la escritura final.
+        """
+        if self._batch is not None:
+            yield
+            return
+        with self._lock, self._file_lock.exclusive(), self._holding_changes():
+            self._batch = self._read()
+            self._batch_dirty = False
+            try:
+                yield
+            except BaseException:
+                self._batch = None
+                self.invalidate_cache()
+                raise
+            data, dirty = self._batch, self._batch_dirty
+            self._batch = None
+            self._publish_changes()
+            if dirty:
+                self._write(data)
 
     def list_patients(self) -> List[Patient]:
         data = self._read()
         return [Patient.from_dict(payload) for payload in data.get("patients", {}).values()]
 
+    def iter_patients(self, include_messages: bool = True) -> Iterator[Patient]:
+        """Iterar los pacientes leyendo el archivo de forma incremental.
+
+        Si el documento ya está en memoria (caché válida o lote en curso) se usa ese;
+        de lo contrario se recorre el archivo por bloques sin cargarlo completo.
+        """
+        if self._batch is None and self._pending is None and not (
+            self.cache_enabled and self._cache is not None and self._file_key() == self._cache_key
+        ):
+            with self.path.open("r", encoding="utf-8") as fp:
+                for payload in iter_patient_payloads(fp, skip_messages=not include_messages):
+                    yield Patient.from_dict(payload)
+            return
+        with self._lock:
+            payloads = list(self._read().get("patients", {}).values())
+        for payload in payloads:
+            yield Patient.from_dict(payload, include_messages=include_messages)
+
+    def _index_for(self, data: Dict) -> StageIndex:
+        # El índice solo es válido para el mismo documento en memoria que se usó al
+        # construirlo: si otro proceso cambió el archivo, ``_read`` devuelve uno nuevo.
+        if self._stage_index is None or self._stage_index_source is not data:
+            self._stage_index = StageIndex.build(
+                (patient_id, payload_completed_stages(payload))
+                for patient_id, payload in data.get("patients", {}).items()
+            )
+            self._stage_index_source = data
+        return self._stage_index
+
+    def _reindex(self, data: Dict, patient_id: str) -> None:
+        payload = data["patients"][patient_id]
+        if self._stage_index is not None and self._stage_index_source is data:
+            self._stage_index.update(patient_id, payload_completed_stages(payload))
+        if self._search_index is not None and self._search_index_source is data:
+            self._search_index.update_patient(patient_id, payload["name"], payload["contact"], payload.get("notes", ""))
+
+    def _search_for(self, data: Dict) -> SearchIndex:
+        # Misma regla que ``_index_for``: el índice corresponde a un documento en memoria.
+        if self._search_index is None or self._search_index_source is not data:
+            self._search_index = SearchIndex.build(
+                (payload, payload.get("messages", [])) for payload in data.get("patients", {}).values()
+            )
+            self._search_index_source = data
+        return self._search_index
+
+    def search_index(self) -> SearchIndex:
+        with self._lock:
+            return self._search_for(self._read())
+
+    def stage_index(self) -> StageIndex:
+        with self._lock:
+            return self._index_for(self._read())
+
+    def patients_at_stage(self, stage_id: int, state: str = "actual") -> List[Patient]:
+        with self._lock:
+            data = self._read()
+            payloads = data.get("patients", {})
+            patient_ids = sorted(self._index_for(data).patient_ids(stage_id, state))
+            return [
+                Patient.from_dict(payloads[patient_id], include_messages=False)
+                for patient_id in patient_ids
+                if patient_id in payloads
+            ]
+
     def get_patient(self, patient_id: str) -> Optional[Patient]:
         data = self._read()
         payload = data.get("patients", {}).get(patient_id)
         if payload is None:
             return None
-        return Patient.from_dict(payload)
+        return Patient.from_dict(payload, include_messages=False)
+
+    def message_history(
+        self, patient_id: str, limit: Optional[int] = None, since: Optional[str] = None
+    ) -> List[MessageRecord]:
+        payload = self._read().get("patients", {}).get(patient_id)
+        if payload is None:
+            return []
+        return tail_messages(payload.get("messages", []), limit, since)
 
     def save_patient(self, patient: Patient) -> None:
-        data = self._read()
-        patients = data.setdefault("patients", {})
-        patients[patient.patient_id] = patient.to_dict()
-        self._write(data)
+        """Guardar el paciente si nadie lo modificó desde que se leyó su ``version``."""
+        with self._lock, self._file_lock.exclusive():
+            data = self._read()
+            patients = data.setdefault("patients", {})
+            current = patients.get(patient.patient_id)
+            stored_version = check_version(patient, current)
+            payload = patient.to_dict()
+            payload["messages"] = current.get("messages", []) if current else []
+            payload["version"] = stored_version + 1
+            patients[patient.patient_id] = payload
+            self._record_changes(patient_changes(current, payload))
+            self._write(data)
+            self._reindex(data, patient.patient_id)
+            patient.version = stored_version + 1
 
     def save_message(self, message: MessageRecord) -> None:
-        data = self._read()
-        patients = data.setdefault("patients", {})
-        payload = patients.get(message.patient_id)
-        if not payload:
-            raise ValueError(f"Paciente {message.patient_id} no existe.")
-        payload.setdefault("messages", []).append(asdict(message))
-        self._write(data)
+        with self._lock, self._file_lock.exclusive():
+            data = self._read()
+            patients = data.setdefault("patients", {})
+            payload = patients.get(message.patient_id)
+            if not payload:
+                raise ValueError(f"Paciente {message.patient_id} no existe.")
+            payload.setdefault("messages", []).append(asdict(message))
+            payload["version"] = payload.get("version", 0) + 1
+            self._record_changes([message_change(asdict(message))])
+            self._write(data)
+            if self._search_index is not None and self._search_index_source is data:
+                self._search_index.add_message(message.patient_id, message.subject, message.body, message.sent_at)
 
+    def import_patients(self, patients: Iterable[Patient]) -> int:
+        with self._lock, self._file_lock.exclusive():
+            data = self._read()
+            stored = data.setdefault("patients", {})
+            events: List[Dict] = []
+            count = 0
+            for patient in patients:
+                current = stored.get(patient.patient_id)
+                payload = patient.to_dict()
+                payload["version"] = (current.get("version", 0) if current else 0) + 1
+                stored[patient.patient_id] = payload
+                self._reindex(data, patient.patient_id)
+                events.extend(patient_changes(current, payload))
+                # Solo los mensajes que el historial guardado no tenía.
+                known = len(current.get("messages", [])) if current else 0
+                events.extend(message_change(message) for message in payload["messages"][known:])
+                count += 1
+            # Las importaciones reemplazan historiales completos: el índice de texto se rehace al consultarlo.
+            self._search_index = None
+            self._record_changes(events)
+            self._write(data)
+        return count
 
-def ensure_patient(storage: PatientStorage, patient_id: str, name: str, contact: str, channel: str) -> Patient:
-    """Crea o actualiza un paciente asegurando que exista."""
-    patient = storage.get_patient(patient_id)
-    if patient is None:
-        patient = Patient(
-            patient_id=patient_id,
-            name=name,
-            contact=contact,
-            preferred_channel=MessagingChannel(channel),
+
+SAVE_RETRIES = 10
+
+
+def _backoff(attempt: int) -> None:
+    time.sleep(random.uniform(0, 0.005 * (attempt + 1)))
+
+
+def check_version(patient: Patient, current: Optional[Dict]) -> int:
+    """Devolver la versión guardada o lanzar :class:`ConflictError` si difiere de la leída."""
+    stored_version = current.get("version", 0) if current else 0
+    if current is not None and stored_version != patient.version:
+        raise ConflictError(
+            f"El paciente {patient.patient_id} fue modificado por otro proceso "
+            f"(versión {stored_version}, se esperaba {patient.version})."
         )
-    else:
-        patient.name = name
-        patient.contact = contact
-        patient.preferred_channel = MessagingChannel(channel)
-    storage.save_patient(patient)
-    return patient
+    return stored_version
+
+
+def update_patient(
+    storage: StorageBackend, patient_id: str, mutate: Callable[[Patient], None], retries: int = SAVE_RETRIES
+) -> Optional[Patient]:
+    """Leer, modificar y guardar un paciente reintentando si hay conflictos de versión.
+
+    Devuelve ``None`` si el paciente no existe.
+    """
+    for attempt in range(retries):
+        patient = storage.get_patient(patient_id)
+        if patient is None:
+            return None
+        mutate(patient)
+        try:
+            storage.save_patient(patient)
+        except ConflictError:
+            _backoff(attempt)
+            continue
+        return patient
+    raise ConflictError(f"No se pudo guardar el paciente {patient_id} tras {retries} intentos.")
+
+
+def ensure_patient(storage: StorageBackend, patient_id: str, name: str, contact: str, channel: str) -> Patient:
+    """Crea o actualiza un paciente asegurando que exista."""
+    preferred_channel = MessagingChannel(channel)
+    for attempt in range(SAVE_RETRIES):
+        patient = storage.get_patient(patient_id)
+        if patient is None:
+            patient = Patient(
+                patient_id=patient_id,
+                name=name,
+                contact=contact,
+                preferred_channel=preferred_channel,
+            )
+        else:
+            patient.name = name
+            patient.contact = contact
+            patient.preferred_channel = preferred_channel
+        try:
+            storage.save_patient(patient)
+        except ConflictError:
+            _backoff(attempt)
+            continue
+        return patient
+    raise ConflictError(f"No se pudo guardar el paciente {patient_id} tras {SAVE_RETRIES} intentos.")
+
+
+def parse_storage_spec(spec: str) -> Tuple[str, str]:
+    """Separar una especificación ``esquema:///ruta`` en esquema y ruta.
+
+    Una ruta sin esquema se interpreta como un archivo JSON tradicional. Tras
+    ``://`` se descarta una sola barra, de modo que ``sqlite:///datos/p.db`` es
+    la ruta relativa ``datos/p.db`` y ``sqlite:////var/datos/p.db`` la absoluta
+    ``/var/datos/p.db``.
+    """
+    if "://" not in spec:
+        return "json", spec
+    scheme, path = spec.split("://", 1)
+    if path.startswith("/"):
+        path = path[1:]
+    return scheme.lower(), path
+
+
+def open_storage(spec: str | Path, fsync: str | None = None) -> StorageBackend:
+    """Abrir el motor de almacenamiento indicado por ``spec``.
+
+    Esquemas soportados: ``json`` (por defecto), ``journal``, ``sqlite``,
+    ``sharded`` (un directorio de fragmentos, ver :mod:`patient_tracking.sharded`)
+    y ``binary`` (instantánea binaria con índice, ver :mod:`patient_tracking.snapshot`).
+    ``fsync`` es la política de sincronización a disco (ver :class:`FsyncPolicy`).
+    """
+    scheme, path = parse_storage_spec(str(spec))
+    if scheme == "json":
+        return PatientStorage(path, fsync=fsync)
+    if scheme == "journal":
+        from .journal import JournalStorage
+
+        return JournalStorage(path, fsync=fsync)
+    if scheme == "sqlite":
+        from .sqlite_storage import SQLiteStorage
+
+        return SQLiteStorage(path, fsync=fsync)
+    if scheme == "sharded":
+        from .sharded import ShardedStorage
+
+        return ShardedStorage(path, fsync=fsync)
+    if scheme == "binary":
+        from .snapshot import BinaryStorage
+
+        return BinaryStorage(path, fsync=fsync)
+    raise ValueError(f"Tipo de almacenamiento desconocido: '{scheme}'.")
@@ -1,8 +1,17 @@
-"""Plantillas de mensajes reutilizables."""
+"""Plantillas de mensajes reutilizables.
+
+Cada plantilla se compila una sola vez (con ``string.Formatter().parse``) en un
+:class:`CompiledTemplate` que conoce sus campos requeridos, valida los
+parámetros antes de renderizar y arma el texto uniendo trozos precalculados.
+``render_template`` guarda en una caché LRU los resultados de llamadas
+idénticas y ``render_many`` renderiza muchas filas de una vez.
+"""
 from __future__ import annotations
 
+import string
 from dataclasses import dataclass
-from typing import Dict
+from functools import lru_cache
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Mapping, Optional, Tuple
 
 
 @dataclass(frozen=True)
@@ -71,12 +80,128 @@ TEMPLATES: Dict[str, MessageTemplate] = {
 }
 
 
-def render_template(slug: str, **kwargs: str) -> MessageTemplate:
+class TemplateError(ValueError):
+    """Faltan parámetros requeridos por la plantilla."""
+
+
+_Piece = Tuple[str, Optional[str], str, Optional[str]]
+_NO_DEFAULTS: Mapping[str, object] = {}
+
+
+def _parse(text: str) -> Tuple[Tuple[_Piece, ...], FrozenSet[str]]:
+    """Separar ``text`` en trozos ``(literal, campo, formato, conversión)`` y sus campos raíz."""
+    pieces: List[_Piece] = []
+    fields = set()
+    for literal, field_name, format_spec, conversion in string.Formatter().parse(text):
+        if field_name is not None:
+            if not field_name or field_name.isdigit():
+                raise ValueError("Las plantillas solo admiten campos con nombre.")
+            fields.add(field_name.split(".", 1)[0].split("[", 1)[0])
+        pieces.append((literal, field_name, format_spec or "", conversion))
+    return tuple(pieces), frozenset(fields)
+
+
+def _render(pieces: Tuple[_Piece, ...], values: Mapping[str, object], defaults: Mapping[str, object]) -> str:
+    out = []
+    for literal, field_name, format_spec, conversion in pieces:
+        out.append(literal)
+        if field_name is None:
+            continue
+        if field_name in values:
+            value = values[field_name]
+        elif field_name in defaults:
+            value = defaults[field_name]
+        else:
+            value = string.Formatter().get_field(field_name, (), {**defaults, **values})[0]
+        if conversion is None and not format_spec and type(value) is str:
+            out.append(value)
+            continue
+        if conversion == "r":
+            value = repr(value)
+        elif conversion == "s":
+            value = str(value)
+        elif conversion == "a":
+            value = ascii(value)
+        out.append(format(value, format_spec))
+    return "".join(out)
+
+
+class CompiledTemplate:
+    """Plantilla ya analizada: campos requeridos y trozos listos para unir."""
+
+    __slots__ = ("slug", "fields", "_subject", "_body", "_static_subject")
+
+    def __init__(self, template: MessageTemplate) -> None:
+        self.slug = template.slug
+        self._subject, subject_fields = _parse(template.subject)
+        self._body, body_fields = _parse(template.body)
+        self.fields: FrozenSet[str] = subject_fields | body_fields
+        # Un asunto sin campos se comparte entre todos los mensajes renderizados.
+        self._static_subject = template.subject if not subject_fields else None
+
+    def missing(self, params: Iterable[str]) -> FrozenSet[str]:
+        return self.fields.difference(params)
+
+    def validate(self, params: Iterable[str]) -> None:
+        """Lanzar :class:`TemplateError` si faltan campos requeridos."""
+        missing = self.missing(params)
+        if missing:
+            raise TemplateError(f"Faltan parámetros para la plantilla '{self.slug}': {', '.join(sorted(missing))}.")
+
+    def render(self, values: Mapping[str, object], defaults: Mapping[str, object] = _NO_DEFAULTS) -> Tuple[str, str]:
+        """Devolver ``(asunto, cuerpo)``; ``values`` prevalece sobre ``defaults``.
+
+        No valida los parámetros (ver :meth:`validate`).
+        """
+        subject = self._static_subject
+        if subject is None:
+            subject = _render(self._subject, values, defaults)
+        return subject, _render(self._body, values, defaults)
+
+
+@lru_cache(maxsize=None)
+def _compile(template: MessageTemplate) -> CompiledTemplate:
+    return CompiledTemplate(template)
+
+
+def compile_template(slug: str) -> CompiledTemplate:
+    """Plantilla compilada para ``slug``; se compila la primera vez que se usa."""
     template = TEMPLATES.get(slug)
     if not template:
         raise KeyError(f"No existe la plantilla '{slug}'.")
-    return MessageTemplate(
-        slug=template.slug,
-        subject=template.subject.format(**kwargs),
-        body=template.body.format(**kwargs),
-    )
+    return _compile(template)
+
+
+@lru_cache(maxsize=4096)
+def _render_cached(template: MessageTemplate, items: Tuple[Tuple[str, object], ...]) -> MessageTemplate:
+    subject, body = _compile(template).render(dict(items))
+    return MessageTemplate(slug=template.slug, subject=subject, body=body)
+
+
+def render_template(slug: str, **kwargs: str) -> MessageTemplate:
+    compiled = compile_template(slug)
+    compiled.validate(kwargs)
+    template = TEMPLATES[slug]
+    try:
+        return _render_cached(template, tuple(sorted(kwargs.items())))
+    except TypeError:
+        # Algún valor no es hasheable: se renderiza sin caché.
+        subject, body = compiled.render(kwargs)
+        return MessageTemplate(slug=template.slug, subject=subject, body=body)
+
+
+def render_many(
+    slug: str, rows: Iterable[Mapping[str, object]], defaults: Optional[Mapping[str, object]] = None
+) -> Iterator[Tuple[str, str]]:
+    """Renderizar ``(asunto, cuerpo)`` para cada fila, combinada con ``defaults``.
+
+    Los campos que aportan ``defaults`` se validan una sola vez; en cada fila
+    solo se revisan los restantes.
+    """
+    compiled = compile_template(slug)
+    defaults = dict(defaults or {})
+    per_row = compiled.missing(defaults)
+    for row in rows:
+        if per_row and not per_row.issubset(row):
+            compiled.validate(set(defaults).union(row))
+        yield compiled.render(row, defaults)
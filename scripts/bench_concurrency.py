@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Stress benchmark: several processes running `marcar` and `enviar` on one store.
+
+Each worker process calls the CLI entry point (`patient_tracking.cli.main`) in a
+loop, alternating stage updates and messages over a shared set of patients. At the
+end the script checks that no update was lost (every stage that some worker
+marked is completed and the message count matches the number of sends) and
+reports throughput.
+
+Example:
+    python scripts/bench_concurrency.py --processes 8 --operations 200
+    python scripts/bench_concurrency.py --storage journal:///bench/patients.json
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from patient_tracking.cli import main as cli_main  # noqa: E402
+from patient_tracking.storage import open_storage  # noqa: E402
+from patient_tracking.workflow import STAGES  # noqa: E402
+
+
+def plan(worker: int, operations: int, patients: int):
+    """Deterministic list of (patient_id, stage_id) updates for a worker."""
+    for index in range(operations):
+        slot = worker * operations + index
+        yield f"P{slot % patients:04d}", STAGES[(slot // patients) % len(STAGES)].id
+
+
+def worker(storage: str, worker_id: int, operations: int, patients: int) -> None:
+    with contextlib.redirect_stdout(io.StringIO()):
+        for patient_id, stage_id in plan(worker_id, operations, patients):
+            cli_main(["--storage", storage, "--fsync", "never", "marcar", patient_id, str(stage_id)])
+            cli_main(
+                [
+                    "--storage",
+                    storage,
+                    "--fsync",
+                    "never",
+                    "enviar",
+                    patient_id,
+                    "--subject",
+                    f"w{worker_id}",
+                    "--body",
+                    f"etapa {stage_id}",
+                ]
+            )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--operations", type=int, default=100, help="marcar+enviar pairs per process")
+    parser.add_argument("--patients", type=int, default=20)
+    parser.add_argument("--storage", help="Storage spec (default: a temporary JSON file)")
+    args = parser.parse_args()
+
+    tmpdir = tempfile.TemporaryDirectory()
+    storage_spec = args.storage or str(Path(tmpdir.name) / "patients.json")
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index in range(args.patients):
+            cli_main(["--storage", storage_spec, "registrar", f"P{index:04d}", f"Paciente {index}", "000"])
+
+    processes = [
+        multiprocessing.Process(target=worker, args=(storage_spec, worker_id, args.operations, args.patients))
+        for worker_id in range(args.processes)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+
+    expected = {pair for worker_id in range(args.processes) for pair in plan(worker_id, args.operations, args.patients)}
+    with open_storage(storage_spec) as storage:
+        stored = {patient.patient_id: patient for patient in storage.list_patients()}
+    lost_stages = [
+        (patient_id, stage_id)
+        for patient_id, stage_id in expected
+        if stage_id not in stored[patient_id].completed_stages()
+    ]
+    messages = sum(len(patient.messages) for patient in stored.values())
+    sends = args.processes * args.operations
+    failed = [process.exitcode for process in processes if process.exitcode]
+
+    total_ops = 2 * sends
+    print(f"storage:          {storage_spec}")
+    print(f"processes:        {args.processes}")
+    print(f"operations:       {total_ops} ({sends} marcar + {sends} enviar)")
+    print(f"elapsed:          {elapsed:.2f}s")
+    print(f"throughput:       {total_ops / elapsed:.1f} ops/s")
+    print(f"messages stored:  {messages}/{sends}")
+    print(f"lost stage marks: {len(lost_stages)}")
+    if failed:
+        print(f"worker failures:  {failed}")
+    tmpdir.cleanup()
+    return 0 if messages == sends and not lost_stages and not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""HTTP load test: throughput and latency percentiles of `patient_tracking servir`.
+
+Starts the service on a temporary store (or targets `--url`), seeds patients
+with one `POST /lote`, and runs `--clients` threads issuing a read-heavy mix:
+
+* 70% `GET /pacientes/<id>` with `If-None-Match` (ETag remembered per client);
+* 10% `GET /pacientes/<id>` without ETag;
+* 10% `POST /pacientes/<id>/etapas`;
+* 10% `POST /pacientes/<id>/mensajes`.
+
+Each client keeps one keep-alive connection unless `--no-keepalive` is given.
+`--cli N` also times N `python -m patient_tracking ver` invocations, the cost
+each request paid before the service existed.
+
+Example:
+    python scripts/bench_http.py --storage sqlite --patients 2000 --clients 8 --requests 20000
+"""
+from __future__ import annotations
+
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+ROOT = Path(__file__).resolve().parents[1]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(storage_spec: str, port: int) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    process = subprocess.Popen(
+        [sys.executable, "-m", "patient_tracking", "--storage", storage_spec, "servir", "--puerto", str(port)],
+        env=env,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+
+def request(
+    conn: http.client.HTTPConnection, method: str, path: str, body: Optional[object] = None,
+    headers: Optional[Dict[str, str]] = None,
+) -> Tuple[int, bytes, Optional[str]]:
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    conn.request(method, path, body=data, headers={"Content-Type": "application/json", **(headers or {})})
+    response = conn.getresponse()
+    return response.status, response.read(), response.getheader("ETag")
+
+
+def seed(host: str, port: int, patients: int) -> None:
+    conn = http.client.HTTPConnection(host, port)
+    operations = [
+        {"op": "registrar", "patient_id": f"P{index:06d}", "name": f"Paciente {index}", "contact": f"+569{index:08d}"}
+        for index in range(patients)
+    ]
+    status, body, _ = request(conn, "POST", "/lote", operations)
+    if status != 200:
+        raise RuntimeError(f"seeding failed: {status} {body[:200]!r}")
+    conn.close()
+
+
+class Client(threading.Thread):
+    def __init__(self, host: str, port: int, patients: int, requests: int, keepalive: bool, seed: int) -> None:
+        super().__init__(daemon=True)
+        self.host, self.port = host, port
+        self.patients = patients
+        self.requests = requests
+        self.keepalive = keepalive
+        self.rng = random.Random(seed)
+        self.latencies: List[float] = []
+        self.statuses: Counter = Counter()
+        self.etags: Dict[str, str] = {}
+
+    def run(self) -> None:
+        conn = http.client.HTTPConnection(self.host, self.port)
+        for _ in range(self.requests):
+            patient_id = f"P{self.rng.randrange(self.patients):06d}"
+            roll = self.rng.random()
+            start = time.perf_counter()
+            if roll < 0.8:
+                headers = {"If-None-Match": self.etags[patient_id]} if roll < 0.7 and patient_id in self.etags else {}
+                status, _, etag = request(conn, "GET", f"/pacientes/{patient_id}", headers=headers)
+                if etag:
+                    self.etags[patient_id] = etag
+            elif roll < 0.9:
+                status, _, _ = request(
+                    conn, "POST", f"/pacientes/{patient_id}/etapas",
+                    {"stage_id": self.rng.randint(1, 17), "pendiente": self.rng.random() < 0.2},
+                )
+            else:
+                status, _, _ = request(
+                    conn, "POST", f"/pacientes/{patient_id}/mensajes",
+                    {"template": "confirmar_cita", "params": {"appointment_date": "1/7"}},
+                )
+            self.latencies.append(time.perf_counter() - start)
+            self.statuses[status] += 1
+            if not self.keepalive:
+                conn.close()
+                conn = http.client.HTTPConnection(self.host, self.port)
+        conn.close()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def cli_baseline(storage_spec: str, runs: int) -> float:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    start = time.perf_counter()
+    for index in range(runs):
+        subprocess.run(
+            [sys.executable, "-m", "patient_tracking", "--storage", storage_spec, "ver", f"P{index:06d}"],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+    return (time.perf_counter() - start) / runs
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="target an already running service instead of starting one")
+    parser.add_argument("--storage", default="json", choices=["json", "journal", "sqlite"])
+    parser.add_argument("--patients", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=10000, help="total requests across all clients")
+    parser.add_argument("--no-keepalive", action="store_true", help="open a new connection per request")
+    parser.add_argument("--cli", type=int, default=0, metavar="N", help="also time N CLI 'ver' invocations")
+    args = parser.parse_args()
+
+    process = None
+    with tempfile.TemporaryDirectory() as tmp:
+        suffix = "db" if args.storage == "sqlite" else "json"
+        storage_spec = f"{args.storage}:///{tmp}/patients.{suffix}"
+        if args.url:
+            parts = urlsplit(args.url)
+            host, port = parts.hostname or "127.0.0.1", parts.port or 80
+        else:
+            host, port = "127.0.0.1", free_port()
+            process = start_server(storage_spec, port)
+        try:
+            seed(host, port, args.patients)
+            clients = [
+                Client(host, port, args.patients, args.requests // args.clients, not args.no_keepalive, seed)
+                for seed in range(args.clients)
+            ]
+            start = time.perf_counter()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+        latencies = [value for client in clients for value in client.latencies]
+        statuses: Counter = Counter()
+        for client in clients:
+            statuses.update(client.statuses)
+        print(f"target:       {args.url or storage_spec}")
+        print(f"clients:      {args.clients} ({'new connection per request' if args.no_keepalive else 'keep-alive'})")
+        print(f"requests:     {len(latencies)} in {elapsed:.2f}s -> {len(latencies) / elapsed:,.0f} req/s")
+        print(
+            f"latency ms:   p50 {statistics.median(latencies) * 1000:.2f}  "
+            f"p90 {percentile(latencies, 0.9) * 1000:.2f}  p99 {percentile(latencies, 0.99) * 1000:.2f}  "
+            f"max {max(latencies) * 1000:.2f}"
+        )
+        print("statuses:     " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+        if args.cli and not args.url:
+            per_call = cli_baseline(storage_spec, args.cli)
+            print(f"cli 'ver':    {per_call * 1000:.1f} ms per invocation ({args.cli} runs)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
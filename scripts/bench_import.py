@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""Bulk import benchmark: `importar` against `lote` and per-row `registrar`.
+
+A synthetic CSV/JSONL file with `--rows` patients (1% of them invalid: unknown
+channel, bad stage id, missing contact) is generated once, then imported into a
+fresh store per backend with:
+
+* `importar --procesos N` for every N in `--procesos` (parallel validation,
+  one merge inside `storage.batch()`);
+* `lote` with one `registrar` plus one `marcar` per completed stage for each
+  row (also one batch, but validated and applied one operation at a time);
+* `registrar` once per row, one process each, on the first `--registrar-rows`
+  rows only and extrapolated to `--rows` (it is far too slow to run in full).
+
+Each run is a separate `python -m patient_tracking` process and reports wall
+time and rows per second. A second `importar` over the now-populated store
+measures the update path.
+
+Example:
+    python scripts/bench_import.py --rows 100000 --storage json,sqlite --procesos 1,4
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+ROOT = Path(__file__).resolve().parents[1]
+SPECS = {
+    "json": "{tmp}/patients.json",
+    "journal": "journal:///{tmp}/patients.json",
+    "sqlite": "sqlite:///{tmp}/patients.db",
+    "sharded": "sharded:///{tmp}/patients",
+}
+FIELDS = ["patient_id", "name", "contact", "channel", "notes", "surgery_date", "stage_status"]
+
+
+def generate_rows(count: int, seed: int = 3) -> List[Dict[str, str]]:
+    rng = random.Random(seed)
+    rows = []
+    for index in range(count):
+        row = {
+            "patient_id": f"C{index:07d}",
+            "name": f"Paciente {index}",
+            "contact": f"+56 9 {rng.randrange(10 ** 8):08d}",
+            "channel": rng.choice(["chat", "sms"]),
+            "notes": "" if rng.random() < 0.7 else "derivado desde otra clínica",
+            "surgery_date": "" if rng.random() < 0.5 else f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            "stage_status": ";".join(str(stage) for stage in range(1, rng.randint(1, 10))),
+        }
+        if rng.random() < 0.01:
+            row[rng.choice(["channel", "stage_status", "contact"])] = rng.choice(["fax", "99", ""])
+        rows.append(row)
+    return rows
+
+
+def write_file(rows: List[Dict[str, str]], path: Path, fmt: str) -> None:
+    with path.open("w", encoding="utf-8", newline="") as stream:
+        if fmt == "csv":
+            writer = csv.DictWriter(stream, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+
+def lote_operations(row: Dict[str, str]) -> List[Dict[str, str]]:
+    """The `lote` equivalent of one import row: `registrar` plus one `marcar` per completed stage."""
+    operations = [{"op": "registrar", **{key: row[key] for key in ("patient_id", "name", "contact", "channel")}}]
+    for stage_id in filter(None, row["stage_status"].split(";")):
+        operations.append({"op": "marcar", "patient_id": row["patient_id"], "stage_id": stage_id})
+    return operations
+
+
+def cli(spec: str, *argv: str, stdin: str | None = None) -> float:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    command = [sys.executable, "-m", "patient_tracking", "--storage", spec, "--fsync", "never", *argv]
+    start = time.perf_counter()
+    result = subprocess.run(command, input=stdin, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr[-2000:]}")
+    return elapsed
+
+
+def report(label: str, rows: int, seconds: float) -> None:
+    print(f"  {label:<28} {seconds:9.2f} s  {rows / seconds:>11,.0f} rows/s")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--storage", default="json,journal,sqlite,sharded", help="comma-separated backends")
+    parser.add_argument("--formato", choices=["csv", "jsonl"], default="csv")
+    parser.add_argument("--procesos", default=f"1,{os.cpu_count() or 1}", help="comma-separated worker counts")
+    parser.add_argument("--no-lote", action="store_true", help="skip the lote baseline")
+    parser.add_argument("--registrar-rows", type=int, default=200, help="rows for the per-row registrar baseline")
+    args = parser.parse_args()
+
+    backends = [backend.strip() for backend in args.storage.split(",")]
+    unknown = set(backends) - set(SPECS)
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+    workers = sorted({int(count) for count in args.procesos.split(",")})
+
+    rows = generate_rows(args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / f"rows.{args.formato}"
+        write_file(rows, source, args.formato)
+        lote_input = "".join(json.dumps(operation) + "\n" for row in rows for operation in lote_operations(row))
+        print(f"{args.rows} rows, {source.stat().st_size / 2 ** 20:.1f} MiB {args.formato}, {os.cpu_count()} CPUs")
+        for backend in backends:
+            print(f"{backend}:")
+            for count in workers:
+                with tempfile.TemporaryDirectory(dir=tmp) as store:
+                    spec = SPECS[backend].format(tmp=store)
+                    command = ("importar", str(source), "--procesos", str(count))
+                    report(f"importar --procesos {count}", args.rows, cli(spec, *command))
+                    if count == workers[-1]:
+                        report("importar (update)", args.rows, cli(spec, *command))
+            if not args.no_lote:
+                with tempfile.TemporaryDirectory(dir=tmp) as store:
+                    spec = SPECS[backend].format(tmp=store)
+                    report("lote registrar+marcar", args.rows, cli(spec, "lote", stdin=lote_input))
+            if args.registrar_rows:
+                with tempfile.TemporaryDirectory(dir=tmp) as store:
+                    spec = SPECS[backend].format(tmp=store)
+                    sample = rows[: args.registrar_rows]
+                    start = time.perf_counter()
+                    for row in sample:
+                        cli(spec, "registrar", row["patient_id"], row["name"], row["contact"] or "-",
+                            "--channel", row["channel"] if row["channel"] in ("chat", "sms") else "chat")
+                    per_row = (time.perf_counter() - start) / len(sample)
+                    report(f"registrar x{len(sample)} (extrapolated)", args.rows, per_row * args.rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
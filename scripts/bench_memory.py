@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""Memory benchmark: per-patient footprint of the in-memory Patient representation.
+
+Builds the same synthetic patients twice and measures the allocated memory with
+`tracemalloc`:
+
+* legacy: the previous layout (regular dataclasses, `stage_status` as a
+  `Dict[str, bool]` keyed by stringified stage ids);
+* current: `Patient`/`MessageRecord` with `__slots__` and stage state kept as
+  bitmasks.
+
+It also times `completed_stages()` / `pending_stages()` over all patients.
+
+Example:
+    python scripts/bench_memory.py --patients 50000 --messages 2
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from patient_tracking.messaging import MessagingChannel  # noqa: E402
+from patient_tracking.storage import Patient  # noqa: E402
+from patient_tracking.workflow import STAGES  # noqa: E402
+
+
+@dataclass
+class LegacyMessage:
+    patient_id: str
+    subject: str
+    body: str
+    channel: MessagingChannel
+    sent_at: str
+
+
+@dataclass
+class LegacyPatient:
+    patient_id: str
+    name: str
+    contact: str
+    preferred_channel: MessagingChannel = MessagingChannel.CHAT
+    notes: str = ""
+    stage_status: Dict[str, bool] = field(default_factory=dict)
+    messages: List[LegacyMessage] = field(default_factory=list)
+    version: int = 0
+
+    def completed_stages(self) -> List[int]:
+        return [int(stage_id) for stage_id, completed in self.stage_status.items() if completed]
+
+    def pending_stages(self) -> List[int]:
+        completed = set(self.completed_stages())
+        return [stage.id for stage in STAGES if stage.id not in completed]
+
+
+def make_payloads(count: int, messages: int, seed: int = 7) -> List[Dict]:
+    rng = random.Random(seed)
+    payloads = []
+    for index in range(count):
+        patient_id = f"P{index:06d}"
+        done = rng.randint(0, len(STAGES))
+        payloads.append(
+            {
+                "patient_id": patient_id,
+                "name": f"Paciente {index}",
+                "contact": f"+56 9 {index:08d}",
+                "preferred_channel": "chat",
+                "notes": "",
+                "stage_status": {str(stage.id): stage.id <= done for stage in STAGES[: done + 1]},
+                "messages": [
+                    {
+                        "patient_id": patient_id,
+                        "subject": f"Seguimiento {number}",
+                        "body": "Hola, te escribimos para continuar con tu proceso.",
+                        "channel": "chat",
+                        "sent_at": "2024-01-01T10:00:00",
+                    }
+                    for number in range(messages)
+                ],
+            }
+        )
+    return payloads
+
+
+def build_legacy(payload: Dict) -> LegacyPatient:
+    return LegacyPatient(
+        patient_id=payload["patient_id"],
+        name=payload["name"],
+        contact=payload["contact"],
+        preferred_channel=MessagingChannel(payload["preferred_channel"]),
+        notes=payload["notes"],
+        stage_status=dict(payload["stage_status"]),
+        messages=[
+            LegacyMessage(
+                patient_id=msg["patient_id"],
+                subject=msg["subject"],
+                body=msg["body"],
+                channel=MessagingChannel(msg["channel"]),
+                sent_at=msg["sent_at"],
+            )
+            for msg in payload["messages"]
+        ],
+    )
+
+
+def measure(label: str, payloads: List[Dict], build: Callable[[Dict], object]) -> int:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    patients = [build(payload) for payload in payloads]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for patient in patients:
+        patient.completed_stages()
+        patient.pending_stages()
+    elapsed = time.perf_counter() - start
+    print(
+        f"{label:<8} {allocated / 1024 / 1024:8.1f} MiB  {allocated / len(patients):7.0f} B/patient  "
+        f"stage queries: {elapsed * 1000:7.1f} ms"
+    )
+    return allocated
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=20000)
+    parser.add_argument("--messages", type=int, default=0, help="messages per patient")
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.patients, args.messages)
+    # The payloads share their strings with both representations, so only the
+    # objects built on top of them are counted.
+    legacy = measure("legacy", payloads, build_legacy)
+    current = measure("current", payloads, Patient.from_dict)
+    print(f"reduction: {100 * (1 - current / legacy):.1f}%")
+    assert Patient.from_dict(payloads[0]).completed_stages() == build_legacy(payloads[0]).completed_stages()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
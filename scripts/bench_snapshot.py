@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Load-time benchmark: JSON document against the mmap binary snapshot.
+
+A JSON store with `--patients` synthetic patients is generated, converted to
+the binary snapshot (`convertir`), and then both formats are timed:
+
+* size on disk;
+* load: `json.load` of the whole document against opening the snapshot
+  (mmap, header and extra section only);
+* cold get_patient: open the store and read one random patient, in-process;
+* cold save_patient: open, mark a stage, save and close;
+* scan: `iter_patients()` over the whole store;
+* cli ver / cli marcar: `python -m patient_tracking` end to end, one process
+  per call, so interpreter start-up is included;
+* convert: `convertir` in both directions.
+
+Every measurement is repeated `--runs` times (with the page cache warm) and the
+median is reported.
+
+Example:
+    python scripts/bench_snapshot.py --patients 100000 --messages 3 --runs 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "scripts"))
+
+from bench_suite import generate_patients  # noqa: E402
+from patient_tracking.snapshot import SnapshotReader, convert_snapshot  # noqa: E402
+from patient_tracking.storage import PatientStorage, open_storage  # noqa: E402
+
+
+def median_seconds(call: Callable[[], object], runs: int) -> float:
+    samples: List[float] = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def cli(spec: str, *argv: str) -> None:
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    command = [sys.executable, "-m", "patient_tracking", "--storage", spec, "--fsync", "never", *argv]
+    result = subprocess.run(command, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr[-2000:]}")
+
+
+def report(label: str, json_seconds: float, binary_seconds: float) -> None:
+    print(
+        f"{label:<22} {json_seconds * 1000:>11.1f} ms {binary_seconds * 1000:>11.1f} ms"
+        f" {json_seconds / binary_seconds:>8.1f}x"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=100_000)
+    parser.add_argument("--messages", type=int, default=3, help="messages per patient")
+    parser.add_argument("--distribution", default="funnel", choices=["uniform", "funnel", "early", "late"])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    def pick_id() -> str:
+        return f"P{rng.randrange(args.patients):07d}"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path, binary_path = Path(tmp) / "patients.json", Path(tmp) / "patients.bin"
+        store = PatientStorage(json_path, fsync="never", changes=False)
+        store.import_patients(generate_patients(args.patients, args.messages, args.distribution, args.seed))
+        store.close()
+        to_binary = median_seconds(lambda: convert_snapshot(json_path, binary_path, "binary"), args.runs)
+        to_json = median_seconds(lambda: convert_snapshot(binary_path, Path(tmp) / "back.json", "json"), args.runs)
+        specs = {"json": str(json_path), "binary": f"binary:///{binary_path}"}
+
+        def load_json() -> None:
+            with json_path.open("r", encoding="utf-8") as fp:
+                json.load(fp)
+
+        def cold_get(spec: str) -> Callable[[], None]:
+            def call() -> None:
+                with open_storage(spec, fsync="never") as opened:
+                    opened.get_patient(pick_id())
+
+            return call
+
+        def cold_save(spec: str) -> Callable[[], None]:
+            def call() -> None:
+                with open_storage(spec, fsync="never") as opened:
+                    patient = opened.get_patient(pick_id())
+                    patient.mark_stage(rng.randint(1, 5), rng.random() < 0.5)
+                    opened.save_patient(patient)
+
+            return call
+
+        def scan(spec: str) -> Callable[[], None]:
+            def call() -> None:
+                with open_storage(spec, fsync="never") as opened:
+                    for _ in opened.iter_patients(include_messages=False):
+                        pass
+
+            return call
+
+        json_size, binary_size = json_path.stat().st_size, binary_path.stat().st_size
+        print(f"{args.patients} patients, {args.messages} messages each, {args.runs} runs (median)")
+        print(f"{'':<22} {'json':>14} {'binary':>14} {'speedup':>9}")
+        print(
+            f"{'size':<22} {json_size / 2 ** 20:>11.1f} MiB {binary_size / 2 ** 20:>10.1f} MiB"
+            f" {json_size / binary_size:>8.1f}x"
+        )
+        report("load", median_seconds(load_json, args.runs), median_seconds(lambda: SnapshotReader(binary_path),
+                                                                             args.runs))
+        for label, factory in (("cold get_patient", cold_get), ("cold save_patient", cold_save), ("scan", scan)):
+            report(label, *(median_seconds(factory(spec), args.runs) for spec in specs.values()))
+        report("cli ver", *(median_seconds(lambda spec=spec: cli(spec, "ver", pick_id()), args.runs)
+                            for spec in specs.values()))
+        report("cli marcar", *(median_seconds(lambda spec=spec: cli(spec, "marcar", pick_id(), "3"), args.runs)
+                               for spec in specs.values()))
+        print(f"{'convert':<22} {to_json * 1000:>11.1f} ms {to_binary * 1000:>11.1f} ms  (to json / to binary)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
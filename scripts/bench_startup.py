@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Startup benchmark and gate: import time and wall time of short CLI invocations.
+
+Cron jobs spawn `python -m patient_tracking` thousands of times, so what a short
+command imports matters more than what it computes. Each scenario runs in a
+fresh interpreter with `-X importtime`, several times, and reports:
+
+* wall time (median over `--runs`, and minus a bare `python -c pass`);
+* import time (sum of the self times reported by `-X importtime`) and number
+  of modules, leaving out the modules a bare interpreter already imports.
+
+The run fails (exit code 1) when a scenario imports more than `--max-modules`
+modules or spends more than `--max-import-ms` importing them, imports a module
+it must not need (NumPy, asyncio, the HTTP server, SQLite for a JSON store, the
+storage layer for `flujo`), or when `flujo` creates the data directory. The
+module count is deterministic; the time limit is loose because import times
+are noisy on shared machines.
+
+Example:
+    python scripts/bench_startup.py --runs 10
+    python scripts/bench_startup.py --max-modules 90 --max-import-ms 60
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+ROOT = Path(__file__).resolve().parents[1]
+
+HEAVY = ("numpy", "asyncio", "http.server", "sqlite3", "patient_tracking.analytics", "patient_tracking.server")
+SCENARIOS: Dict[str, Tuple[List[str], Sequence[str]]] = {
+    "flujo": (["flujo"], HEAVY + ("patient_tracking.storage", "json")),
+    "ver": (["--storage", "patients.json", "ver", "P0001"], HEAVY),
+    "marcar": (["--storage", "patients.json", "marcar", "P0001", "3"], HEAVY),
+    "historial": (["--storage", "patients.json", "historial", "P0001"], HEAVY),
+}
+
+
+def parse_importtime(stderr: str) -> Dict[str, float]:
+    """Module name -> self import time in milliseconds."""
+    modules: Dict[str, float] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, _cumulative, name = line[len("import time:"):].split("|", 2)
+        modules[name.strip()] = int(self_us) / 1000
+    return modules
+
+
+def run(command: List[str], cwd: str, env: Dict[str, str]) -> Tuple[float, Dict[str, float]]:
+    start = time.perf_counter()
+    result = subprocess.run(command, cwd=cwd, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed:\n{result.stderr[-2000:]}")
+    return elapsed, parse_importtime(result.stderr)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-modules", type=int, default=120, help="fail when a scenario imports more modules")
+    parser.add_argument(
+        "--max-import-ms", type=float, default=150.0, help="fail when a scenario's median import time exceeds this"
+    )
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="default: all")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=str(ROOT))
+    failures: List[str] = []
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run(
+            [sys.executable, "-m", "patient_tracking", "--storage", "patients.json", "registrar", "P0001", "Ana", "1"],
+            cwd=tmp,
+            env=env,
+            check=True,
+            capture_output=True,
+        )
+        bare_runs = [run([sys.executable, "-X", "importtime", "-c", "pass"], tmp, env) for _ in range(args.runs)]
+        bare = statistics.median(wall for wall, _ in bare_runs)
+        startup_modules = set(bare_runs[0][1])
+        print(f"python -c pass: {bare * 1000:.1f} ms, {len(startup_modules)} modules")
+        for name in args.scenario or list(SCENARIOS):
+            argv, forbidden = SCENARIOS[name]
+            # Without a data/ directory, flujo must leave the working directory untouched.
+            workdir = tempfile.mkdtemp(dir=tmp) if name == "flujo" else tmp
+            walls: List[float] = []
+            imports: List[float] = []
+            for _ in range(args.runs):
+                wall, modules = run([sys.executable, "-X", "importtime", "-m", "patient_tracking", *argv], workdir, env)
+                modules = {module: ms for module, ms in modules.items() if module not in startup_modules}
+                walls.append(wall)
+                imports.append(sum(modules.values()))
+            wall, imported = statistics.median(walls), statistics.median(imports)
+            print(
+                f"{name:<10} wall {wall * 1000:7.1f} ms (+{(wall - bare) * 1000:6.1f} over bare python)  "
+                f"imports {imported:6.1f} ms, {len(modules)} modules"
+            )
+            if len(modules) > args.max_modules:
+                failures.append(f"{name}: imports {len(modules)} modules (limit {args.max_modules})")
+            if imported > args.max_import_ms:
+                failures.append(f"{name}: imports take {imported:.1f} ms (limit {args.max_import_ms:.1f} ms)")
+            loaded = sorted(module for module in forbidden if module in modules)
+            if loaded:
+                failures.append(f"{name}: loads {', '.join(loaded)}")
+            if name == "flujo" and os.listdir(workdir):
+                failures.append(f"flujo: created {', '.join(sorted(os.listdir(workdir)))}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+"""Benchmark suite: storage, messaging and CLI hot paths at several store sizes.
+
+For every backend and size a synthetic store is generated (patients, messages
+per patient and a stage distribution) and imported in one go; then each
+operation is timed call by call:
+
+* open_storage: open the store and read one patient (cold start);
+* get_patient, save_patient (mark a stage and save), save_message,
+  send_message (`MessagingService`), list_patients (full scan);
+* render_template: `confirmar_cita` with a different name per call;
+* cli ver / cli marcar: `patient_tracking.cli.main([...])` end to end, store
+  loading included.
+
+Each backend/size case runs in its own process so its peak RSS is reported
+separately. An operation stops after `--ops` calls or `--budget` seconds,
+whichever comes first, so the slow paths of large JSON stores still finish.
+
+Results are written as JSON (`--output`); `--compare` reads an earlier result
+file, prints the change per operation and exits with 1 when an operation's
+throughput dropped more than `--threshold`.
+
+Example:
+    python scripts/bench_suite.py --sizes 1000,10000 --storage json,sqlite --output bench.json
+    python scripts/bench_suite.py --sizes 1000,10000 --storage json,sqlite --compare bench.json
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from patient_tracking.cli import main as cli_main  # noqa: E402
+from patient_tracking.messaging import MessageRecord, MessagingChannel, MessagingService  # noqa: E402
+from patient_tracking.storage import Patient, open_storage  # noqa: E402
+from patient_tracking.templates import render_template  # noqa: E402
+from patient_tracking.workflow import STAGES  # noqa: E402
+
+DISTRIBUTIONS = ("uniform", "funnel", "early", "late")
+SUFFIXES = {"json": "json", "journal": "json", "sqlite": "db", "sharded": "d", "binary": "bin"}
+
+
+def completed_count(distribution: str, rng: random.Random) -> int:
+    """Number of leading stages completed by one synthetic patient."""
+    total = len(STAGES)
+    if distribution == "uniform":
+        return rng.randint(0, total)
+    if distribution == "early":
+        return min(total, int(rng.expovariate(1 / 3)))
+    if distribution == "late":
+        return max(0, total - int(rng.expovariate(1 / 3)))
+    # funnel: every stage keeps ~85% of the patients that reached the previous one.
+    count = 0
+    while count < total and rng.random() < 0.85:
+        count += 1
+    return count
+
+
+def generate_patients(count: int, messages: int, distribution: str, seed: int = 11) -> Iterator[Patient]:
+    rng = random.Random(seed)
+    start = datetime(2024, 1, 1)
+    channels = list(MessagingChannel)
+    for index in range(count):
+        patient_id = f"P{index:07d}"
+        patient = Patient(
+            patient_id=patient_id,
+            name=f"Paciente {index}",
+            contact=f"+56 9 {rng.randrange(10 ** 8):08d}",
+            preferred_channel=rng.choice(channels),
+        )
+        moment = start + timedelta(minutes=rng.randrange(60 * 24 * 90))
+        for stage in STAGES[: completed_count(distribution, rng)]:
+            moment += timedelta(hours=rng.randrange(1, 72))
+            patient.mark_stage(stage.id, at=moment.isoformat(timespec="seconds"))
+        patient.messages = [
+            MessageRecord(
+                patient_id,
+                f"Seguimiento {number}",
+                "Hola, te escribimos para continuar con tu proceso de preparación.",
+                patient.preferred_channel,
+                (moment + timedelta(hours=number)).isoformat(timespec="seconds"),
+            )
+            for number in range(messages)
+        ]
+        yield patient
+
+
+def summarize(operation: str, latencies: List[float]) -> Dict:
+    ordered = sorted(latencies)
+
+    def pick(fraction: float) -> float:
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {
+        "operation": operation,
+        "calls": len(ordered),
+        "ops_per_sec": len(ordered) / sum(ordered) if sum(ordered) else None,
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": pick(0.5),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def timed(operation: str, call: Callable[[int], object], ops: int, budget: float) -> Dict:
+    latencies: List[float] = []
+    deadline = time.perf_counter() + budget
+    for index in range(ops):
+        start = time.perf_counter()
+        call(index)
+        end = time.perf_counter()
+        latencies.append(end - start)
+        if end > deadline:
+            break
+    return summarize(operation, latencies)
+
+
+def peak_rss_mib() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def run_case(backend: str, patients: int, options: Dict) -> Dict:
+    """Generate, import and time one backend/size; runs in a child process."""
+    rng = random.Random(5)
+    with tempfile.TemporaryDirectory() as tmp:
+        spec = f"{backend}:///{tmp}/patients.{SUFFIXES[backend]}"
+        storage = open_storage(spec, fsync=options["fsync"])
+        start = time.perf_counter()
+        storage.import_patients(
+            generate_patients(patients, options["messages"], options["distribution"], options["seed"])
+        )
+        storage.close()
+        import_seconds = time.perf_counter() - start
+
+        def pick_id() -> str:
+            return f"P{rng.randrange(patients):07d}"
+
+        ops, budget = options["ops"], options["budget"]
+        results = []
+
+        def cold_open(_index: int) -> None:
+            opened = open_storage(spec, fsync=options["fsync"])
+            opened.get_patient(pick_id())
+            opened.close()
+
+        results.append(timed("open_storage", cold_open, ops, budget))
+
+        storage = open_storage(spec, fsync=options["fsync"])
+        storage.get_patient(pick_id())  # warm the cache before the steady-state operations
+
+        def save_patient(_index: int) -> None:
+            patient = storage.get_patient(pick_id())
+            patient.mark_stage(rng.choice(STAGES).id, rng.random() < 0.8)
+            storage.save_patient(patient)
+
+        def save_message(index: int) -> None:
+            storage.save_message(
+                MessageRecord.create(pick_id(), "Recordatorio", f"Mensaje de prueba {index}", MessagingChannel.CHAT)
+            )
+
+        service = MessagingService(storage)
+        results.append(timed("get_patient", lambda _index: storage.get_patient(pick_id()), ops, budget))
+        results.append(timed("save_patient", save_patient, ops, budget))
+        results.append(timed("save_message", save_message, ops, budget))
+        results.append(
+            timed(
+                "send_message",
+                lambda index: service.send_message(pick_id(), "Aviso", f"Envío {index}", MessagingChannel.SMS),
+                ops,
+                budget,
+            )
+        )
+        results.append(timed("list_patients", lambda _index: storage.list_patients(), ops, budget))
+        storage.close()
+
+        results.append(
+            timed(
+                "render_template",
+                lambda index: render_template("confirmar_cita", name=f"Paciente {index}", appointment_date="1/7"),
+                ops,
+                budget,
+            )
+        )
+
+        base = ["--storage", spec, "--fsync", options["fsync"]]
+        with contextlib.redirect_stdout(io.StringIO()):
+            results.append(timed("cli ver", lambda _index: cli_main(base + ["ver", pick_id()]), ops, budget))
+            results.append(
+                timed(
+                    "cli marcar",
+                    lambda _index: cli_main(base + ["marcar", pick_id(), str(rng.choice(STAGES).id)]),
+                    ops,
+                    budget,
+                )
+            )
+
+    for result in results:
+        result.update(backend=backend, patients=patients)
+    return {
+        "backend": backend,
+        "patients": patients,
+        "import_seconds": import_seconds,
+        "peak_rss_mib": peak_rss_mib(),
+        "results": results,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict, baseline: Dict, threshold: float) -> int:
+    """Print the change against ``baseline``; return how many operations regressed."""
+    previous = {
+        (result["backend"], result["patients"], result["operation"]): result
+        for case in baseline["cases"]
+        for result in case["results"]
+    }
+    regressions = 0
+    print(f"\ncompared with {baseline['meta'].get('revision') or 'baseline'} ({baseline['meta']['timestamp']}):")
+    for case in current["cases"]:
+        for result in case["results"]:
+            old = previous.get((result["backend"], result["patients"], result["operation"]))
+            if old is None or not old["ops_per_sec"] or not result["ops_per_sec"]:
+                continue
+            change = result["ops_per_sec"] / old["ops_per_sec"] - 1
+            flag = ""
+            if change < -threshold:
+                regressions += 1
+                flag = "  REGRESSION"
+            print(
+                f"  {result['backend']:<8} {result['patients']:>7} {result['operation']:<16} "
+                f"ops/s {change:+7.1%}  p99 {old['p99_ms']:9.3f} -> {result['p99_ms']:9.3f} ms{flag}"
+            )
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated patient counts")
+    parser.add_argument("--storage", default="json,journal,sqlite", help="comma-separated backends")
+    parser.add_argument("--messages", type=int, default=3, help="messages per patient")
+    parser.add_argument("--distribution", default="funnel", choices=DISTRIBUTIONS, help="completed-stage spread")
+    parser.add_argument("--ops", type=int, default=200, help="maximum calls per operation")
+    parser.add_argument("--budget", type=float, default=5.0, help="maximum seconds per operation")
+    parser.add_argument("--fsync", default="never", help="fsync policy passed to the backends")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--compare", help="earlier JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.20, help="ops/s drop reported as a regression")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",")]
+    backends = [backend.strip() for backend in args.storage.split(",")]
+    unknown = set(backends) - set(SUFFIXES)
+    if unknown:
+        parser.error(f"unknown backends: {', '.join(sorted(unknown))}")
+    options = {
+        "messages": args.messages,
+        "distribution": args.distribution,
+        "ops": args.ops,
+        "budget": args.budget,
+        "fsync": args.fsync,
+        "seed": args.seed,
+    }
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "options": options,
+        },
+        "cases": [],
+    }
+    # A fresh process per case keeps peak RSS and caches from leaking between cases.
+    context = multiprocessing.get_context("spawn")
+    for patients in sizes:
+        for backend in backends:
+            with context.Pool(1) as pool:
+                case = pool.apply(run_case, (backend, patients, options))
+            report["cases"].append(case)
+            rss = case["peak_rss_mib"]
+            print(
+                f"{backend} / {patients} patients: import {case['import_seconds']:.2f}s"
+                + (f", peak RSS {rss:.0f} MiB" if rss is not None else "")
+            )
+            for result in case["results"]:
+                print(
+                    f"  {result['operation']:<16} {result['calls']:>5} calls {result['ops_per_sec']:>11,.1f} ops/s  "
+                    f"p50 {result['p50_ms']:9.3f}  p95 {result['p95_ms']:9.3f}  p99 {result['p99_ms']:9.3f} ms"
+                )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        if compare(report, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,43 @@
+"""Pruebas del registro de cambios (``patient_tracking.changes``)."""
+from __future__ import annotations
+
+import pytest
+
+from patient_tracking.journal import JournalStorage
+from patient_tracking.messaging import MessagingChannel
+from patient_tracking.storage import Patient, PatientStorage
+
+
+def fail_data_write(monkeypatch, storage):
+    def crash(*args, **kwargs):
+        raise OSError("corte de energía")
+
+    monkeypatch.setattr(storage, "_flush" if isinstance(storage, JournalStorage) else "_dump", crash)
+
+
+@pytest.mark.parametrize("backend", [PatientStorage, JournalStorage])
+@pytest.mark.parametrize("use_batch", [False, True])
+def test_feed_is_written_before_the_data(tmp_path, monkeypatch, backend, use_batch):
+    path = tmp_path / "patients.json"
+    storage = backend(path, fsync="never")
+    storage.save_patient(Patient("P1", "Ana", "+569", MessagingChannel.CHAT))
+    patient = storage.get_patient("P1")
+    patient.mark_stage(1)
+
+    fail_data_write(monkeypatch, storage)
+    with pytest.raises(OSError):
+        if use_batch:
+            with storage.batch():
+                storage.save_patient(patient)
+        else:
+            storage.save_patient(patient)
+    monkeypatch.undo()
+    storage.close()
+
+    # El cambio no llegó a guardarse, pero su evento sí: el registro es "al menos una vez".
+    storage = backend(path, fsync="never")
+    assert not storage.get_patient("P1").is_stage_completed(1)
+    events = list(storage.changes_since(0))
+    assert [event["op"] for event in events] == ["patient", "patient", "stage"]
+    assert events[-1]["data"]["stage_id"] == 1
+    storage.close()
@@ -0,0 +1,102 @@
+"""Pruebas del despacho asíncrono (``patient_tracking.dispatch``)."""
+from __future__ import annotations
+
+import asyncio
+from contextlib import contextmanager
+
+import pytest
+
+from patient_tracking.dispatch import ChannelSender, DeliveryError, Dispatcher, Outbox, OutboxEntry
+from patient_tracking.messaging import MessagingChannel
+from patient_tracking.storage import Patient, PatientStorage
+
+
+class FlakySender(ChannelSender):
+    """Falla las primeras ``failures`` veces por mensaje."""
+
+    def __init__(self, failures: int = 0, retryable: bool = True) -> None:
+        self.failures = failures
+        self.retryable = retryable
+        self.attempts = {}
+
+    async def send(self, entry):
+        self.attempts[entry.entry_id] = self.attempts.get(entry.entry_id, 0) + 1
+        if self.attempts[entry.entry_id] <= self.failures:
+            raise DeliveryError("pasarela caída", retryable=self.retryable)
+
+
+class FailingBatchStorage(PatientStorage):
+    """``batch()`` lanza ``OSError`` las primeras ``failures`` veces."""
+
+    failures = 0
+
+    @contextmanager
+    def batch(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disco lleno")
+        with super().batch():
+            yield
+
+
+def setup(tmp_path, count=3, storage_class=PatientStorage):
+    storage = storage_class(tmp_path / "patients.json", fsync="never")
+    outbox = Outbox.beside(storage.path, fsync="never")
+    entries = []
+    for index in range(count):
+        patient_id = f"P{index}"
+        storage.save_patient(Patient(patient_id, "Ana", "+569", MessagingChannel.SMS))
+        entries.append(OutboxEntry.create(patient_id, "Hola", "Recordatorio", MessagingChannel.SMS))
+    outbox.enqueue(entries)
+    return storage, outbox
+
+
+def run(dispatcher):
+    return asyncio.run(asyncio.wait_for(dispatcher.run(), timeout=10))
+
+
+def test_retries_until_delivered(tmp_path):
+    storage, outbox = setup(tmp_path)
+    sender = FlakySender(failures=2)
+    report = run(Dispatcher(storage, outbox, {"sms": sender}, concurrency=2, base_delay=0.01))
+    assert (report.delivered, report.failed, report.retries) == (3, 0, 6)
+    assert all(attempts == 3 for attempts in sender.attempts.values())
+    assert outbox.pending() == []
+    assert [len(storage.message_history(f"P{index}")) for index in range(3)] == [1, 1, 1]
+
+
+def test_gives_up_after_max_attempts_or_permanent_error(tmp_path):
+    storage, outbox = setup(tmp_path)
+    report = run(Dispatcher(storage, outbox, {"sms": FlakySender(failures=9)}, max_attempts=3, base_delay=0.01))
+    assert (report.delivered, report.failed, report.retries) == (0, 3, 6)
+    assert len(outbox.failed()) == 3
+
+    storage, outbox = setup(tmp_path / "permanente")
+    report = run(Dispatcher(storage, outbox, {"sms": FlakySender(failures=1, retryable=False)}, base_delay=0.01))
+    assert (report.delivered, report.failed, report.retries) == (0, 3, 0)
+
+
+def test_backoff_grows_and_is_capped(tmp_path):
+    storage, outbox = setup(tmp_path, count=0)
+    dispatcher = Dispatcher(storage, outbox, {}, base_delay=1.0, max_delay=5.0)
+    assert 0.5 <= dispatcher._backoff(1) <= 1.0
+    assert 2.0 <= dispatcher._backoff(3) <= 4.0
+    assert 2.5 <= dispatcher._backoff(10) <= 5.0
+
+
+def test_failing_flush_does_not_hang_join(tmp_path):
+    storage, outbox = setup(tmp_path, storage_class=FailingBatchStorage)
+    storage.failures = 1
+    report = run(Dispatcher(storage, outbox, {"sms": FlakySender()}, batch_size=1))
+    assert report.flush_errors == ["disco lleno"]
+    assert report.delivered == 3
+    assert outbox.pending() == []
+    assert [len(storage.message_history(f"P{index}")) for index in range(3)] == [1, 1, 1]
+
+
+def test_flush_that_keeps_failing_raises_and_keeps_outbox(tmp_path):
+    storage, outbox = setup(tmp_path, storage_class=FailingBatchStorage)
+    storage.failures = 99
+    with pytest.raises(OSError):
+        run(Dispatcher(storage, outbox, {"sms": FlakySender()}, batch_size=1))
+    assert len(outbox.pending()) == 3
@@ -0,0 +1,49 @@
+"""Pruebas de la importación masiva (``patient_tracking.importer``)."""
+from __future__ import annotations
+
+import io
+import json
+from contextlib import contextmanager
+
+from patient_tracking.importer import import_rows, parse_rows
+from patient_tracking.storage import PatientStorage
+
+
+class RecordingStorage(PatientStorage):
+    in_batch = False
+
+    @contextmanager
+    def batch(self):
+        with super().batch():
+            RecordingStorage.in_batch = True
+            try:
+                yield
+            finally:
+                RecordingStorage.in_batch = False
+
+
+def jsonl(rows):
+    return io.StringIO("".join(json.dumps(row) + "\n" for row in rows))
+
+
+def test_rows_are_parsed_before_the_batch_opens(tmp_path):
+    storage = RecordingStorage(tmp_path / "patients.json", fsync="never")
+    rows = [{"patient_id": f"P{index}", "name": "Ana", "contact": "+569", "stage_status": "1"} for index in range(5)]
+
+    def parsed():
+        for result in parse_rows(jsonl(rows), workers=1):
+            assert not RecordingStorage.in_batch
+            yield result
+
+    report = import_rows(storage, parsed())
+    assert (report.created, report.updated, report.rejected) == (5, 0, [])
+    assert storage.get_patient("P3").is_stage_completed(1)
+    storage.close()
+
+
+def test_parallel_parse_keeps_line_order_with_bounded_window():
+    rows = [{"patient_id": f"P{index}", "name": "Ana", "contact": "+569"} for index in range(50)]
+    rows[17] = {"patient_id": "P17", "name": "Ana", "contact": "+569", "channel": "paloma"}
+    results = list(parse_rows(jsonl(rows), workers=2, chunk_rows=3))
+    assert [line for line, _, _ in results] == list(range(1, 51))
+    assert [line for line, patient, raw in results if raw is not None] == [18]
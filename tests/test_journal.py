@@ -0,0 +1,25 @@
+"""Pruebas del motor de bitácora (``patient_tracking.journal``)."""
+from __future__ import annotations
+
+from patient_tracking.journal import JournalStorage
+from patient_tracking.messaging import MessagingChannel
+from patient_tracking.storage import Patient
+
+
+def test_append_after_torn_tail_survives_reopen(tmp_path):
+    path = tmp_path / "patients.json"
+    storage = JournalStorage(path, fsync="never")
+    storage.save_patient(Patient("P1", "Ana", "+569", MessagingChannel.CHAT))
+    storage.close()
+    with storage.journal_path.open("ab") as fp:
+        fp.write(b'{"op": "patient", "patient": {"patient_id": "P9"')
+
+    storage = JournalStorage(path, fsync="never")
+    storage.save_patient(Patient("P2", "Bea", "+569", MessagingChannel.SMS))
+    assert storage.get_patient("P2") is not None
+    storage.close()
+
+    storage = JournalStorage(path, fsync="never")
+    assert sorted(patient.patient_id for patient in storage.list_patients()) == ["P1", "P2"]
+    assert storage.get_patient("P2").name == "Bea"
+    storage.close()
@@ -0,0 +1,58 @@
+"""Pruebas del limitador de envíos (``patient_tracking.ratelimit``)."""
+from __future__ import annotations
+
+import random
+
+from patient_tracking.ratelimit import RateLimiter, TokenBucket
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def check_limits(sends, rate, burst, gap):
+    """``sends`` son pares ``(instante, paciente)``; verifica la ráfaga del canal y la separación por paciente."""
+    times = sorted(at for at, _ in sends)
+    for first in range(len(times)):
+        for last in range(first, len(times)):
+            assert last - first + 1 <= burst + rate * (times[last] - times[first]) + 1e-9
+    by_patient = {}
+    for at, patient_id in sends:
+        by_patient.setdefault(patient_id, []).append(at)
+    for patient_times in by_patient.values():
+        patient_times.sort()
+        assert all(later - earlier >= gap - 1e-9 for earlier, later in zip(patient_times, patient_times[1:]))
+
+
+def test_patient_gap_does_not_spend_channel_tokens_early():
+    clock = FakeClock()
+    limiter = RateLimiter({"sms": (1.0, 1.0)}, patient_gap=10.0, clock=clock)
+    sends = [(limiter._reserve("sms", patient_id), patient_id) for patient_id in ("A", "B", "A", "B")]
+    assert [at for at, _ in sends] == [0.0, 1.0, 10.0, 11.0]
+    check_limits(sends, rate=1.0, burst=1.0, gap=10.0)
+
+
+def test_combined_limits_hold_for_random_traffic():
+    rng = random.Random(7)
+    clock = FakeClock()
+    limiter = RateLimiter({"sms": (2.0, 3.0)}, patient_gap=4.0, clock=clock)
+    sends = []
+    for _ in range(300):
+        clock.now += rng.choice([0.0, 0.0, 0.1, 0.5, 2.0])
+        patient_id = f"P{rng.randrange(6)}"
+        sends.append((clock.now + limiter._reserve("sms", patient_id), patient_id))
+    check_limits(sends, rate=2.0, burst=3.0, gap=4.0)
+    assert limiter.stats["sms"].queued == 300
+
+
+def test_bucket_allows_burst_then_paces():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2.0, burst=3.0, clock=clock)
+    assert [bucket.reserve() for _ in range(5)] == [0.0, 0.0, 0.0, 0.5, 1.0]
+    clock.now = 10.0
+    assert [bucket.reserve() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.reserve(at=20.0) == 10.0
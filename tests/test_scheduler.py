@@ -0,0 +1,39 @@
+"""Pruebas del programador de etapas (``patient_tracking.scheduler``)."""
+from __future__ import annotations
+
+from datetime import datetime
+
+from patient_tracking import scheduler as scheduler_module
+from patient_tracking.messaging import MessagingChannel
+from patient_tracking.operations import OperationError
+from patient_tracking.scheduler import Scheduler, ScheduleState
+from patient_tracking.storage import Patient, PatientStorage
+
+NOW = datetime(2024, 1, 10, 12, 0)
+
+
+def test_sent_message_is_recorded_even_if_the_stage_fails(tmp_path, monkeypatch):
+    storage = PatientStorage(tmp_path / "patients.json", fsync="never")
+    patient = Patient("P1", "Ana", "+569", MessagingChannel.SMS)
+    patient.mark_stage(1, True, at="2024-01-01T10:00:00")
+    storage.save_patient(patient)
+    state = ScheduleState.beside(storage.path, fsync="never")
+
+    def failing_set_stage(*args, **kwargs):
+        raise OperationError("conflicto")
+
+    monkeypatch.setattr(scheduler_module, "set_stage", failing_set_stage)
+    scheduler = Scheduler(storage, state, clock=lambda: NOW)
+    assert scheduler.rebuild() == 1
+    report = scheduler.run_due()
+    assert report.sent == 1
+    assert report.errors == ["P1/recordatorio: etapa 2: conflicto"]
+    assert "P1/recordatorio" in ScheduleState.beside(storage.path).refresh()
+
+    # La etapa sigue pendiente, pero el recordatorio no se vuelve a enviar.
+    assert scheduler.rebuild() == 0
+    assert scheduler.run_due().sent == 0
+    assert not storage.get_patient("P1").is_stage_completed(2)
+    assert len(storage.message_history("P1")) == 1
+    state.close()
+    storage.close()
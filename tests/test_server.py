@@ -0,0 +1,71 @@
+"""Pruebas del servicio HTTP (``patient_tracking.server``)."""
+from __future__ import annotations
+
+import http.client
+import json
+import socket
+import threading
+from urllib.parse import quote
+
+import pytest
+
+from patient_tracking.server import ApiServer
+from patient_tracking.storage import PatientStorage
+
+
+@pytest.fixture
+def client(tmp_path):
+    storage = PatientStorage(tmp_path / "patients.json", fsync="never")
+    server = ApiServer(("127.0.0.1", 0), storage)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connection = http.client.HTTPConnection(*server.server_address, timeout=5)
+    yield connection
+    connection.close()
+    server.shutdown()
+    server.server_close()
+    storage.close()
+
+
+def request(connection, method, path, body=None, headers=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    connection.request(method, path, body=data, headers=headers or {})
+    response = connection.getresponse()
+    return response, response.read()
+
+
+@pytest.mark.parametrize("patient_id", ["Ω1", "ñandú-7", 'a"b'])
+def test_etag_with_non_ascii_patient_id(client, patient_id):
+    response, _ = request(
+        client, "POST", "/pacientes", {"patient_id": patient_id, "name": "Ana", "contact": "+569", "channel": "sms"}
+    )
+    assert response.status == 201
+    etag = response.getheader("ETag")
+    assert etag.startswith('"') and etag.endswith('"') and etag[1:-1].isalnum()
+
+    path = "/pacientes/" + quote(patient_id, safe="")
+    response, body = request(client, "GET", path)
+    assert response.status == 200
+    assert json.loads(body)["patient_id"] == patient_id
+    assert response.getheader("ETag") == etag
+
+    response, _ = request(client, "GET", path, headers={"If-None-Match": etag})
+    assert response.status == 304
+
+
+@pytest.mark.parametrize("length", ["-1", "abc", "1_0", "+5"])
+def test_invalid_content_length_is_rejected(client, length):
+    with socket.create_connection((client.host, client.port), timeout=5) as sock:
+        sock.sendall(f"POST /pacientes HTTP/1.1\r\nHost: x\r\nContent-Length: {length}\r\n\r\n{{}}".encode("ascii"))
+        response = http.client.HTTPResponse(sock)
+        response.begin()
+        assert response.status == 400
+        assert "Content-Length" in json.loads(response.read())["error"]
+
+
+@pytest.mark.parametrize("pendiente, completed", [("false", True), ("true", False), (False, True), ("no", True)])
+def test_mark_parses_pendiente_like_the_batch(client, pendiente, completed):
+    request(client, "POST", "/pacientes", {"patient_id": "P1", "name": "Ana", "contact": "+569"})
+    response, body = request(client, "POST", "/pacientes/P1/etapas", {"stage_id": 3, "pendiente": pendiente})
+    assert response.status == 200
+    assert json.loads(body)["stage_status"].get("3", False) is completed
@@ -0,0 +1,136 @@
+"""Pruebas del almacenamiento repartido en fragmentos (``patient_tracking.sharded``)."""
+from __future__ import annotations
+
+import multiprocessing
+import time
+
+import pytest
+
+from patient_tracking.messaging import MessageRecord, MessagingChannel
+from patient_tracking.sharded import ShardedStorage, shard_of
+from patient_tracking.storage import Patient
+
+SHARDS = 4
+
+
+def _ids_in_different_shards():
+    low = next(f"P{index}" for index in range(100) if shard_of(f"P{index}", SHARDS) == 0)
+    high = next(f"P{index}" for index in range(100) if shard_of(f"P{index}", SHARDS) == SHARDS - 1)
+    return low, high
+
+
+def _batch_worker(root, first, second, scan, ready, start):
+    # El almacenamiento se abre antes de que empiece cualquier lote, como en ``servir``.
+    storage = ShardedStorage(root, shards=SHARDS, fsync="never")
+    ready.wait()
+    start.wait()
+    with storage.batch():
+        storage.get_patient(first)
+        time.sleep(0.5)
+        if scan:
+            sum(1 for _ in storage.iter_patients())
+        storage.get_patient(second)
+        for patient_id in (first, second):
+            storage.save_message(MessageRecord(patient_id, "s", f"de {first}", MessagingChannel.CHAT, "2024-01-01"))
+    storage.close()
+
+
+@pytest.mark.parametrize("scan", [False, True])
+def test_batches_in_opposite_order_do_not_deadlock(tmp_path, scan):
+    root = tmp_path / "pacientes"
+    low, high = _ids_in_different_shards()
+    with ShardedStorage(root, shards=SHARDS, fsync="never") as storage:
+        for patient_id in (low, high):
+            storage.save_patient(Patient(patient_id, patient_id, "+569", MessagingChannel.CHAT))
+
+    context = multiprocessing.get_context("fork")
+    ready, start = context.Barrier(2), context.Barrier(2)
+    workers = [
+        context.Process(target=_batch_worker, args=(root, low, high, False, ready, start)),
+        context.Process(target=_batch_worker, args=(root, high, low, scan, ready, start)),
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(timeout=20)
+    hung = [worker for worker in workers if worker.is_alive()]
+    for worker in hung:
+        worker.kill()
+    assert not hung, "los lotes quedaron bloqueados entre sí"
+    assert [worker.exitcode for worker in workers] == [0, 0]
+
+    with ShardedStorage(root, shards=SHARDS, fsync="never") as storage:
+        for patient_id in (low, high):
+            assert sorted(message.body for message in storage.message_history(patient_id)) == [
+                f"de {high}",
+                f"de {low}",
+            ]
+
+
+@pytest.mark.parametrize("parallel", ["hilos", "procesos"])
+def test_iter_patients_streams_every_shard(tmp_path, parallel):
+    ids = [f"P{index:03d}" for index in range(60)]
+    with ShardedStorage(tmp_path / "pacientes", shards=SHARDS, fsync="never", workers=2, parallel=parallel) as storage:
+        for patient_id in ids:
+            storage.save_patient(Patient(patient_id, patient_id, "+569", MessagingChannel.CHAT))
+        storage.save_message(MessageRecord(ids[0], "s", "hola", MessagingChannel.CHAT, "2024-01-01"))
+
+        stream = storage.iter_patients()
+        first = next(stream)
+        assert first.patient_id in ids
+        patients = [first, *stream]
+        assert sorted(patient.patient_id for patient in patients) == ids
+        assert [len(patient.messages) for patient in patients if patient.patient_id == ids[0]] == [1]
+        assert all(not patient.messages for patient in storage.iter_patients(include_messages=False))
+        assert sorted(patient.patient_id for patient in storage.list_patients()) == ids
+
+
+def test_reshard_keeps_every_record(tmp_path):
+    root = tmp_path / "pacientes"
+    ids = [f"P{index:03d}" for index in range(50)]
+    with ShardedStorage(root, shards=SHARDS, fsync="never") as storage:
+        for patient_id in ids:
+            storage.save_patient(Patient(patient_id, "Ñuñoa " + patient_id, "+569", MessagingChannel.CHAT))
+            storage.save_message(MessageRecord(patient_id, "s", "hola", MessagingChannel.CHAT, "2024-01-01"))
+        (root / ".reparto-interrumpido").mkdir()
+
+        assert storage.reshard(3) == (len(ids), SHARDS)
+        assert storage.reshard(7) == (len(ids), 3)
+        assert storage.shard_count == 7
+        assert sorted(path.name for path in root.glob("fragmento-*.json")) == [
+            f"fragmento-2-{index:03d}.json" for index in range(7)
+        ]
+        assert not list(root.glob(".reparto-*"))
+        patients = storage.list_patients()
+        assert sorted(patient.patient_id for patient in patients) == ids
+        assert all(patient.name == "Ñuñoa " + patient.patient_id and patient.messages for patient in patients)
+
+
+def test_failed_batch_is_atomic_per_shard(tmp_path):
+    low, high = _ids_in_different_shards()
+    with ShardedStorage(tmp_path / "pacientes", shards=SHARDS, fsync="never") as storage:
+        for patient_id in (low, high):
+            storage.save_patient(Patient(patient_id, "Ana", "+569", MessagingChannel.CHAT))
+
+        # Mayor y luego menor: el fragmento mayor se escribe al reordenar y queda guardado.
+        with pytest.raises(RuntimeError):
+            with storage.batch():
+                for patient_id in (high, low):
+                    patient = storage.get_patient(patient_id)
+                    patient.name = "Bea"
+                    storage.save_patient(patient)
+                raise RuntimeError("falla")
+        assert (storage.get_patient(high).name, storage.get_patient(low).name) == ("Bea", "Ana")
+
+        # En orden ascendente nada se escribe antes de terminar: se descarta todo.
+        with pytest.raises(RuntimeError):
+            with storage.batch():
+                for patient_id in (low, high):
+                    patient = storage.get_patient(patient_id)
+                    patient.name = "Cata"
+                    storage.save_patient(patient)
+                raise RuntimeError("falla")
+        assert (storage.get_patient(high).name, storage.get_patient(low).name) == ("Bea", "Ana")
+
+    with ShardedStorage(tmp_path / "pacientes", fsync="never") as storage:
+        assert (storage.get_patient(high).name, storage.get_patient(low).name) == ("Bea", "Ana")
@@ -0,0 +1,98 @@
+"""Pruebas del motor SQLite (``patient_tracking.sqlite_storage``) frente al motor JSON."""
+from __future__ import annotations
+
+import os
+
+import pytest
+
+from patient_tracking.messaging import MessageRecord, MessagingChannel
+from patient_tracking.sqlite_storage import SQLiteStorage
+from patient_tracking.storage import ConflictError, Patient, PatientStorage, open_storage, parse_storage_spec
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "json":
+        backend = PatientStorage(tmp_path / "patients.json", fsync="never")
+    else:
+        backend = SQLiteStorage(tmp_path / "patients.db", fsync="never")
+    yield backend
+    backend.close()
+
+
+def message(patient_id, subject, body):
+    return MessageRecord(patient_id, subject, body, MessagingChannel.SMS, "2024-01-01T10:00:00")
+
+
+def test_stale_save_raises_conflict(storage):
+    storage.save_patient(Patient("P1", "Ana", "+569", MessagingChannel.SMS))
+    first = storage.get_patient("P1")
+    second = storage.get_patient("P1")
+    first.notes = "primera"
+    storage.save_patient(first)
+    second.notes = "segunda"
+    with pytest.raises(ConflictError):
+        storage.save_patient(second)
+    assert storage.get_patient("P1").notes == "primera"
+
+    # Un mensaje también cambia la versión.
+    current = storage.get_patient("P1")
+    storage.save_message(message("P1", "Hola", "Recordatorio"))
+    with pytest.raises(ConflictError):
+        storage.save_patient(current)
+
+
+def test_search_finds_patients_and_messages(storage):
+    storage.save_patient(Patient("P1", "Ana Pérez", "+56 9 1234 5678", MessagingChannel.SMS))
+    storage.save_patient(Patient("P2", "Bea Soto", "+56 9 8765 4321", MessagingChannel.SMS, notes="alergia"))
+    storage.save_message(message("P1", "Control", "Traer exámenes de sangre"))
+
+    assert [hit.patient_id for hit in storage.search("perez")] == ["P1"]
+    assert [hit.patient_id for hit in storage.search("alergia")] == ["P2"]
+    assert [hit.patient_id for hit in storage.search("4321")] == ["P2"]
+    assert [(hit.patient_id, hit.subject) for hit in storage.search("examenes sangre")] == [("P1", "Control")]
+    assert storage.search("examenes alergia") == []
+
+    # Renombrar reemplaza la entrada del índice en lugar de duplicarla.
+    patient = storage.get_patient("P1")
+    patient.name = "Ana Rojas"
+    storage.save_patient(patient)
+    assert storage.search("perez") == []
+    assert [hit.patient_id for hit in storage.search("rojas")] == ["P1"]
+
+
+def test_batch_rolls_back_on_error(storage):
+    storage.save_patient(Patient("P1", "Ana", "+569", MessagingChannel.SMS))
+    cursor = max([event["seq"] for event in storage.changes_since(0)], default=0)
+    with pytest.raises(RuntimeError):
+        with storage.batch():
+            storage.save_patient(Patient("P2", "Bea", "+569", MessagingChannel.SMS))
+            patient = storage.get_patient("P1")
+            patient.mark_stage(1, True)
+            storage.save_patient(patient)
+            storage.save_message(message("P1", "Hola", "Bienvenida"))
+            raise RuntimeError("falla a mitad del lote")
+    assert [patient.patient_id for patient in storage.list_patients()] == ["P1"]
+    assert storage.get_patient("P1").completed_stages() == []
+    assert storage.message_history("P1") == []
+    assert list(storage.changes_since(cursor)) == []
+    assert storage.search("bea") == []
+
+
+def test_sqlite_spec_paths_are_relative_unless_doubled(tmp_path, monkeypatch):
+    assert parse_storage_spec("sqlite:///datos/p.db") == ("sqlite", "datos/p.db")
+    assert parse_storage_spec("sqlite:////var/datos/p.db") == ("sqlite", "/var/datos/p.db")
+
+    monkeypatch.chdir(tmp_path)
+    with open_storage("sqlite:///relativa.db", fsync="never") as storage:
+        assert isinstance(storage, SQLiteStorage)
+        storage.save_patient(Patient("P1", "Ana", "+569", MessagingChannel.SMS))
+    assert os.path.exists(tmp_path / "relativa.db")
+
+    absolute = tmp_path / "otra" / "absoluta.db"
+    absolute.parent.mkdir()
+    with open_storage(f"sqlite:///{absolute}", fsync="never") as storage:
+        assert [patient.patient_id for patient in storage.list_patients()] == []
+        storage.save_patient(Patient("P2", "Bea", "+569", MessagingChannel.SMS))
+    with SQLiteStorage(absolute, fsync="never") as storage:
+        assert storage.get_patient("P2").name == "Bea"
@@ -0,0 +1,36 @@
+"""Pruebas del paciente y del motor JSON (``patient_tracking.storage``)."""
+from __future__ import annotations
+
+from patient_tracking.messaging import MessagingChannel
+from patient_tracking.storage import Patient
+
+
+def test_constructor_still_accepts_stage_status():
+    patient = Patient(
+        "P1",
+        "Ana",
+        "+569",
+        MessagingChannel.SMS,
+        stage_status={"1": True, "3": False},
+        stage_times={"1": "2024-01-01T10:00:00", "3": "2024-01-02T10:00:00"},
+    )
+    assert patient.stage_status == {"1": True, "3": False}
+    assert patient.completed_stages() == [1]
+    assert patient.stage_times == {"1": "2024-01-01T10:00:00"}
+    assert Patient.from_dict(patient.to_dict()).stage_status == patient.stage_status
+
+
+def test_stage_times_is_allocated_on_first_completion():
+    patient = Patient("P1", "Ana", "+569")
+    assert patient.stage_times is None and patient.stage_time(1) is None
+    patient.mark_stage(2, False)
+    assert patient.stage_times is None
+    assert patient.to_dict()["stage_times"] == {}
+
+    patient.mark_stage(1, True, at="2024-01-01T10:00:00")
+    assert patient.stage_time(1) == "2024-01-01T10:00:00"
+    patient.mark_stage(1, False)
+    assert patient.stage_time(1) is None
+
+    loaded = Patient.from_dict({"patient_id": "P2", "name": "Bea", "contact": "+569", "stage_status": {"4": False}})
+    assert loaded.stage_times is None